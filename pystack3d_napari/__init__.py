@@ -1,4 +1,17 @@
+PROCESS_NAMES = ['cropping', 'bkg_removal', 'intensity_rescaling', 'intensity_rescaling_area',
+                 'registration_calculation', 'registration_transformation',
+                 'destriping', 'resampling', 'cropping_final']
+
 KWARGS_RENDERING = {'blending': "opaque", 'colormap': "viridis", 'depiction': "volume",
                     'rendering': "translucent"}
 
 FILTER_DEFAULT = {'name': 'Gabor', 'noise_level': 20.0, 'sigma': [0.5, 200], 'theta': 0.0}
+
+# steps evaluated slice by slice by the live preview (see 'preview.PREVIEW_KERNELS')
+PREVIEW_STEPS = ['cropping', 'bkg_removal', 'intensity_rescaling',
+                 'registration_transformation', 'destriping', 'cropping_final']
+
+RETENTION_POLICIES = {'all': "keep all",
+                      'consumed': "delete once consumed",
+                      'final': "keep final only",
+                      'last': "keep last N"}
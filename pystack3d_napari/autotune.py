@@ -0,0 +1,132 @@
+"""
+Automatic 'nproc' (and fused 'chunksize') recommendation from a short calibration of the step
+on a few slices, the available RAM and the number of cores
+"""
+import os
+import json
+import time
+import tracemalloc
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import psutil
+
+from pystack3d_napari.preview import PREVIEW_KERNELS, get_kernel, get_input_stack
+from pystack3d_napari.reader import TiffStack
+
+WORKER_OVERHEAD = 150 * 2 ** 20  # interpreter + pystack3d imports in a spawned worker
+SPAWN_TIME = 1.  # worker start-up time (s), not worth for less work
+RAM_SAFETY = 0.7  # fraction of the available RAM usable by the workers
+TASK_TIME = 1.  # targeted duration of the fused tasks (s)
+
+# working memory of the steps without single-slice kernel, in input slices (float64) sizes
+MEMORY_FACTORS = {'intensity_rescaling_area': 4,
+                  'registration_calculation': 8,
+                  'resampling': 6}
+
+_CALIBRATIONS = {}  # (process_name, params, input slices...): (nslices, calibration)
+
+
+def calibrate(process_name, params, tiff_stack, project_dir=None, nslices=3):
+    """
+    Evaluate 'process_name' on 'nslices' slices of 'tiff_stack' (step input images), in a
+    spawned process for the allocations of the calling one (GUI) not to be traced.
+    Return the mean time per slice (None if not measurable) and the peak working memory.
+    The results are reused by the further calls for the same step, parameters and input
+    slices (e.g. the admission check following 'auto_nproc')
+    """
+    slice_bytes = int(np.prod(tiff_stack.slice_shape)) * 8
+    default = None, MEMORY_FACTORS.get(process_name, 4) * slice_bytes
+    if process_name not in PREVIEW_KERNELS:
+        return default
+
+    try:
+        mtime = os.stat(tiff_stack.fnames[0]).st_mtime_ns
+    except OSError:
+        mtime = None
+    key = (process_name, json.dumps(params, sort_keys=True, default=str),
+           tuple(tiff_stack.fnames), mtime, str(project_dir))
+    if key in _CALIBRATIONS and _CALIBRATIONS[key][0] >= nslices:
+        return _CALIBRATIONS[key][1]
+
+    inds = np.unique(np.linspace(0, len(tiff_stack) - 1, nslices).astype(int))
+    args = (process_name, params, tiff_stack.fnames, tiff_stack.slice_shape,
+            tiff_stack.dtype.str, project_dir, inds)
+    try:
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+            result = executor.submit(calibrate_slices, *args).result()
+    except Exception:  # (worker start-up failure)
+        result = None
+    if result is None:  # missing pre-calculated data ('tmats.npy', ...)
+        return default
+    time_per_slice, peak = result
+    _CALIBRATIONS[key] = (nslices, (time_per_slice, max(peak, slice_bytes)))
+    return _CALIBRATIONS[key][1]
+
+
+def calibrate_slices(process_name, params, fnames, shape, dtype, project_dir, inds):
+    """ Return the median time and the peak memory of the evaluation of the 'inds' slices """
+    tiff_stack = TiffStack(fnames, shape=shape, dtype=dtype, cache=None)
+    tracemalloc.start()
+    try:
+        kernel = get_kernel(process_name, params, tiff_stack, project_dir=project_dir)
+        durations = []
+        for ind in inds:
+            img = np.array(tiff_stack.read(ind))
+            t0 = time.perf_counter()
+            kernel(img, ind)
+            durations.append(time.perf_counter() - t0)
+        return float(np.median(durations)), tracemalloc.get_traced_memory()[1]
+    except Exception:
+        return None
+    finally:
+        tracemalloc.stop()
+
+
+def recommend(nslices, time_per_slice, peak_bytes, ram_available=None, cpu_count=None,
+              nslices_tot=None):
+    """
+    Return the recommended 'nproc', the fused tasks 'chunksize' and the explanation of the
+    choice, limited by the cores, the RAM per worker, the 'nslices' slices per channel (the
+    pystack3d partition requires nproc <= nslices) and the work per worker, estimated with
+    the 'nslices_tot' slices of all the channels
+    """
+    nslices_tot = nslices_tot or nslices
+    ram_available = ram_available or psutil.virtual_memory().available
+    cpu_count = cpu_count or os.cpu_count()
+    worker_bytes = WORKER_OVERHEAD + peak_bytes
+
+    limits = {'cores': cpu_count,
+              'RAM': max(int(RAM_SAFETY * ram_available // worker_bytes), 1),
+              'slices': max(nslices, 1)}
+    if time_per_slice is not None:
+        limits['work'] = max(int(nslices_tot * time_per_slice / SPAWN_TIME), 1)
+    reason = min(limits, key=limits.get)
+    nproc = limits[reason]
+
+    chunksize = max(1, min(8, nslices_tot // (4 * nproc)))
+    if time_per_slice:
+        chunksize = max(1, min(chunksize, int(TASK_TIME / time_per_slice)))
+
+    lines = [f"nproc={nproc} (limited by {reason})",
+             f"  {worker_bytes / 2 ** 20:.0f} MB/worker, "
+             f"{ram_available / 2 ** 30:.1f} GB RAM available -> {limits['RAM']} workers max",
+             f"  {cpu_count} cores, {nslices} slices/channel ({nslices_tot} in total)"]
+    if time_per_slice is not None:
+        lines.append(f"  {1e3 * time_per_slice:.0f} ms/slice -> {limits['work']} workers "
+                     f"for {SPAWN_TIME:.0f}s of work each")
+    else:
+        lines.append("  time per slice not measured (memory estimated)")
+    return nproc, chunksize, "\n".join(lines)
+
+
+def auto_nproc(stack, process_name, params, nslices=3):
+    """ Calibrate 'process_name' on its input images and return (nproc, chunksize, explanation) """
+    tiff_stack = get_input_stack(stack, process_name)
+    if tiff_stack is None:
+        return stack.params['nproc'], None, "No input image: nproc unchanged"
+    time_per_slice, peak_bytes = calibrate(process_name, params, tiff_stack,
+                                           project_dir=stack.project_dir, nslices=nslices)
+    nslices_tot = len(tiff_stack) * len(stack.channels(process_name))
+    return recommend(len(tiff_stack), time_per_slice, peak_bytes, nslices_tot=nslices_tot)
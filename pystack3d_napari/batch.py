@@ -0,0 +1,324 @@
+"""
+Headless execution of the processing steps saved in a parameters file (without Qt/napari)
+"""
+import sys
+import ast
+import json
+import time
+import shutil
+from pathlib import Path
+from contextlib import redirect_stdout, nullcontext
+from threading import Thread, Event
+
+from tomlkit import parse
+from pystack3d import Stack3d
+from pystack3d.utils import dumps_params
+
+from pystack3d_napari import PROCESS_NAMES, autotune
+from pystack3d_napari.governor import MemoryGovernor, check_admission
+from pystack3d_napari.fusion import eval_fused, get_fused_groups, get_restart_step, is_pool_run
+from pystack3d_napari.profiling import profiling
+from pystack3d_napari.store import write_step_stores, DEFAULT_OUTPUT
+from pystack3d_napari.retention import compress_step, get_steps_to_release, release_step
+from pystack3d_napari.fingerprint import (get_fingerprints, write_fingerprint, is_uptodate,
+                                          write_run_marker, remove_run_marker,
+                                          get_resumable_steps)
+from pystack3d_napari.utils import (convert_params, update_progress, get_input_dirname,
+                                    get_slice_nbytes, format_duration)
+
+
+class Signal:
+    """ Minimal stand-in of the Qt signals used by 'update_progress' """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+
+    def emit(self, value):
+        if self.callback is not None:
+            self.callback(value)
+
+
+class Reporter:
+    """ Stream the run events to stdout, as text or as json lines """
+
+    def __init__(self, json_mode=False, stream=None):
+        self.json_mode = json_mode
+        self.stream = stream or sys.stdout
+
+    def __call__(self, event, **kwargs):
+        if self.json_mode:
+            line = json.dumps({'event': event, 'time': time.time(), **kwargs})
+        elif event == 'progress':
+            line = (f"  [{kwargs['step']}] {kwargs['percent']:3d}% - "
+                    f"{kwargs['slices/s']:.1f} sl/s - {kwargs['MB/s']:.1f} MB/s - "
+                    f"ETA {format_duration(kwargs['eta'])}")
+            if len(kwargs['channels']) > 1:
+                line += " - channels " + " ".join(f"{stats['count']}/{stats['ntot'] or '?'}"
+                                                  for stats in kwargs['channels'])
+        elif event == 'run_end':
+            status = 'failed' if kwargs['exit_code'] else 'completed'
+            line = f"run {status} in {format_duration(kwargs['duration'])}"
+        elif event == 'step_start':
+            line = f"[{kwargs['step']}] started (nproc={kwargs['nproc']})"
+        elif event == 'step_end':
+            line = f"[{kwargs['step']}] {kwargs['status']} in {format_duration(kwargs['duration'])}"
+            if kwargs.get('error'):
+                line += f": {kwargs['error']}"
+        elif event == 'profile':
+            line = f"[{kwargs['step']}] {kwargs['summary']}"
+        else:
+            line = f"{event}: " + ", ".join(f"{key}={val}" for key, val in kwargs.items())
+        print(line, file=self.stream, flush=True)
+
+
+def load_params(fname_toml):
+    with open(fname_toml, 'r', encoding='utf-8') as fid:
+        return parse(fid.read()).unwrap()
+
+
+def create_stack(params, project_dir=None, nproc=None):
+    """ Create the Stack3d object as done by the GUI 'INIT' button """
+    project_dir = Path(project_dir or params['project_dir'])
+    channels = params.get('channels') or ['.']
+    if isinstance(channels, str):
+        channels = ast.literal_eval(channels)
+
+    stack = Stack3d(input_name=project_dir, ignore_error=True)
+    stack.params['channels'] = channels
+    stack.params['ind_min'] = params.get('ind_min', 0)
+    stack.params['ind_max'] = params.get('ind_max', 99999)
+    stack.params['nproc'] = nproc or params.get('nproc', 1)
+    stack.params['process_steps'] = params.get('process_steps', PROCESS_NAMES)
+    for process_name in PROCESS_NAMES:
+        if process_name in params:
+            stack.params[process_name] = convert_params(params[process_name])
+    return stack
+
+
+def delete_steps(stack, process_name):
+    """ Delete the outputs of 'process_name' and of the following steps in the history """
+    history = stack.params['history']
+    ind = history.index(process_name)
+    for process_name_ in history[ind:]:
+        shutil.rmtree(stack.project_dir / 'process' / process_name_, ignore_errors=True)
+    stack.params['history'] = history[:ind]
+    if stack.fname_toml:
+        stack.fname_toml.write_text(dumps_params(stack.params), encoding='utf-8')
+
+
+def run_step(stack, process_name, reporter, interval=1., stdout=None, fused_steps=(),
+             checkpoints=(), resume=False, chunksize=None, profile=False,
+             concurrent_channels=False):
+    """
+    Evaluate a processing step, streaming its progress through 'reporter'.
+    The slice-local 'fused_steps' following 'process_name' are evaluated in the same pass.
+    With 'resume', only the missing slices of an interrupted run are processed.
+    With 'concurrent_channels', the slices of all the channels of a slice-local step are
+    processed by a single pool of workers
+    With 'profile', the run is profiled in 'process/<last step>/profile'
+    """
+    nproc = stack.params['nproc']
+    channels = stack.channels(process_name)
+    input_dirname = get_input_dirname(stack.project_dir, stack.params['history'], process_name)
+    slice_nbytes = get_slice_nbytes(input_dirname, channels)
+    stop_event = Event()
+    name = "+".join([process_name, *fused_steps])
+    pool_run = is_pool_run([process_name, *fused_steps], len(channels), resume=resume,
+                           concurrent_channels=concurrent_channels)
+
+    def on_stats(stats):
+        reporter('progress', step=name, **stats)
+
+    progress = Thread(target=update_progress, daemon=True,
+                      kwargs={'nchannels': len(channels), 'nproc': nproc,
+                              'queue_incr': stack.queue_incr, 'pbar_signal': Signal(),
+                              'stop_event': stop_event, 'stats_signal': Signal(on_stats),
+                              'slice_nbytes': slice_nbytes, 'interval': interval})
+    progress.start()
+    profile_results = {}
+    try:
+        with redirect_stdout(stdout or sys.stdout), \
+                (profiling(stack.project_dir, [process_name, *fused_steps], profile_results)
+                 if profile else nullcontext()):
+            if pool_run:
+                eval_fused(stack, [process_name, *fused_steps], checkpoints=checkpoints,
+                           pbar_init=True, resume=resume, chunksize=chunksize,
+                           concurrent_channels=concurrent_channels)
+            else:
+                stack.eval(process_steps=process_name, show_pbar=False, pbar_init=True)
+        progress.join(timeout=5.)  # let the last increments be collected
+    finally:
+        stop_event.set()
+        progress.join()
+        if 'summary' in profile_results:
+            reporter('profile', step=name, dirname=str(profile_results['dirname']),
+                     summary=profile_results['summary'])
+
+
+def run(fname_toml, project_dir=None, process_steps=None, nproc=None, json_mode=False,
+        fname_output=None, stream=None, fuse=False, checkpoints=(), resume=False,
+        auto_nproc=False, governor=False, profile=False, retention='all', keep=1,
+        concurrent_channels=False):
+    """
+    Run the processing steps in the order of 'process_steps'. Return the exit code.
+    With 'fuse', the consecutive slice-local steps are evaluated in memory in a single pass,
+    only the last one and the 'checkpoints' steps saving their images.
+    With 'resume', the interrupted slice-local steps only process their missing slices.
+    With 'auto_nproc', the nproc of each step is chosen from a calibration on a few slices.
+    With 'governor', the steps exceeding the available RAM are refused and the workers are
+    suspended under memory pressure (events logged in 'process/<step>/governor.log').
+    With 'profile', each step run is profiled in 'process/<step>/profile'.
+    With 'concurrent_channels', the channels of the slice-local steps share a single pool of
+    workers instead of being processed one after another.
+    The steps with 'format = "zarr"' in the TOML 'outputs' table get their tiff slices
+    exported to chunked zarr stores once completed ('process/<step>/<channel>/stack.zarr'),
+    and their tiff slices are compressed with a 'compression' other than "none".
+    With 'retention' ('consumed', 'final' or 'last' with 'keep' steps), the images of the steps
+    no longer needed by the following ones are deleted along the run
+    """
+    reporter = Reporter(json_mode=json_mode, stream=stream)
+    # in json mode, all the prints (stack creation, pystack3d, ...) are sent to stderr not to
+    # pollute the json stream
+    with redirect_stdout(sys.stderr if json_mode else sys.stdout):
+        return run_steps(reporter, fname_toml, project_dir=project_dir,
+                         process_steps=process_steps, nproc=nproc, fname_output=fname_output,
+                         fuse=fuse, checkpoints=checkpoints, resume=resume,
+                         auto_nproc=auto_nproc, governor=governor, profile=profile,
+                         retention=retention, keep=keep,
+                         concurrent_channels=concurrent_channels)
+
+
+def run_steps(reporter, fname_toml, project_dir=None, process_steps=None, nproc=None,
+              fname_output=None, fuse=False, checkpoints=(), resume=False, auto_nproc=False,
+              governor=False, profile=False, retention='all', keep=1,
+              concurrent_channels=False):
+    """ Run the processing steps as described in 'run', the events being sent to 'reporter' """
+    try:
+        params = load_params(fname_toml)
+        stack = create_stack(params, project_dir=project_dir, nproc=nproc)
+    except Exception as e:
+        reporter('error', msg=repr(e))
+        return 1
+    process_steps = process_steps or params.get('process_steps', [])
+    outputs = params.get('outputs', {})
+
+    unknown = [name for name in process_steps if name not in PROCESS_NAMES]
+    if unknown:
+        reporter('error', msg=f"unknown process steps: {unknown}")
+        return 2
+
+    reporter('run_start', project_dir=str(stack.project_dir), steps=process_steps,
+             nproc=stack.params['nproc'])
+    timings = []
+    exit_code = 0
+    t0 = time.perf_counter()
+    # outdated outputs deletion (with the following ones), the others being skipped
+    history = stack.params['history']
+    for process_name in process_steps:
+        params = stack.params.get(process_name, {})
+        if process_name in history and not is_uptodate(stack, process_name, params):
+            delete_steps(stack, get_restart_step(stack.project_dir, stack.params['channels'],
+                                                 history, process_name))
+            break
+
+    if fuse:
+        groups = get_fused_groups(process_steps, stack.params['history'])
+    else:
+        groups = [[process_name] for process_name in process_steps]
+
+    def apply_retention(pending):
+        process_names = get_steps_to_release(retention, stack.project_dir,
+                                             stack.params['channels'], stack.params['history'],
+                                             pending, nkeep=keep)
+        for name in process_names:
+            nbytes = release_step(stack.project_dir, name, stack.channels(name), policy=retention)
+            reporter('released', step=name, nbytes=nbytes)
+
+    for igroup, group in enumerate(groups):
+        apply_retention([name for group_ in groups[igroup:] for name in group_])
+        resume_steps = get_resumable_steps(stack, group[0], stack.params) if resume else None
+        group = resume_steps or group  # a resumed run keeps its own fused steps
+        process_name = "+".join(group)
+        params_list = [stack.params.get(name, {}) for name in group]
+        if group[0] in stack.params['history']:
+            timings.append({'step': process_name, 'status': 'up to date', 'duration': 0.})
+            reporter('step_end', step=process_name, status='up to date', duration=0., error=None)
+            continue
+        restart = get_restart_step(stack.project_dir, stack.params['channels'],
+                                   stack.params['history'], group[0])
+        if restart != group[0] and resume_steps is None:
+            error = f"input images not saved (fused steps) or released: re-run from {restart}"
+            timings.append({'step': process_name, 'status': 'failed', 'duration': 0.})
+            reporter('step_end', step=process_name, status='failed', duration=0., error=error)
+            exit_code = 1
+            break
+        chunksize = None
+        if auto_nproc:
+            nproc_, chunksize, info = autotune.auto_nproc(stack, group[0], params_list[0])
+            stack.params['nproc'] = nproc_
+            reporter('nproc', step=process_name, nproc=nproc_, info=info)
+        if governor:
+            reason = check_admission(stack, group[0], params_list[0], stack.params['nproc'])
+            if reason is not None:
+                timings.append({'step': process_name, 'status': 'refused', 'duration': 0.})
+                reporter('step_end', step=process_name, status='refused', duration=0.,
+                         error=reason)
+                exit_code = 1
+                break
+        reporter('step_start', step=process_name, nproc=stack.params['nproc'])
+        t0_step = time.perf_counter()
+        status, error = 'completed', None
+        memory_governor = None
+        if governor:
+            # (only the independent workers of a pool run can be suspended)
+            memory_governor = MemoryGovernor(throttle=is_pool_run(
+                group, len(stack.channels(group[0])), resume=resume_steps is not None,
+                concurrent_channels=concurrent_channels))
+        try:
+            if memory_governor is not None:
+                memory_governor.start()
+            fingerprints = get_fingerprints(stack, group, params_list)
+            write_run_marker(stack.project_dir, group, fingerprints)
+            run_step(stack, group[0], reporter, fused_steps=group[1:], checkpoints=checkpoints,
+                     resume=resume_steps is not None, chunksize=chunksize, profile=profile,
+                     concurrent_channels=concurrent_channels)
+            for name, fingerprint in zip(group, fingerprints):
+                if fingerprint is not None:
+                    write_fingerprint(stack.project_dir, name, fingerprint)
+            remove_run_marker(stack.project_dir, group)
+            for name in group:
+                output = {**DEFAULT_OUTPUT, **outputs.get(name, {})}
+                if output['compression'] != 'none':
+                    nbytes, nbytes_new = compress_step(stack.project_dir, name,
+                                                       stack.channels(name),
+                                                       output['compression'],
+                                                       output['compression_level'])
+                    reporter('compressed', step=name, nbytes=nbytes, nbytes_compressed=nbytes_new)
+                if output['format'] == 'zarr':
+                    fnames = write_step_stores(stack.project_dir, name, stack.channels(name),
+                                               output)
+                    reporter('zarr', step=name, stores=[str(fname) for fname in fnames])
+        except Exception as e:
+            status, error, exit_code = 'failed', repr(e), 1
+        finally:
+            if memory_governor is not None:
+                memory_governor.stop()
+                for name in group:
+                    memory_governor.write_log(stack.project_dir / 'process' / name)
+                if memory_governor.nthrottled:
+                    reporter('throttled', step=process_name,
+                             suspensions=memory_governor.nthrottled)
+        duration = time.perf_counter() - t0_step
+        timings.append({'step': process_name, 'status': status, 'duration': duration})
+        reporter('step_end', step=process_name, status=status, duration=duration, error=error)
+        if exit_code:
+            break
+    if not exit_code:
+        apply_retention([])
+
+    summary = {'project_dir': str(stack.project_dir), 'nproc': stack.params['nproc'],
+               'steps': timings, 'duration': time.perf_counter() - t0, 'exit_code': exit_code}
+    reporter('run_end', **summary)
+    if fname_output:
+        Path(fname_output).write_text(json.dumps(summary, indent=2), encoding='utf-8')
+    return exit_code
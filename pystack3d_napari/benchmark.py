@@ -0,0 +1,256 @@
+"""
+Headless benchmark of the processing steps on synthetic stacks (with known drift, stripes and
+background) for several 'nproc' values, to detect performance regressions between versions
+"""
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+from pathlib import Path
+from threading import Thread, Event
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
+import psutil
+from scipy.ndimage import shift as ndi_shift, gaussian_filter
+from tifffile import imwrite
+from tomlkit import dumps, parse
+
+from pystack3d_napari import PROCESS_NAMES
+from pystack3d_napari.batch import Reporter, create_stack, run_step
+
+PACKAGES = ['pystack3d', 'pystack3d_napari', 'napari', 'numpy', 'scipy', 'tifffile', 'pyvsnr']
+
+
+def get_bench_params(params=None):
+    """
+    Return the steps parameters of the 'params.toml' packaged with pystack3d (its 'assets'),
+    overwritten (step by step, key by key) by 'params'
+    """
+    from importlib.resources import files
+
+    fname = files('pystack3d') / 'assets' / 'params.toml'
+    defaults = parse(fname.read_text(encoding='utf-8')).unwrap()
+    params = params or {}
+    return {name: {**defaults.get(name, {}), **params.get(name, {})} for name in PROCESS_NAMES}
+
+
+def make_synthetic_stack(project_dir, shape=(50, 256, 256), dtype='uint16', nchannels=1,
+                         drift=(0.4, -0.3), stripes=0.05, bkg=0.2, noise=0.01, seed=0):
+    """
+    Write a synthetic stack of 'shape' (nz, ny, nx) in 'project_dir', with a 'drift'
+    (in pixels per slice along y and x), vertical stripes, a polynomial background and noise
+    ('stripes', 'bkg' and 'noise' amplitudes relative to the dtype range).
+    The slices are named according to the default 'resampling' policy (irregular z steps).
+    Return the channels names
+    """
+    nz, ny, nx = shape
+    dtype = np.dtype(dtype)
+    vmax = np.iinfo(dtype).max if dtype.kind in 'ui' else 1.
+    rng = np.random.default_rng(seed)
+    channels = ['.'] if nchannels == 1 else [f"channel_{k}" for k in range(nchannels)]
+
+    # texture larger than the slices to be shifted without border effects
+    margin = int(np.ceil(nz * max(map(abs, drift)))) + 2
+    texture = gaussian_filter(rng.random((ny + 2 * margin, nx + 2 * margin)), 3)
+    texture = (texture - texture.min()) / np.ptp(texture)
+    y, x = np.mgrid[:ny, :nx] / max(ny, nx)
+    background = bkg * (x + 0.5 * y ** 2 - 0.3 * x * y)
+    zpos = np.cumsum(rng.uniform(0.005, 0.015, nz))
+
+    for k_ch, channel in enumerate(channels):
+        dirname = Path(project_dir) / channel
+        dirname.mkdir(parents=True, exist_ok=True)
+        for k in range(nz):
+            img = ndi_shift(texture, (k * drift[0], k * drift[1]), order=1)
+            img = 0.5 * img[margin:margin + ny, margin:margin + nx] * (1 + 0.2 * k_ch)
+            img = img + background * (1 + k / nz)
+            img = img + stripes * rng.standard_normal((1, nx))
+            img = img + noise * rng.standard_normal((ny, nx))
+            img = np.clip(img / (1 + bkg + 4 * stripes), 0, 1) * vmax
+            imwrite(dirname / f"slice_{k:04d}_z={zpos[k]:.4f}um.tif", img.astype(dtype))
+    return channels
+
+
+class ProcessTreeSampler(Thread):
+    """ Peak RSS and I/O bytes of the current process and its children (workers) """
+
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stop_event = Event()
+        self.peak_rss = 0
+        self.io = {}  # cumulated (read, write) bytes per pid, as last seen
+        self.io0 = {}
+
+    def processes(self):
+        process = psutil.Process()
+        try:
+            return [process] + process.children(recursive=True)
+        except psutil.Error:
+            return [process]
+
+    def sample(self):
+        rss = 0
+        for process in self.processes():
+            try:
+                with process.oneshot():
+                    rss += process.memory_info().rss
+                    counters = process.io_counters()
+            except (psutil.Error, AttributeError):  # finished or 'io_counters' not supported
+                continue
+            # bytes requested by the process (including the page cache hits) where available
+            self.io[process.pid] = (getattr(counters, 'read_chars', counters.read_bytes),
+                                    getattr(counters, 'write_chars', counters.write_bytes))
+            self.io0.setdefault(process.pid, (0, 0) if process.pid != psutil.Process().pid
+                                else self.io[process.pid])
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.sample()
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        self.sample()
+        read = sum(self.io[pid][0] - self.io0[pid][0] for pid in self.io)
+        write = sum(self.io[pid][1] - self.io0[pid][1] for pid in self.io)
+        return {'peak_rss': self.peak_rss, 'read_bytes': read, 'write_bytes': write}
+
+
+def get_versions():
+    versions = {'python': platform.python_version()}
+    for package in PACKAGES:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def bench_step(stack, process_name, nslices):
+    """ Run 'process_name' and return its metrics """
+    sampler = ProcessTreeSampler()
+    sampler.start()
+    t0 = time.perf_counter()
+    try:
+        run_step(stack, process_name, Reporter(stream=io.StringIO()), stdout=io.StringIO())
+        error = None
+    except Exception as e:
+        error = repr(e)
+    wall_time = time.perf_counter() - t0
+    metrics = sampler.stop()
+    return {'step': process_name, 'nproc': stack.params['nproc'], 'wall_time': wall_time,
+            'slices/s': nslices / wall_time, **metrics, 'error': error}
+
+
+def run_benchmark(shape=(50, 256, 256), dtype='uint16', nchannels=1, nprocs=(1, 2, 4),
+                  process_steps=None, params=None, workdir=None, stream=None):
+    """
+    Run the 'process_steps' (default: all) on a synthetic stack for each 'nproc' of 'nprocs'.
+    'params' overwrites the packaged pystack3d parameters of the steps (see 'get_bench_params').
+    Return the results as a dictionary
+    """
+    stream = stream or sys.stdout
+    process_steps = process_steps or PROCESS_NAMES
+    bench_params = get_bench_params(params)
+    tmpdir = None
+    if workdir is None:
+        workdir = tmpdir = tempfile.mkdtemp(prefix="pystack3d_bench_")
+    project_dir = Path(workdir) / "synthetic"
+    shutil.rmtree(project_dir, ignore_errors=True)
+    channels = make_synthetic_stack(project_dir, shape=shape, dtype=dtype, nchannels=nchannels)
+    fname_toml = project_dir / "params.toml"
+
+    results = []
+    try:
+        for nproc in nprocs:
+            shutil.rmtree(project_dir / 'process', ignore_errors=True)
+            init_params = {'channels': channels, 'ind_min': 0, 'ind_max': 99999,
+                           'nproc': nproc, 'process_steps': process_steps, 'history': []}
+            fname_toml.write_text(dumps(init_params), encoding='utf-8')
+            stack = create_stack({**init_params, 'project_dir': str(project_dir),
+                                  **bench_params})
+            for process_name in process_steps:
+                result = bench_step(stack, process_name, shape[0] * len(channels))
+                results.append(result)
+                print(format_result(result), file=stream, flush=True)
+                if result['error']:
+                    break  # the following steps need this one outputs
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    config = {'shape': list(shape), 'dtype': str(np.dtype(dtype)), 'nchannels': nchannels,
+              'nprocs': list(nprocs), 'params': bench_params, 'cpu_count': psutil.cpu_count(),
+              'ram': psutil.virtual_memory().total, 'platform': platform.platform()}
+    return {'config': config, 'versions': get_versions(), 'time': time.time(),
+            'results': results}
+
+
+def format_result(result):
+    line = (f"{result['step']:28} nproc={result['nproc']:<3d} {result['wall_time']:8.2f} s "
+            f"{result['slices/s']:8.1f} sl/s  RSS {result['peak_rss'] / 2 ** 20:7.0f} MB  "
+            f"R/W {result['read_bytes'] / 2 ** 20:.0f}/{result['write_bytes'] / 2 ** 20:.0f} MB")
+    if result['error']:
+        line += f"  {result['error']}"
+    return line
+
+
+def compare(bench, baseline, tolerance=0.2):
+    """
+    Compare the wall times and peak RSS of 'bench' to the 'baseline' ones (same step and nproc).
+    Return the list of the regressions (relative increase greater than 'tolerance')
+    """
+    if bench['config']['shape'] != baseline['config']['shape'] \
+            or bench['config']['dtype'] != baseline['config']['dtype']:
+        raise ValueError("The benchmark and the baseline stacks differ")
+    ref = {(result['step'], result['nproc']): result for result in baseline['results']}
+    regressions = []
+    for result in bench['results']:
+        result_ref = ref.get((result['step'], result['nproc']))
+        if result_ref is None or result['error'] or result_ref['error']:
+            continue
+        for key in ['wall_time', 'peak_rss']:
+            ratio = result[key] / max(result_ref[key], 1e-9)
+            if ratio > 1 + tolerance:
+                regressions.append({'step': result['step'], 'nproc': result['nproc'],
+                                    'metric': key, 'value': result[key],
+                                    'baseline': result_ref[key], 'ratio': ratio})
+    return regressions
+
+
+def bench(shape=(50, 256, 256), dtype='uint16', nchannels=1, nprocs=(1, 2, 4),
+          process_steps=None, fname_params=None, fname_output=None, fname_baseline=None,
+          tolerance=0.2, workdir=None, stream=None):
+    """ Command line entry point. Return the exit code (1 if regressions are found) """
+    stream = stream or sys.stdout
+    params = None
+    if fname_params:
+        from pystack3d_napari.batch import load_params
+
+        params = {key: val for key, val in load_params(fname_params).items()
+                  if key in PROCESS_NAMES}
+    results = run_benchmark(shape=shape, dtype=dtype, nchannels=nchannels, nprocs=nprocs,
+                            process_steps=process_steps, params=params, workdir=workdir,
+                            stream=stream)
+    if fname_output:
+        Path(fname_output).write_text(json.dumps(results, indent=2, default=str),
+                                      encoding='utf-8')
+    exit_code = 1 if any(result['error'] for result in results['results']) else 0
+    if fname_baseline:
+        baseline = json.loads(Path(fname_baseline).read_text(encoding='utf-8'))
+        regressions = compare(results, baseline, tolerance=tolerance)
+        for reg in regressions:
+            print(f"REGRESSION {reg['step']} nproc={reg['nproc']} {reg['metric']}: "
+                  f"{reg['value']:.3g} vs {reg['baseline']:.3g} (x{reg['ratio']:.2f})",
+                  file=stream)
+        if len(regressions) == 0:
+            print(f"no regression (tolerance {100 * tolerance:.0f}%)", file=stream)
+        exit_code = exit_code or int(len(regressions) > 0)
+    return exit_code
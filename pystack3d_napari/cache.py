@@ -0,0 +1,74 @@
+"""
+Process-wide LRU cache of decoded slices
+"""
+import os
+from collections import OrderedDict
+from threading import Lock
+
+CACHE_BYTES = int(os.environ.get("PYSTACK3D_CACHE_MB", 1024)) * 2 ** 20
+
+
+class SliceCache:
+    """ Memory-budgeted LRU cache of decoded slices, keyed by (absolute file name, mtime) """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+        arr = loader()
+        arr.flags.writeable = False  # shared between layers
+        self.put(key, arr)
+        return arr
+
+    def put(self, key, arr):
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key).nbytes
+            if arr.nbytes > self.max_bytes:
+                return
+            self._data[key] = arr
+            self.nbytes += arr.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, arr = self._data.popitem(last=False)
+            self.nbytes -= arr.nbytes
+            self.evictions += 1
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def invalidate(self, dirname=None):
+        """ Remove the entries related to 'dirname' (and sub-folders) or all the entries """
+        prefix = None if dirname is None else os.path.join(os.path.abspath(dirname), '')
+        with self._lock:
+            for key in list(self._data):
+                if prefix is None or key[0].startswith(prefix):
+                    self.nbytes -= self._data.pop(key).nbytes
+
+    def stats(self):
+        with self._lock:
+            return {'nbytes': self.nbytes, 'max_bytes': self.max_bytes, 'nslices': len(self._data),
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+SLICE_CACHE = SliceCache()
@@ -0,0 +1,160 @@
+"""
+'pystack3d' command line: GUI launching (default) or headless processing
+"""
+import sys
+import argparse
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="pystack3d",
+                                     description="Pystack3D-napari GUI and headless processing")
+    subparsers = parser.add_subparsers(dest="command")
+
+    gui = subparsers.add_parser("gui", help="launch the napari GUI (default)")
+    gui.add_argument("project_dir", nargs="?", default=None)
+    gui.add_argument("--params", dest="fname_toml", default=None, help="TOML parameters file")
+
+    run = subparsers.add_parser("run", help="run the processing steps without GUI")
+    run.add_argument("fname_toml", help="TOML parameters file (as saved with 'SAVE PARAMS')")
+    run.add_argument("--project-dir", default=None, help="overwrite the TOML 'project_dir'")
+    run.add_argument("--steps", nargs="+", default=None,
+                     help="processing steps to run (default: the TOML 'process_steps')")
+    run.add_argument("--nproc", type=int, default=None, help="overwrite the TOML 'nproc'")
+    run.add_argument("--json", action="store_true", help="stream the events as json lines")
+    run.add_argument("--output", default=None, help="json file to save the timings in")
+    run.add_argument("--fuse", action="store_true",
+                     help="evaluate the consecutive slice-local steps in memory in a single pass")
+    run.add_argument("--checkpoints", nargs="+", default=(),
+                     help="fused steps whose images are saved anyway")
+    run.add_argument("--resume", action="store_true",
+                     help="process only the missing slices of the interrupted slice-local steps")
+    run.add_argument("--auto-nproc", action="store_true",
+                     help="choose the nproc of each step from a calibration on a few slices")
+    run.add_argument("--governor", action="store_true",
+                     help="refuse the steps exceeding the available RAM and suspend the "
+                          "workers under memory pressure")
+    run.add_argument("--retention", default="all", choices=["all", "consumed", "final", "last"],
+                     help="delete the images of the steps no longer needed by the following "
+                          "ones: once consumed, all but the final step or all but the last "
+                          "'--keep' steps")
+    run.add_argument("--keep", type=int, default=1, help="number of steps kept with "
+                                                         "'--retention last'")
+    run.add_argument("--concurrent-channels", action="store_true",
+                     help="process the slices of all the channels of the slice-local steps "
+                          "in a single pool of workers")
+    run.add_argument("--profile", action="store_true",
+                     help="profile each step (eval thread and workers) in "
+                          "'process/<step>/profile'")
+
+    queue = subparsers.add_parser("queue", help="run several projects within a CPU budget")
+    queue.add_argument("jobs", nargs="+",
+                       help="TOML files or project directories, optionally suffixed by "
+                            "':<priority>' (ex: params.toml:2)")
+    queue.add_argument("--cpus", type=int, default=None, help="global budget (default: all)")
+    queue.add_argument("--nproc-max", type=int, default=None, help="max. nproc per job")
+    queue.add_argument("--status-file", default=None, help="json file to save the status in")
+
+    bench = subparsers.add_parser("bench", help="benchmark the processing steps on a "
+                                                "synthetic stack")
+    bench.add_argument("--shape", type=int, nargs=3, default=(50, 256, 256),
+                       metavar=("NZ", "NY", "NX"), help="synthetic stack shape")
+    bench.add_argument("--dtype", default="uint16", help="synthetic stack dtype")
+    bench.add_argument("--channels", type=int, default=1, help="number of channels")
+    bench.add_argument("--nproc", type=int, nargs="+", default=(1, 2, 4),
+                       help="nproc values to benchmark")
+    bench.add_argument("--steps", nargs="+", default=None,
+                       help="processing steps to run (default: all)")
+    bench.add_argument("--params", dest="fname_params", default=None,
+                       help="TOML file overwriting the steps parameters (pystack3d "
+                            "packaged 'params.toml')")
+    bench.add_argument("--output", default=None, help="json file to save the results in")
+    bench.add_argument("--baseline", default=None, help="json results to compare with")
+    bench.add_argument("--tolerance", type=float, default=0.2,
+                       help="relative increase considered as a regression")
+    bench.add_argument("--workdir", default=None, help="directory of the synthetic stack "
+                                                       "(default: temporary)")
+
+    startup = subparsers.add_parser("startup", help="benchmark the GUI time-to-interactive "
+                                                    "(compared to napari alone)")
+    startup.add_argument("--runs", type=int, default=3, help="launches per measurement "
+                                                             "(median)")
+    startup.add_argument("--budget", type=float, default=None,
+                         help="time-to-interactive (s) not to exceed (exit code 1 otherwise)")
+    startup.add_argument("--output", default=None, help="json file to save the results in")
+
+    convert = subparsers.add_parser("convert", help="export the tiff slices directories to "
+                                                    "chunked zarr stores")
+    convert.add_argument("dirnames", nargs="+",
+                         help="directories searched (recursively) for tiff slices")
+    convert.add_argument("--chunks", type=int, nargs=3, default=(1, 1024, 1024),
+                         metavar=("CZ", "CY", "CX"), help="chunk shape")
+    convert.add_argument("--codec", default="blosc-zstd",
+                         help="blosc-zstd, blosc-lz4, zstd or none")
+    convert.add_argument("--level", type=int, default=5, help="compression level")
+
+    return parser
+
+
+def parse_job(arg):
+    """ Return (fname, priority) from 'fname' or 'fname:priority' """
+    fname, _, priority = arg.rpartition(":")
+    if fname and priority.isdigit():
+        return fname, int(priority)
+    return arg, 1
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    if args.command == "run":
+        from pystack3d_napari.batch import run
+
+        sys.exit(run(args.fname_toml, project_dir=args.project_dir, process_steps=args.steps,
+                     nproc=args.nproc, json_mode=args.json, fname_output=args.output,
+                     fuse=args.fuse, checkpoints=args.checkpoints, resume=args.resume,
+                     auto_nproc=args.auto_nproc, governor=args.governor,
+                     profile=args.profile, retention=args.retention, keep=args.keep,
+                     concurrent_channels=args.concurrent_channels))
+
+    if args.command == "queue":
+        from pystack3d_napari.jobs import JobQueue
+
+        job_queue = JobQueue(cpus=args.cpus)
+        for arg in args.jobs:
+            fname, priority = parse_job(arg)
+            job_queue.add(fname, priority=priority, nproc_max=args.nproc_max)
+        sys.exit(1 if job_queue.run(fname_status=args.status_file) else 0)
+
+    if args.command == "bench":
+        from pystack3d_napari.benchmark import bench
+
+        sys.exit(bench(shape=tuple(args.shape), dtype=args.dtype, nchannels=args.channels,
+                       nprocs=args.nproc, process_steps=args.steps,
+                       fname_params=args.fname_params, fname_output=args.output,
+                       fname_baseline=args.baseline, tolerance=args.tolerance,
+                       workdir=args.workdir))
+
+    if args.command == "startup":
+        from pystack3d_napari.startup import bench_startup
+
+        sys.exit(bench_startup(nruns=args.runs, budget=args.budget, fname_output=args.output))
+
+    if args.command == "convert":
+        from pystack3d_napari.store import convert
+
+        for dirname in args.dirnames:
+            for fname in convert(dirname, chunks=args.chunks, codec=args.codec,
+                                 level=args.level):
+                print(fname)
+        sys.exit(0)
+
+    from pystack3d_napari.main import launch
+
+    if args.command == "gui":
+        launch(project_dir=args.project_dir, fname_toml=args.fname_toml)
+    else:
+        launch()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Content-addressed fingerprints of the processing steps outputs, used to skip the steps whose
+parameters, input slices and upstream steps are unchanged since their last run
+"""
+import json
+import time
+import hashlib
+
+from pystack3d_napari.index import get_slice_index
+from pystack3d_napari.fusion import is_saved, is_released, get_input_step, FUSABLE_STEPS
+
+FINGERPRINT_NAME = ".fingerprint.json"
+RUN_NAME = ".run_{}.json"  # in 'process' (the step directories being erased at each run)
+
+
+def get_input_signature(project_dir, channels, ind_min=0, ind_max=99999):
+    """ Return a signature of the raw input slices (names, sizes and mtimes) """
+    sha = hashlib.sha256()
+    for channel in channels:
+        index = get_slice_index(project_dir / channel, update=False)
+        index.update(force=True)  # slices rewritten in place are not seen from the dir mtime
+        for fname, infos in zip(index.fnames(ind_min, ind_max), index.infos(ind_min, ind_max)):
+            sha.update(f"{channel}/{fname.name}:{infos['size']}:{infos['mtime']}\n".encode())
+    return sha.hexdigest()
+
+
+def get_upstream(history, process_name):
+    """ Return the step preceding 'process_name' in the history (None for the raw inputs) """
+    if process_name in history:
+        history = history[:history.index(process_name)]
+    return history[-1] if history else None
+
+
+def read_fingerprint(project_dir, process_name):
+    fname = project_dir / 'process' / process_name / FINGERPRINT_NAME
+    try:
+        return json.loads(fname.read_text(encoding='utf-8'))['fingerprint']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_fingerprint(project_dir, process_name, fingerprint):
+    fname = project_dir / 'process' / process_name / FINGERPRINT_NAME
+    data = {'fingerprint': fingerprint, 'time': time.time()}
+    fname.write_text(json.dumps(data), encoding='utf-8')
+
+
+def get_fingerprint(stack, process_name, params, upstream=None):
+    """
+    Return the fingerprint of the 'process_name' output, from its converted 'params', the
+    stack 'ind_min', 'ind_max' and 'channels' and the fingerprint of its upstream step
+    ('upstream', read from the upstream output if None) or of the raw input slices.
+    Return None if the upstream output has no fingerprint
+    """
+    project_dir = stack.project_dir
+    if upstream is None:
+        upstream_name = get_upstream(stack.params['history'], process_name)
+        if upstream_name is None:
+            upstream = get_input_signature(project_dir, stack.params['channels'],
+                                           stack.params['ind_min'], stack.params['ind_max'])
+        else:
+            upstream = read_fingerprint(project_dir, upstream_name)
+            if upstream is None:
+                return None
+    data = {'process_name': process_name, 'params': params,
+            'ind_min': stack.params['ind_min'], 'ind_max': stack.params['ind_max'],
+            'channels': list(stack.params['channels']), 'upstream': upstream}
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_fingerprints(stack, process_names, params_list):
+    """ Return the fingerprints of the successive 'process_names' to be run in a row """
+    fingerprints = []
+    for k, (process_name, params) in enumerate(zip(process_names, params_list)):
+        if k == 0:
+            fingerprint = get_fingerprint(stack, process_name, params)
+        elif fingerprints[-1] is None:
+            fingerprint = None
+        else:
+            fingerprint = get_fingerprint(stack, process_name, params, upstream=fingerprints[-1])
+        fingerprints.append(fingerprint)
+    return fingerprints
+
+
+def is_uptodate(stack, process_name, params):
+    """ Return True if the 'process_name' output exists and matches its current fingerprint """
+    history = stack.params['history']
+    if process_name not in history:
+        return False
+    if not is_saved(stack.project_dir, stack.params['channels'], process_name):
+        if process_name == history[-1]:
+            return False  # fused step whose images (not saved) feed no more steps
+        input_step = get_input_step(history, process_name)
+        if input_step is not None and is_released(stack.project_dir, input_step):
+            return False  # images neither saved nor computable from the released inputs
+    fingerprint = read_fingerprint(stack.project_dir, process_name)
+    return fingerprint is not None and fingerprint == get_fingerprint(stack, process_name, params)
+
+
+def write_run_marker(project_dir, process_names, fingerprints):
+    """ Record the run (in progress) of 'process_names' to allow its resumption """
+    dirname = project_dir / 'process'
+    dirname.mkdir(parents=True, exist_ok=True)
+    data = json.dumps({'process_steps': process_names, 'fingerprints': fingerprints,
+                       'time': time.time()})
+    for process_name in process_names:
+        (dirname / RUN_NAME.format(process_name)).write_text(data, encoding='utf-8')
+
+
+def remove_run_marker(project_dir, process_names):
+    for process_name in process_names:
+        (project_dir / 'process' / RUN_NAME.format(process_name)).unlink(missing_ok=True)
+
+
+def get_resumable_steps(stack, process_name, params):
+    """
+    Return the steps of the interrupted run of 'process_name' if their partial outputs can be
+    reused (slice-local steps with unchanged fingerprints), None otherwise.
+    'params' is a dictionary of the current converted parameters of each step
+    """
+    fname = stack.project_dir / 'process' / RUN_NAME.format(process_name)
+    try:
+        data = json.loads(fname.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+    process_names = data['process_steps']
+    input_step = get_input_step(stack.params['history'], process_names[0])
+    if input_step is not None and not is_saved(stack.project_dir, stack.params['channels'],
+                                               input_step):
+        return None  # input images released (or not saved) since the interruption
+    for process_name_ in process_names:
+        if process_name_ not in FUSABLE_STEPS or process_name_ in stack.params['history'] \
+                or not (stack.project_dir / 'process' / process_name_).is_dir():
+            return None
+    params_list = [params.get(process_name_, {}) for process_name_ in process_names]
+    fingerprints = get_fingerprints(stack, process_names, params_list)
+    if None in fingerprints or fingerprints != data['fingerprints']:
+        return None
+    return process_names
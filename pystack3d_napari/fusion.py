@@ -0,0 +1,400 @@
+"""
+Fused execution of consecutive slice-local processing steps: each slice goes through the
+whole chain in memory and only the last step results (and optional checkpoints) are saved
+"""
+import os
+import json
+import shutil
+from itertools import zip_longest
+from multiprocessing import Pool
+
+import numpy as np
+from tifffile import TiffFile
+
+from pystack3d_napari.utils import get_input_dirname
+from pystack3d_napari.reader import get_tiff_info, is_complete_tiff
+
+# steps that only need the current slice (and pre-calculated data) to be evaluated
+FUSABLE_STEPS = ['cropping', 'registration_transformation', 'destriping', 'cropping_final']
+
+FUSED_NAME = "fused.json"
+RELEASED_NAME = ".released.json"  # images deleted by a retention policy
+
+
+def get_fused_groups(process_steps, history=()):
+    """
+    Split 'process_steps' into groups of consecutive fusable steps (not yet processed).
+    The other steps are returned as single-step groups
+    """
+    groups = []
+    for process_step in process_steps:
+        fusable = process_step in FUSABLE_STEPS and process_step not in history
+        if fusable and groups and groups[-1][-1] in FUSABLE_STEPS \
+                and groups[-1][-1] not in history:
+            groups[-1].append(process_step)
+        else:
+            groups.append([process_step])
+    return groups
+
+
+def is_pool_run(process_steps, nchannels, resume=False, concurrent_channels=False):
+    """
+    Return True if the run of 'process_steps' is done by 'eval_fused' (independent workers of
+    a single pool), False if done by 'stack.eval()' (workers synchronised by barriers)
+    """
+    if len(process_steps) > 1 or resume:
+        return True
+    return concurrent_channels and nchannels > 1 and process_steps[0] in FUSABLE_STEPS
+
+
+def is_saved(project_dir, channels, process_name):
+    """
+    Return False if the 'process_name' images were not saved, being fused with next steps,
+    or were released by a retention policy
+    """
+    if is_released(project_dir, process_name):
+        return False
+    fname = project_dir / 'process' / process_name / channels[0] / 'outputs' / FUSED_NAME
+    try:
+        return json.loads(fname.read_text(encoding='utf-8'))['saved']
+    except (OSError, ValueError, KeyError):
+        return True
+
+
+def is_released(project_dir, process_name):
+    """ Return True if the 'process_name' images were deleted by a retention policy """
+    return (project_dir / 'process' / process_name / RELEASED_NAME).exists()
+
+
+def get_input_step(history, process_name):
+    """ Return the step providing the images processed by 'process_name' (None if raw) """
+    if process_name in history:
+        history = history[:history.index(process_name)]
+    history = [name for name in history if name != 'registration_calculation']  # no images
+    return history[-1] if history else None
+
+
+def get_restart_step(project_dir, channels, history, process_name):
+    """
+    Return the step to re-run (with the following ones) to re-evaluate 'process_name', i.e.
+    the first step of the chain providing its input images if they were not saved (fused
+    steps) or released
+    """
+    while True:
+        input_step = get_input_step(history, process_name)
+        if input_step is None or is_saved(project_dir, channels, input_step):
+            return process_name
+        process_name = input_step
+
+
+class Cropping:
+    """ Slice cropping, as done in 'pystack3d.cropping' """
+
+    def __init__(self, params, shape, **kwargs):
+        area = params.get('area')
+        if area is None:
+            self.inds = (0, shape[0], 0, shape[1])
+        else:
+            self.inds = (shape[0] - area[3], shape[0] - area[2], area[0], area[1])
+
+    def out_shape(self, shape):
+        imin, imax, jmin, jmax = self.inds
+        return np.broadcast_to(0, shape)[imin:imax, jmin:jmax].shape
+
+    def __call__(self, img, k):
+        imin, imax, jmin, jmax = self.inds
+        return img[imin:imax, jmin:jmax]
+
+
+class RegistrationTransformation:
+    """ Slice registration, as done in 'pystack3d.registration_transformation' """
+
+    def __init__(self, params, shape, project_dir=None, output_dirname=None, **kwargs):
+        from pystack3d.utils import cumdot
+        from pystack3d.registration_transformation import (constant_drift_removal,
+                                                           running_avg_removal,
+                                                           inner_rectangle)
+
+        fname = project_dir / 'process' / 'registration_calculation' / 'tmats.npy'
+        if not os.path.exists(fname):
+            raise IOError("File 'tmats.npy' not found")
+        tmats = np.load(fname)
+
+        if not params.get('subpixel', True):
+            for tmat in tmats:
+                tmat_transl = tmat[:, :, 2]
+                tmat_transl[np.abs(tmat_transl) < 1] = 0
+
+        tmats_cumul = cumdot(tmats)
+        if params.get('constant_drift') is not None:
+            tmats_cumul = constant_drift_removal(tmats_cumul, params['constant_drift'])
+        if params.get('box_size_averaging') is not None:
+            box_size = max(params['box_size_averaging'], 0)
+            tmats_cumul = running_avg_removal(tmats_cumul, box_size=box_size)
+
+        self.tmats_cumul = tmats_cumul
+        self.nb_blocks = params.get('nb_blocks')
+        self.mode = params.get('mode', 'constant')
+        self.inds = None
+        if params.get('cropping', False):
+            self.inds, img_crop = inner_rectangle(shape, tmats_cumul, self.nb_blocks)
+            if output_dirname is not None:
+                np.savetxt(output_dirname / 'outputs' / 'inds_crop.txt', self.inds)
+                np.save(output_dirname / 'outputs' / 'img_crop.npy', img_crop)
+        if output_dirname is not None:
+            np.save(output_dirname / 'outputs' / 'tmats_cumul.npy', tmats_cumul)
+
+    def out_shape(self, shape):
+        if self.inds is None:
+            return shape
+        imin, imax, jmin, jmax = self.inds
+        return imax - imin, jmax - jmin
+
+    def __call__(self, img, k):
+        from pystack3d.registration_transformation import img_transformation
+
+        img_res = img_transformation(img.astype(float), self.tmats_cumul[k],
+                                     nb_blocks=self.nb_blocks, mode=self.mode)
+        img_res = img_res.astype(img.dtype)
+        if self.inds is not None:
+            imin, imax, jmin, jmax = self.inds
+            img_res = img_res[imin:imax, jmin:jmax]
+        return img_res
+
+
+class Destriping:
+    """ Slice destriping, as done in 'pystack3d.destriping' """
+
+    def __init__(self, params, shape, **kwargs):
+        self.maxit = params.get('maxit', 100)
+        self.cvg_threshold = params.get('cvg_threshold', 0)
+        self.filters = params.get('filters')
+        self.wavelet_decomposition = params.get('wavelet_decomposition')
+
+    def out_shape(self, shape):
+        return shape
+
+    def __call__(self, img, k):
+        from pystack3d.destriping import destriping_from_wavelets
+        from pyvsnr import vsnr2d
+
+        if self.wavelet_decomposition is not None:
+            wdec = self.wavelet_decomposition
+            return destriping_from_wavelets(img, wavelet=wdec.get('wavelet'),
+                                            level=wdec.get('level'), sigma=wdec.get('sigma'))
+        return vsnr2d(img, self.filters, maxit=self.maxit, cvg_threshold=self.cvg_threshold,
+                      norm=False)
+
+
+KERNELS = {'cropping': Cropping,
+           'registration_transformation': RegistrationTransformation,
+           'destriping': Destriping,
+           'cropping_final': Cropping}
+
+
+def get_out_shape(process_steps, params, shape, project_dir):
+    """ Return the output slices shape of 'process_steps' (None if not known up front) """
+    for process_step in process_steps:
+        if process_step in KERNELS:
+            kernel = KERNELS[process_step](params[process_step], shape, project_dir=project_dir)
+            shape = tuple(kernel.out_shape(shape))
+        elif process_step in ['registration_calculation', 'resampling']:
+            return None  # no images or slices renamed and interpolated along z
+    return shape
+
+
+class FusedChain:
+    """ Successive slice-local kernels applied in memory """
+
+    def __init__(self, process_steps, params, shape, project_dir, output_dirnames):
+        self.process_steps = process_steps
+        self.kernels = []
+        self.shapes = []  # output slices shapes of each step
+        for process_step, output_dirname in zip(process_steps, output_dirnames):
+            kernel = KERNELS[process_step](params[process_step], shape,
+                                           project_dir=project_dir,
+                                           output_dirname=output_dirname)
+            self.kernels.append(kernel)
+            shape = tuple(kernel.out_shape(shape))
+            self.shapes.append(shape)
+        self.shape = shape
+
+    def __call__(self, img, k, fname=None, fnames_out=None):
+        """
+        Apply the kernels to the slice 'k', saving the results of the steps listed in
+        'fnames_out' (dict of output filenames). Return the stats of the saved steps
+        """
+        from pystack3d.utils import img_reformatting, save_tif
+
+        stats = {}
+        for process_step, kernel in zip(self.process_steps, self.kernels):
+            img_res = kernel(img, k)
+            img_res2 = img_reformatting(img_res, img.dtype)  # as stored by each step
+            if fnames_out and process_step in fnames_out:
+                save_tif(img_res2, fname, fnames_out[process_step])
+                stats[process_step] = [[img.min(), img.max(), img.mean()],
+                                       [img_res.min(), img_res.max(), img_res.mean()],
+                                       [img_res2.min(), img_res2.max(), img_res2.mean()]]
+            img = img_res2
+        return stats
+
+
+_CHAINS = None
+
+
+def worker_init(chains):
+    global _CHAINS
+    _CHAINS = chains
+
+
+def process_slice(args):
+    k, fname, fnames_out, ichannel = args
+    with TiffFile(fname) as tiff:
+        img = tiff.asarray()
+    return ichannel, k, _CHAINS[ichannel](img, k, fname=fname, fnames_out=fnames_out)
+
+
+def interleave(tasks_list):
+    """ Return the tasks of the channels in turn, for all of them to progress together """
+    return [task for tasks in zip_longest(*tasks_list) for task in tasks if task is not None]
+
+
+def eval_fused(stack, process_steps, nproc=None, checkpoints=(), pbar_init=False,
+               stop_event=None, resume=False, chunksize=None, concurrent_channels=False):
+    """
+    Evaluate the slice-local 'process_steps' in a single pass over the stack.
+
+    The slices increments are sent through 'stack.queue_incr' as done by 'stack.eval()', as
+    (channel index, value) tuples.
+    Only the last step and the 'checkpoints' steps have their images saved, the other
+    step directories keeping a 'fused.json' file in their 'outputs' folder.
+    With 'resume', the outputs of an interrupted run are kept and only the missing or
+    invalid (truncated, with unexpected shape or dtype) slices are processed.
+    'chunksize' is the number of slices per task sent to the workers (default: automatic).
+    With 'concurrent_channels', the slices of all the channels are processed by a single pool
+    of 'nproc' workers instead of a pool per channel, one channel after another.
+    """
+    from pystack3d.utils import dumps_params
+    from pystack3d.stack3d import plot
+
+    assert all(process_step in FUSABLE_STEPS for process_step in process_steps)
+    nproc = nproc or stack.params['nproc']
+    history = stack.params['history']
+    process_steps = [process_step for process_step in process_steps
+                     if process_step not in history]
+    if len(process_steps) == 0:
+        return
+    if resume:
+        saved_steps = [process_step for process_step in process_steps
+                       if is_saved(stack.project_dir, stack.params['channels'], process_step)]
+    else:
+        saved_steps = [process_steps[-1]] + [x for x in checkpoints if x in process_steps[:-1]]
+    input_dir = get_input_dirname(stack.project_dir, history, process_steps[0])
+
+    def prepare(ichannel, channel):
+        """ Return the chain, tasks and output dirnames of 'channel' (outputs cleaned up) """
+        print(" + ".join(process_steps), (channel != '.') * f"channel {channel}",
+              resume * "(resume)")
+
+        fnames = stack.fnames(input_dir / channel)
+        output_dirnames = []
+        for process_step in process_steps:
+            output_dirname = stack.process_dirname(process_step, channel)
+            os.makedirs(output_dirname, exist_ok=True)
+            if not resume:
+                shutil.rmtree(output_dirname)
+            os.makedirs(output_dirname / 'outputs', exist_ok=True)
+            infos = {'process_steps': process_steps, 'saved': process_step in saved_steps}
+            (output_dirname / 'outputs' / FUSED_NAME).write_text(json.dumps(infos),
+                                                                 encoding='utf-8')
+            output_dirnames.append(output_dirname)
+
+        shape, dtype, _ = get_tiff_info(fnames[0])
+        chain = FusedChain(process_steps, stack.params, shape,
+                           stack.project_dir, output_dirnames)
+        tasks = []
+        for k, fname in enumerate(fnames):
+            fnames_out = {process_step: output_dirname / fname.name
+                          for process_step, output_dirname in zip(process_steps,
+                                                                   output_dirnames)
+                          if process_step in saved_steps}
+            if resume and all(is_complete_tiff(fname_out,
+                                               chain.shapes[process_steps.index(process_step)],
+                                               dtype)
+                              for process_step, fname_out in fnames_out.items()):
+                continue
+            tasks.append((k, fname, fnames_out, ichannel))
+
+        # stats of the slices processed during a previous run are not known
+        stats = {process_step: np.full((len(fnames), 3, 3), np.nan if resume else 0.)
+                 for process_step in saved_steps}
+        return {'channel': channel, 'chain': chain, 'tasks': tasks, 'stats': stats,
+                'output_dirnames': output_dirnames}
+
+    def run(jobs):
+        """ Process the tasks of 'jobs' (per channel index) in a shared pool """
+        if pbar_init:
+            for ichannel, job in jobs.items():
+                stack.queue_incr.put((ichannel, len(job['tasks'])))
+
+        def finish(ichannel):
+            for _ in range(nproc):
+                stack.queue_incr.put((ichannel, 'finished'))
+
+        remaining = {ichannel: len(job['tasks']) for ichannel, job in jobs.items()}
+        for ichannel in [ichannel for ichannel, ntasks in remaining.items() if ntasks == 0]:
+            finish(ichannel)
+
+        def collect(results):
+            for ichannel, k, stats_k in results:
+                for process_step, vals in stats_k.items():
+                    jobs[ichannel]['stats'][process_step][k] = vals
+                stack.queue_incr.put((ichannel, 1))
+                remaining[ichannel] -= 1
+                if remaining[ichannel] == 0:
+                    finish(ichannel)  # (channel completion reported without waiting the others)
+                if stop_event is not None and stop_event.is_set():
+                    return False
+            return True
+
+        chains = {ichannel: job['chain'] for ichannel, job in jobs.items()}
+        tasks = interleave([job['tasks'] for job in jobs.values()])
+        if nproc == 1:
+            worker_init(chains)
+            completed = collect(map(process_slice, tasks))
+        else:
+            chunksize_ = chunksize or max(1, min(8, len(tasks) // (4 * nproc)))
+            with Pool(nproc, initializer=worker_init, initargs=(chains,)) as pool:
+                completed = collect(pool.imap_unordered(process_slice, tasks, chunksize_))
+                if not completed:
+                    pool.terminate()
+
+        for ichannel in [ichannel for ichannel, ntasks in remaining.items() if ntasks > 0]:
+            finish(ichannel)  # stopped
+        return completed
+
+    def finalize(job):
+        for process_step, output_dirname in zip(process_steps, job['output_dirnames']):
+            if process_step in saved_steps:
+                np.save(output_dirname / 'outputs' / 'stats.npy', job['stats'][process_step])
+            plot(process_step, output_dirname, input_dir / job['channel'],
+                 stack.params[process_step])
+
+    channels = stack.channels(process_steps[0])
+    if concurrent_channels:
+        jobs = {ichannel: prepare(ichannel, channel) for ichannel, channel in enumerate(channels)}
+        if not run(jobs):
+            return
+        for job in jobs.values():
+            finalize(job)
+    else:
+        for ichannel, channel in enumerate(channels):
+            job = prepare(ichannel, channel)
+            if not run({ichannel: job}):
+                return
+            finalize(job)
+
+    # 'history' parameter updating and saving
+    stack.params['history'] = stack.params['history'] + process_steps
+    if stack.fname_toml:
+        stack.fname_toml.write_text(dumps_params(stack.params), encoding='utf-8')
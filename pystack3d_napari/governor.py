@@ -0,0 +1,178 @@
+"""
+Memory-pressure governor of the processing steps: the workers are suspended (the most memory
+consuming first, one at a time) when the RAM usage crosses a threshold and resumed when
+headroom returns, after 'MAX_SUSPENSION' or when the other workers are idle (waiting for the
+suspended ones). The steps whose estimated footprint exceeds the available RAM are refused
+"""
+import os
+import json
+import time
+from threading import Thread, Event
+
+import psutil
+
+PAUSE_PERCENT = float(os.environ.get("PYSTACK3D_MEM_PAUSE", 90))
+RESUME_PERCENT = float(os.environ.get("PYSTACK3D_MEM_RESUME", 80))
+MAX_SUSPENSION = float(os.environ.get("PYSTACK3D_MEM_MAX_SUSPENSION", 30))  # (s)
+
+LOG_NAME = "governor.log"
+
+
+def check_admission(stack, process_name, params, nproc):
+    """ Return None if 'process_name' can be run with 'nproc' workers, the reason otherwise """
+    from pystack3d_napari.autotune import WORKER_OVERHEAD, calibrate
+    from pystack3d_napari.preview import get_input_stack
+
+    tiff_stack = get_input_stack(stack, process_name)
+    if tiff_stack is None:
+        return None
+    _, peak_bytes = calibrate(process_name, params, tiff_stack, project_dir=stack.project_dir,
+                              nslices=1)
+    worker_bytes = WORKER_OVERHEAD + peak_bytes
+    available = psutil.virtual_memory().available
+    if nproc * worker_bytes <= available:
+        return None
+    return (f"estimated footprint {nproc * worker_bytes / 2 ** 30:.1f} GB "
+            f"({nproc} x {worker_bytes / 2 ** 20:.0f} MB) > {available / 2 ** 30:.1f} GB "
+            f"available (nproc <= {int(available // worker_bytes)} would fit)")
+
+
+class MemoryGovernor(Thread):
+    """
+    Watch the RAM usage during a step run and suspend/resume the worker processes
+    (children of the current process) to keep it below 'pause_percent'.
+    The workers are suspended only with 'throttle', i.e. for the independent workers of the
+    'eval_fused' pool: the 'stack.eval()' workers meet at barriers, so suspending one of them
+    would freeze the whole step (the memory pressure is then only logged).
+    A worker suspended for more than 'max_suspension' seconds, or while all the other
+    workers are idle, is resumed and no longer suspended during the run
+    """
+
+    def __init__(self, pause_percent=PAUSE_PERCENT, resume_percent=RESUME_PERCENT,
+                 interval=0.5, min_running=1, stop_event=None, throttle=True,
+                 max_suspension=MAX_SUSPENSION):
+        super().__init__(daemon=True)
+        self.pause_percent = pause_percent
+        self.resume_percent = min(resume_percent, pause_percent)
+        self.interval = interval
+        self.min_running = min_running
+        self.stop_event = stop_event  # external stop (the suspended workers are resumed)
+        self.throttle = throttle
+        self.max_suspension = max_suspension
+        self.finished = Event()
+        self.suspended = []
+        self.suspension_times = {}  # (pid: suspension time)
+        self.cpu_times = {}  # (pid: cpu time at the previous step) to detect idle workers
+        self.exempted = set()  # pids of the workers resumed by force
+        self.pressure = False
+        self.events = []
+
+    def log(self, event, process=None, **kwargs):
+        mem = psutil.virtual_memory()
+        infos = {'time': time.time(), 'event': event, 'ram_percent': mem.percent,
+                 'ram_available': mem.available, **kwargs}
+        if process is not None:
+            infos['pid'] = process.pid
+        self.events.append(infos)
+
+    @staticmethod
+    def workers():
+        """ Return the worker processes with their RSS """
+        workers = []
+        for process in psutil.Process().children(recursive=True):
+            try:
+                if 'resource_tracker' in " ".join(process.cmdline()):
+                    continue
+                workers.append((process, process.memory_info().rss))
+            except psutil.Error:
+                continue
+        return workers
+
+    def suspend(self, process, rss):
+        try:
+            process.suspend()
+        except psutil.Error:
+            return
+        self.suspended.append(process)
+        self.suspension_times[process.pid] = time.monotonic()
+        self.log('suspend', process, rss=rss)
+
+    def resume(self, process, reason=None):
+        try:
+            process.resume()
+        except psutil.Error:
+            pass
+        self.suspended.remove(process)
+        self.suspension_times.pop(process.pid, None)
+        if reason is None:
+            self.log('resume', process)
+        else:
+            self.exempted.add(process.pid)
+            self.log('resume', process, forced=reason)
+
+    def resume_all(self):
+        for process in list(self.suspended):
+            self.resume(process)
+
+    def is_idle(self, process):
+        """ Return True if 'process' did not consume CPU since the previous call """
+        try:
+            times = process.cpu_times()
+        except psutil.Error:
+            return True
+        cpu_time = times.user + times.system
+        cpu_time_prev = self.cpu_times.get(process.pid)
+        self.cpu_times[process.pid] = cpu_time
+        return cpu_time_prev is not None and cpu_time <= cpu_time_prev
+
+    def step(self):
+        percent = psutil.virtual_memory().percent
+        self.suspended = [process for process in self.suspended if process.is_running()]
+        running = [(process, rss) for process, rss in self.workers()
+                   if process not in self.suspended]
+        idle = [self.is_idle(process) for process, _ in running]  # (cpu times updated)
+        if percent >= self.pause_percent and not self.pressure:
+            self.log('pressure', throttle=self.throttle)
+        self.pressure = percent >= self.pause_percent
+
+        if self.suspended:
+            process = self.suspended[0]
+            duration = time.monotonic() - self.suspension_times[process.pid]
+            if duration > self.max_suspension:
+                self.resume(process, reason='max_suspension')
+                return
+            if all(idle):  # (no running worker) waiting for the suspended ones
+                self.resume(process, reason='idle')
+                return
+        candidates = [(process, rss) for process, rss in running
+                      if process.pid not in self.exempted]
+        if self.throttle and self.pressure and len(running) > self.min_running and candidates:
+            self.suspend(*max(candidates, key=lambda x: x[1]))
+        elif percent <= self.resume_percent and self.suspended:
+            self.resume(self.suspended[0])
+
+    def run(self):
+        self.log('start', pause_percent=self.pause_percent, resume_percent=self.resume_percent)
+        while not self.finished.wait(self.interval):
+            if self.stop_event is not None and self.stop_event.is_set():
+                break
+            self.step()
+        self.resume_all()
+
+    def stop(self):
+        self.finished.set()
+        if self.is_alive():
+            self.join()
+        self.resume_all()
+        self.log('stop')
+
+    @property
+    def nthrottled(self):
+        return sum(event['event'] == 'suspend' for event in self.events)
+
+    def write_log(self, dirname):
+        """ Append the events to the 'dirname' step log """
+        if dirname.is_dir():
+            with open(dirname / LOG_NAME, 'a', encoding='utf-8') as fid:
+                for event in self.events:
+                    fid.write(json.dumps(event) + "\n")
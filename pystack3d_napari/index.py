@@ -0,0 +1,154 @@
+"""
+Persistent index of the tiff slices located in a channel directory
+"""
+import os
+import json
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+from pystack3d_napari.reader import get_tiff_info
+from pystack3d_napari.utils import hsorted
+
+INDEX_NAME = ".pystack3d_index.json"
+INDEX_VERSION = 3
+
+_INDEXES = {}
+_INDEXES_LOCK = Lock()
+
+
+class SliceIndex:
+    """
+    Sorted listing of the '*.tif' files of a directory with their shape, dtype and mtime,
+    saved as a sidecar json file and updated incrementally from a 'scandir' diff
+    """
+
+    def __init__(self, dirname):
+        self.dirname = Path(dirname)
+        self.fname = self.dirname / INDEX_NAME
+        self.signature = None
+        self.names = []
+        self.entries = {}
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        try:
+            data = json.loads(self.fname.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return
+        if data.get('version') == INDEX_VERSION:
+            self.signature = data['signature']
+            self.names = data['names']
+            self.entries = data['entries']
+
+    def save(self):
+        """ Write the index, the sidecar file being only created for a directory with slices """
+        is_new = not self.fname.exists()
+        if is_new and len(self.names) == 0:
+            return
+        try:
+            if is_new:
+                # the file creation changes the directory mtime, the further writings being
+                # done in place
+                self.fname.touch()
+                self.signature[0] = os.stat(self.dirname).st_mtime_ns
+            data = {'version': INDEX_VERSION, 'signature': self.signature,
+                    'names': self.names, 'entries': self.entries}
+            self.fname.write_text(json.dumps(data), encoding='utf-8')
+        except OSError:
+            pass  # read-only directory: the index is kept in memory only
+
+    def scan(self):
+        """ Return the directory mtime and the stats of its '*.tif' files """
+        dir_mtime = os.stat(self.dirname).st_mtime_ns
+        stats = {}
+        with os.scandir(self.dirname) as it:
+            for entry in it:
+                try:
+                    if entry.name.endswith('.tif') and entry.is_file():
+                        stats[entry.name] = entry.stat()
+                except OSError:
+                    continue  # file removed in the meantime
+        return dir_mtime, stats
+
+    @staticmethod
+    def get_signature(dir_mtime, stats):
+        """
+        Return a cheap signature of the directory content: its mtime (files added or removed),
+        the number of slices and their max. mtime (slices rewritten in place)
+        """
+        return [dir_mtime, len(stats), max((stat.st_mtime_ns for stat in stats.values()),
+                                           default=0)]
+
+    def is_uptodate(self, signature):
+        return signature == self.signature
+
+    def update(self, force=False):
+        """ Synchronize the index with the directory content. Return True if changed """
+        with self.lock:
+            try:
+                dir_mtime, stats = self.scan()
+            except OSError:
+                changed = len(self.names) > 0
+                self.signature, self.names, self.entries = None, [], {}
+                return changed
+            signature = self.get_signature(dir_mtime, stats)
+            if not force and self.is_uptodate(signature):
+                return False
+
+            entries = {}
+            for name, stat in stats.items():
+                infos = self.entries.get(name)
+                if infos is None or infos['mtime'] != stat.st_mtime_ns \
+                        or infos['size'] != stat.st_size:
+                    infos = self.probe(self.dirname / name, stat)
+                if infos is not None:
+                    entries[name] = infos
+
+            if set(entries) != set(self.entries):
+                self.names = hsorted(entries)
+            changed = entries != self.entries
+            self.entries = entries
+            self.signature = signature
+            self.save()
+            return changed
+
+    @staticmethod
+    def probe(fname, stat):
+        try:
+            shape, dtype, offset = get_tiff_info(fname)
+        except Exception:
+            return None  # file being written or corrupted
+        if offset is not None and offset + int(np.prod(shape)) * dtype.itemsize > stat.st_size:
+            offset = None  # truncated file
+        return {'shape': list(shape), 'dtype': dtype.str, 'offset': offset,
+                'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+    def __len__(self):
+        return len(self.names)
+
+    def fnames(self, ind_min=0, ind_max=None):
+        names = self.names[ind_min:None if ind_max is None else ind_max + 1]
+        return [self.dirname / name for name in names]
+
+    def infos(self, ind_min=0, ind_max=None):
+        names = self.names[ind_min:None if ind_max is None else ind_max + 1]
+        return [self.entries[name] for name in names]
+
+    def shape_dtype(self, ind=0):
+        infos = self.entries[self.names[ind]]
+        return tuple(infos['shape']), np.dtype(infos['dtype'])
+
+
+def get_slice_index(dirname, update=True):
+    """ Return the (process-wide shared) slice index related to 'dirname' """
+    key = os.path.abspath(dirname)
+    with _INDEXES_LOCK:
+        if key not in _INDEXES:
+            _INDEXES[key] = SliceIndex(dirname)
+        index = _INDEXES[key]
+    if update:
+        index.update()
+    return index
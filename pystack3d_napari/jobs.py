@@ -0,0 +1,242 @@
+"""
+Queue of several projects processed concurrently within a global CPU budget
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+from pathlib import Path
+from threading import Thread, Lock
+
+from pystack3d_napari.batch import load_params
+from pystack3d_napari.utils import format_duration
+
+LOG_NAME = "job.log"  # stderr of the steps subprocesses, in 'project_dir/process'
+LOG_TAIL = 10  # number of stderr lines reported with a failure
+
+
+class Job:
+    """ Project processing, executed step by step in 'pystack3d run' subprocesses """
+
+    def __init__(self, fname_toml, priority=1, nproc_max=None):
+        self.fname_toml = Path(fname_toml)
+        self.project_dir = self.fname_toml
+        self.name = self.fname_toml.stem if self.fname_toml.suffix else self.fname_toml.name
+        self.priority = 1
+        self.nproc_max = nproc_max or os.cpu_count()
+        self.steps = []
+        self.nsteps = 0
+        self.status = 'pending'
+        self.step = None
+        self.nproc = 0
+        self.percent = 0
+        self.eta = None
+        self.cpu_time = 0.  # allocated cores x seconds, used for fair sharing
+        self.durations = {}
+        self.error = None
+        self.process = None
+        self._t0 = None
+        self._log = None
+        self._log_offset = 0
+        try:
+            self.load(priority, nproc_max)
+        except Exception as e:  # (missing or invalid .toml, none or several in the project)
+            self.status = 'failed'
+            self.error = str(e)
+            return
+        if self.nsteps == 0:
+            self.status = 'completed'
+
+    def load(self, priority, nproc_max):
+        fname_toml = self.fname_toml
+        if fname_toml.is_dir():  # project directory with a single .toml file inside
+            fnames = list(fname_toml.glob("*.toml"))
+            if len(fnames) != 1:
+                raise IOError(f"{len(fnames)} '.toml' files found in {fname_toml}")
+            fname_toml = fnames[0]
+        params = load_params(fname_toml)
+
+        self.fname_toml = fname_toml
+        self.project_dir = Path(params.get('project_dir') or fname_toml.parent)
+        self.name = self.project_dir.name
+        self.priority = max(int(priority), 1)
+        self.nproc_max = nproc_max or params.get('nproc_max') or os.cpu_count()
+        self.steps = list(params.get('process_steps') or [])
+        self.nsteps = len(self.steps)
+
+    @property
+    def is_done(self):
+        return self.status in ['completed', 'failed']
+
+    @property
+    def is_running(self):
+        return self.process is not None
+
+    @property
+    def fname_log(self):
+        return self.project_dir / 'process' / LOG_NAME
+
+    def get_command(self, nproc):
+        return [sys.executable, "-m", "pystack3d_napari.cli", "run", str(self.fname_toml),
+                "--project-dir", str(self.project_dir), "--steps", self.step,
+                "--nproc", str(nproc), "--json"]
+
+    def start_step(self, nproc):
+        self.step = self.steps.pop(0)
+        self.nproc = nproc
+        self.percent = 0
+        self.eta = None
+        self.status = 'running'
+        self._t0 = time.perf_counter()
+        self.fname_log.parent.mkdir(parents=True, exist_ok=True)
+        self._log = open(self.fname_log, 'a', encoding='utf-8')
+        self._log.write(f"--- {time.strftime('%Y-%m-%d %H:%M:%S')} {self.step} "
+                        f"(nproc={nproc}) ---\n")
+        self._log.flush()
+        self._log_offset = self._log.tell()
+        self.process = subprocess.Popen(self.get_command(nproc), stdout=subprocess.PIPE,
+                                        stderr=self._log, text=True, bufsize=1)
+        Thread(target=self.read_events, args=(self.process,), daemon=True).start()
+
+    def close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def get_log_tail(self, nlines=LOG_TAIL):
+        """ Return the last lines written in the log by the current step subprocess """
+        try:
+            with open(self.fname_log, 'r', encoding='utf-8', errors='replace') as fid:
+                fid.seek(self._log_offset)
+                lines = [line.rstrip() for line in fid if line.strip()]
+        except OSError:
+            return ""
+        return "\n".join(lines[-nlines:])
+
+    def read_events(self, process):
+        for line in process.stdout:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event['event'] == 'progress':
+                self.percent, self.eta = event['percent'], event['eta']
+            elif event['event'] == 'step_end' and event['error']:
+                self.error = event['error']
+            elif event['event'] == 'error':
+                self.error = event['msg']
+
+    def poll(self):
+        """ Update the job once its current step subprocess is finished. Return True if so """
+        if self.process is None or self.process.poll() is None:
+            return False
+        duration = time.perf_counter() - self._t0
+        self.cpu_time += self.nproc * duration
+        self.durations[self.step] = duration
+        self.close_log()
+        if self.process.returncode != 0:
+            self.status = 'failed'
+            self.error = self.error or f"exit code {self.process.returncode}"
+            tail = self.get_log_tail()
+            if tail:
+                self.error += f"\n{tail}\n(see '{self.fname_log}')"
+        elif len(self.steps) == 0:
+            self.status = 'completed'
+        else:
+            self.status = 'waiting'
+        self.process = None
+        self.nproc = 0
+        return True
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        self.close_log()
+        self.status = 'failed'
+        self.error = 'stopped'
+
+    def as_dict(self):
+        return {'name': self.name, 'project_dir': str(self.project_dir),
+                'priority': self.priority, 'status': self.status, 'step': self.step,
+                'steps_done': self.nsteps - len(self.steps) - self.is_running,
+                'nsteps': self.nsteps, 'nproc': self.nproc, 'percent': self.percent,
+                'eta': self.eta, 'durations': self.durations, 'error': self.error}
+
+
+class JobQueue:
+    """
+    Scheduler sharing a global worker budget between the jobs according to their priorities.
+    The cores are re-allocated at each step boundary, the jobs that received the less
+    cores x seconds being served first (fair sharing).
+    """
+
+    def __init__(self, cpus=None, poll_interval=0.5):
+        self.cpus = cpus or os.cpu_count()
+        self.poll_interval = poll_interval
+        self.jobs = []
+        self.lock = Lock()
+
+    def add(self, fname_toml, priority=1, nproc_max=None):
+        job = Job(fname_toml, priority=priority, nproc_max=nproc_max)
+        with self.lock:
+            self.jobs.append(job)
+        return job
+
+    def free_cpus(self):
+        return self.cpus - sum(job.nproc for job in self.jobs if job.is_running)
+
+    def schedule(self):
+        """ Start the next step of the idle jobs within the free cpus budget """
+        active = [job for job in self.jobs if not job.is_done]
+        idle = [job for job in active if not job.is_running and len(job.steps) > 0]
+        idle.sort(key=lambda job: (-job.priority, job.cpu_time / job.priority))
+        weights = sum(job.priority for job in active)
+        for job in idle:
+            free = self.free_cpus()
+            if free < 1:
+                break
+            share = max(int(self.cpus * job.priority / weights), 1)
+            job.start_step(nproc=min(share, free, job.nproc_max))
+
+    def status(self):
+        with self.lock:
+            return [job.as_dict() for job in self.jobs]
+
+    def format_status(self):
+        lines = [f"{'job':20} {'prio':>4} {'status':10} {'step':28} {'nproc':>5} {'%':>4} ETA"]
+        for job in self.status():
+            step = f"{job['step'] or '-'} ({job['steps_done']}/{job['nsteps']})"
+            lines.append(f"{job['name'][:20]:20} {job['priority']:4d} {job['status']:10} "
+                         f"{step[:28]:28} {job['nproc']:5d} {job['percent']:4d} "
+                         f"{format_duration(job['eta'])}")
+        lines += [f"{job['name']}: {job['error']}" for job in self.status() if job['error']]
+        return "\n".join(lines)
+
+    def run(self, stream=None, fname_status=None, status_interval=10.):
+        """ Process all the jobs. Return the number of failed jobs """
+        stream = stream or sys.stdout
+        last_status = 0.
+        try:
+            while True:
+                with self.lock:
+                    changed = any([job.poll() for job in self.jobs])
+                    self.schedule()
+                    done = all(job.is_done for job in self.jobs)
+                now = time.perf_counter()
+                if changed or done or now - last_status > status_interval:
+                    last_status = now
+                    print(self.format_status() + "\n", file=stream, flush=True)
+                    if fname_status:
+                        Path(fname_status).write_text(json.dumps(self.status(), indent=2),
+                                                      encoding='utf-8')
+                if done:
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            for job in self.jobs:
+                if job.is_running:
+                    job.stop()
+        return sum(job.status == 'failed' for job in self.jobs)
@@ -2,26 +2,27 @@
 Main functions dedicated to pystack3D processing
 """
 import os
+import time
 from pathlib import Path
 import ast
 
 import napari
 from magicgui import magic_factory, magicgui
-from qtpy.QtWidgets import QWidget, QHBoxLayout, QPushButton, QLabel, QCheckBox, QMessageBox
+from qtpy.QtWidgets import (QWidget, QHBoxLayout, QPushButton, QLabel, QCheckBox, QMessageBox,
+                            QComboBox, QSpinBox)
 from qtpy.QtGui import QFont
-from qtpy.QtCore import QObject, Signal
+from qtpy.QtCore import Qt, QObject, Signal
 
-from pystack3d import Stack3d
-from pystack3d_napari import FILTER_DEFAULT
+from pystack3d_napari import FILTER_DEFAULT, PROCESS_NAMES, PREVIEW_STEPS, RETENTION_POLICIES
+from pystack3d_napari.governor import PAUSE_PERCENT, RESUME_PERCENT, LOG_NAME
+from pystack3d_napari.utils import format_duration, convert_params
 from pystack3d_napari.widgets import (DragDropContainer, CollapsibleSection, FilterTableWidget,
-                                      CroppingPreview, CompactLayouts, DiskRAMUsageWidget,
-                                      SelectProjectDirWidget, LoadParamsWidget, SaveParamsWidget,
+                                      CroppingPreview, LivePreview, ProfilePanel, OutputSettings,
+                                      CompactLayouts,
+                                      DiskRAMUsageWidget, Volume3DWidget, SelectProjectDirWidget,
+                                      LoadParamsWidget, SaveParamsWidget,
                                       get_napari_icon, add_layers, change_ndisplay, remove_layers)
 
-PROCESS_NAMES = ['cropping', 'bkg_removal', 'intensity_rescaling', 'intensity_rescaling_area',
-                 'registration_calculation', 'registration_transformation',
-                 'destriping', 'resampling', 'cropping_final']
-
 
 class PyStack3dNapari(QObject):
     finish_signal = Signal()
@@ -35,9 +36,21 @@ class PyStack3dNapari(QObject):
         self.process_container = None
         self.process_names = PROCESS_NAMES
         self.nproc = 1
+        self.auto_nproc = False
+        self.multiscale = False
+        self.fuse = False
+        self.concurrent_channels = False
+        self.governor = False
+        self.retention = 'all'
+        self.retention_keep = 2
+        self.live_layers = False
+        self._released_bytes = 0
+        self._resume = False
         self._stop_all = False
         self.current_section = None
         self.active_sections = []
+        self._run_all_nsteps = 0
+        self._run_all_t0 = None
 
     def on_init(self, widget):
         widget.native.setFont(QFont("Segoe UI", 10))
@@ -66,19 +79,80 @@ class PyStack3dNapari(QObject):
         qt_field.layout().replaceWidget(push_button, sel_proj_dir)
         push_button.deleteLater()
 
+        # sections content built at first expansion (or parameters access)
         self.process_container = DragDropContainer(self.process_names)
         for process_name in self.process_names:
-            process_widget = eval(f"{process_name}_widget()")
-            process_widget._parent = self
-            section = CollapsibleSection(self, process_name, process_widget)
-            section.add_widget(process_widget.native)
+            panels = [LivePreview] if process_name in PREVIEW_STEPS else []
+            if process_name != "registration_calculation":  # (no images)
+                panels.append(OutputSettings)
+            panels.append(ProfilePanel)
+            section = CollapsibleSection(self, process_name, eval(f"{process_name}_widget"),
+                                         panels=panels)
             self.process_container.add_widget(section)
-        self.process_container.set_cropping_area()
         self.layout.addWidget(self.process_container)
 
         self.run_all_widget = self.create_run_all_widget()
+        self.run_all_status = QLabel("")
+        self.run_all_widget.native.layout().addWidget(self.run_all_status)
         self.layout.addWidget(self.run_all_widget.native)
 
+        cbox_fuse = QCheckBox(" Fuse slice-local steps")
+        cbox_fuse.setToolTip("With RUN ALL, evaluate the consecutive slice-local steps "
+                             "(cropping, registration_transformation, destriping, "
+                             "cropping_final)\nin memory in a single pass, only the last one "
+                             "saving its images")
+        cbox_fuse.setChecked(self.fuse)
+        cbox_fuse.stateChanged.connect(lambda state: setattr(self, 'fuse', state == Qt.Checked))
+        self.run_all_widget.native.layout().addWidget(cbox_fuse)
+
+        cbox_channels = QCheckBox(" Concurrent channels")
+        cbox_channels.setToolTip("Process the slices of all the channels in a single pool of "
+                                 "'nproc' workers\n(slice-local steps only, the other ones "
+                                 "processing the channels one after another)")
+        cbox_channels.setChecked(self.concurrent_channels)
+        cbox_channels.stateChanged.connect(
+            lambda state: setattr(self, 'concurrent_channels', state == Qt.Checked))
+        self.run_all_widget.native.layout().addWidget(cbox_channels)
+
+        cbox_governor = QCheckBox(" Memory governor")
+        cbox_governor.setToolTip(f"Refuse to start a step whose estimated footprint (calibration "
+                                 f"on a slice, in a separate process)\nexceeds the available "
+                                 f"RAM. The workers of the fused, resumed or concurrent-channels "
+                                 f"runs are\nsuspended when the RAM usage exceeds "
+                                 f"{PAUSE_PERCENT:.0f}% (resumed below {RESUME_PERCENT:.0f}%); "
+                                 f"the other runs (synchronised\nworkers) are only checked at "
+                                 f"admission, the memory pressure being logged in "
+                                 f"'process/<step>/{LOG_NAME}'")
+        cbox_governor.setChecked(self.governor)
+        cbox_governor.stateChanged.connect(
+            lambda state: setattr(self, 'governor', state == Qt.Checked))
+        self.run_all_widget.native.layout().addWidget(cbox_governor)
+
+        retention_widget = QWidget()
+        retention_layout = QHBoxLayout(retention_widget)
+        retention_layout.setContentsMargins(0, 0, 0, 0)
+        combo_retention = QComboBox()
+        combo_retention.addItems(list(RETENTION_POLICIES.values()))
+        combo_retention.setToolTip("With RUN ALL, delete the images of the steps no longer "
+                                   "needed by the following ones\n(the steps are kept in the "
+                                   "history with their 'outputs' and zarr stores)")
+        spin_keep = QSpinBox()
+        spin_keep.setRange(1, len(self.process_names))
+        spin_keep.setValue(self.retention_keep)
+        spin_keep.setToolTip("N")
+        spin_keep.setEnabled(False)
+        spin_keep.valueChanged.connect(lambda value: setattr(self, 'retention_keep', value))
+
+        def set_retention(index):
+            self.retention = list(RETENTION_POLICIES)[index]
+            spin_keep.setEnabled(self.retention == 'last')
+
+        combo_retention.currentIndexChanged.connect(set_retention)
+        retention_layout.addWidget(QLabel("Retention"))
+        retention_layout.addWidget(combo_retention)
+        retention_layout.addWidget(spin_keep)
+        self.run_all_widget.native.layout().addWidget(retention_widget)
+
         stop_all_widget = self.create_stop_all_widget()
         self.layout.addWidget(stop_all_widget.native)
 
@@ -96,22 +170,51 @@ class PyStack3dNapari(QObject):
         load_save_widget.setLayout(hlayout)
         self.layout.addWidget(load_save_widget)
 
+        cbox_multiscale = QCheckBox(" Enable multiscale pyramids")
+        cbox_multiscale.setToolTip("Display large slices from 2x-binned levels "
+                                   "built in background (in '.pyramid' sub-folders)")
+        cbox_multiscale.setChecked(self.multiscale)
+        cbox_multiscale.stateChanged.connect(
+            lambda state: setattr(self, 'multiscale', state == Qt.Checked))
+        self.layout.addWidget(cbox_multiscale)
+
+        cbox_live = QCheckBox(" Live result layers")
+        cbox_live.setToolTip("Open the result layers when a step starts, the slices being "
+                             "displayed as soon as they are written\n(blank placeholders for "
+                             "the slices not processed yet)")
+        cbox_live.stateChanged.connect(
+            lambda state: setattr(self, 'live_layers', state == Qt.Checked))
+        self.layout.addWidget(cbox_live)
+
         cbox_visu3D = QCheckBox(" Enable 3D visualisation")
         cbox_visu3D.setChecked(False)
         cbox_visu3D.stateChanged.connect(change_ndisplay)
         self.layout.addWidget(cbox_visu3D)
 
+        volume_widget = Volume3DWidget()
+        cbox_visu3D.stateChanged.connect(volume_widget.set_enabled)
+        self.layout.addWidget(volume_widget)
+
         usage_widget = DiskRAMUsageWidget()
         self.layout.addWidget(usage_widget)
 
         widgets = self.process_container.widgets()
         widgets += [self.init_widget.native,
                     self.run_all_widget.native, stop_all_widget.native,
-                    load_save_widget, usage_widget]
+                    load_save_widget, volume_widget, usage_widget]
         CompactLayouts.apply(widgets)
 
         self.init_widget.nproc.changed.connect(lambda val: setattr(self, 'nproc', val))
 
+        cbox_auto_nproc = QCheckBox("auto")
+        cbox_auto_nproc.setToolTip("Choose nproc at each step run from a calibration on a few "
+                                   "slices\n(memory and time per worker), the available RAM "
+                                   "and the cores")
+        cbox_auto_nproc.setChecked(self.auto_nproc)
+        cbox_auto_nproc.stateChanged.connect(
+            lambda state: setattr(self, 'auto_nproc', state == Qt.Checked))
+        self.init_widget.nproc.native.parentWidget().layout().addWidget(cbox_auto_nproc)
+
         if self.fname_toml:
             load_params_widget.load_params(self.fname_toml)
 
@@ -124,7 +227,8 @@ class PyStack3dNapari(QObject):
                        channels=self.stack.params['channels'],
                        ind_min=self.stack.params['ind_min'],
                        ind_max=self.stack.params['ind_max'],
-                       is_init=True)
+                       is_init=True,
+                       multiscale=self.multiscale)
 
     def create_widgets(self):
         @magic_factory(widget_init=self.on_init,
@@ -157,9 +261,14 @@ class PyStack3dNapari(QObject):
             if self.stack is not None:
                 self.reinit()
 
+            from pystack3d_napari.monitor import MONITOR
+
             self.project_dir = project_dir
+            MONITOR.set_project_dir(project_dir)
             channels = ['.'] if channels == '' else ast.literal_eval(channels)
 
+            from pystack3d import Stack3d
+
             self.stack = Stack3d(input_name=project_dir, ignore_error=True)
             self.stack.params['channels'] = channels
             self.stack.params['ind_min'] = ind_min
@@ -174,15 +283,73 @@ class PyStack3dNapari(QObject):
     def create_run_all_widget(self):
         @magicgui(call_button="RUN ALL")
         def run_all_widget():
-            run_all_widget.call_button.enabled = False
-            self._stop_all = False
+            self.run_all()
 
-            self.active_sections = self.get_sections(only_checked=True)
-            self.finish_signal.connect(self.run_next_step)
-            self.run_next_step()
+        resume_all_button = QPushButton("RESUME ALL")
+        resume_all_button.setToolTip("RUN ALL reusing the partial outputs of the interrupted "
+                                     "slice-local steps")
+        resume_all_button.clicked.connect(lambda: self.run_all(resume=True))
+        run_all_widget.native.layout().addWidget(resume_all_button)
 
         return run_all_widget
 
+    def run_all(self, resume=False):
+        if not self.run_all_widget.call_button.enabled:
+            return
+        self.run_all_widget.call_button.enabled = False
+        self._stop_all = False
+        self._resume = resume
+
+        self.active_sections = self.get_sections(only_checked=True)
+        self.delete_outdated()
+        self._run_all_nsteps = len(self.active_sections)
+        self._run_all_t0 = time.perf_counter()
+        self._released_bytes = 0
+        self.finish_signal.connect(self.run_next_step)
+        self.run_next_step()
+
+    def get_resumable_steps(self, section):
+        from pystack3d_napari.fingerprint import get_resumable_steps
+
+        if self.stack is None:
+            return None
+        params = {section_.process_name: convert_params(section_.widget.asdict())
+                  for section_ in self.get_sections()}
+        return get_resumable_steps(self.stack, section.process_name, params)
+
+    def delete_outdated(self):
+        """ Delete the outputs of the 1rst outdated active step and of the following ones """
+        from pystack3d_napari.fingerprint import is_uptodate
+
+        if self.stack is None:
+            return
+        for section in self.active_sections:
+            params = convert_params(section.widget.asdict())
+            if section.process_name in self.stack.params['history'] \
+                    and not is_uptodate(self.stack, section.process_name, params):
+                section.delete(reply=QMessageBox.Yes)
+                break
+
+    def update_run_all_status(self, section, stats):
+        if self._run_all_t0 is None:
+            return
+        istep = self._run_all_nsteps - len(self.active_sections)
+        elapsed = time.perf_counter() - self._run_all_t0
+        self.run_all_status.setText(
+            f"step {istep}/{self._run_all_nsteps} ({section.process_name}): "
+            f"{stats['percent']}% - {stats['slices/s']:.1f} sl/s - {stats['MB/s']:.1f} MB/s - "
+            f"ETA {format_duration(stats['eta'])} - elapsed {format_duration(elapsed)}")
+
+    def finish_run_all_status(self, msg):
+        if self._run_all_t0 is not None:
+            elapsed = time.perf_counter() - self._run_all_t0
+            released = ""
+            if self._released_bytes:
+                released = f" ({self._released_bytes / 2 ** 30:.2f} GB released)"
+            self.run_all_status.setText(f"RUN ALL {msg} after {format_duration(elapsed)}"
+                                        f"{released}")
+        self._run_all_t0 = None
+
     def run_next_step(self):
         if self._stop_all:
             try:
@@ -190,11 +357,30 @@ class PyStack3dNapari(QObject):
             except TypeError:
                 pass
             self.run_all_widget.call_button.enabled = True
+            self.finish_run_all_status("stopped")
             return
 
+        # steps remaining in the history after 'delete_outdated()' are up to date
+        while len(self.active_sections) != 0 and self.stack is not None \
+                and self.active_sections[0].process_name in self.stack.params['history']:
+            self.active_sections.pop(0).set_uptodate()
+
+        self.apply_retention()
+
         if len(self.active_sections) != 0:
             self.current_section = self.active_sections.pop(0)
-            self.current_section.run(callback=self.run_next_step)
+            fused_sections = []
+            resume = self._resume and self.get_resumable_steps(self.current_section) is not None
+            if self.fuse and not resume:  # a resumed run keeps its own fused steps
+                from pystack3d_napari.fusion import get_fused_groups
+
+                process_names = [section.process_name
+                                 for section in [self.current_section] + self.active_sections]
+                group = get_fused_groups(process_names, self.stack.params['history'])[0]
+                fused_sections = self.active_sections[:len(group) - 1]
+                del self.active_sections[:len(group) - 1]
+            self.current_section.set_fused(fused_sections)
+            self.current_section.run(callback=self.run_next_step, resume=resume)
         else:
             try:
                 self.finish_signal.disconnect(self.run_next_step)
@@ -202,6 +388,24 @@ class PyStack3dNapari(QObject):
                 pass
             self.current_section = None
             self.run_all_widget.call_button.enabled = True
+            self.finish_run_all_status("completed")
+
+    def apply_retention(self):
+        """ Release the images of the steps no longer needed by the remaining RUN ALL steps """
+        if self.stack is None or self.retention == 'all':
+            return
+        from pystack3d_napari.retention import get_steps_to_release, release_step
+
+        pending = [section.process_name for section in self.active_sections]
+        channels = self.stack.params['channels']
+        process_names = get_steps_to_release(self.retention, self.stack.project_dir, channels,
+                                             self.stack.params['history'], pending,
+                                             nkeep=self.retention_keep)
+        for process_name in process_names:
+            remove_layers(process_name, channels)
+            self._released_bytes += release_step(self.stack.project_dir, process_name,
+                                                 self.stack.channels(process_name),
+                                                 policy=self.retention)
 
     def create_stop_all_widget(self):
         @magicgui(call_button="STOP ALL")
@@ -224,6 +428,9 @@ class PyStack3dNapari(QObject):
             remove_layers(self.project_dir, self.stack.params['channels'], is_init=True)
             for widget in self.process_container.widgets():
                 widget.delete(reply=QMessageBox.Yes)
+            from pystack3d_napari.cache import SLICE_CACHE
+
+            SLICE_CACHE.invalidate()
 
     def get_sections(self, only_checked=False):
         return [section for section in self.process_container.widgets()
@@ -316,8 +523,8 @@ def resampling_widget(policy: str = "slice_{slice_nb}_z={z_coord}um.tif",
 def cropping_final_widget(area: str = "(0, 9999, 0, 9999)"): ...
 
 
-def launch(project_dir=None, fname_toml=None):
-    """ Launch Napari with the 'drift_correction' pluggin """
+def create_viewer(project_dir=None, fname_toml=None):
+    """ Return a napari viewer with the 'pystack3d' dock widget """
     stack_napari = PyStack3dNapari(project_dir=project_dir, fname_toml=fname_toml)
     stack_napari.project_dir = project_dir
     stack_napari.fname_toml = fname_toml
@@ -326,6 +533,12 @@ def launch(project_dir=None, fname_toml=None):
     viewer.window.add_dock_widget(widgets(), area="right", name='pystack3d')
     viewer.window._qt_window.resize(1200, 850)
     viewer.window._qt_viewer.viewerButtons.ndisplayButton.setEnabled(False)
+    return viewer
+
+
+def launch(project_dir=None, fname_toml=None):
+    """ Launch Napari with the 'drift_correction' pluggin """
+    create_viewer(project_dir=project_dir, fname_toml=fname_toml)
     napari.run()
 
 
@@ -0,0 +1,183 @@
+"""
+Background monitoring of the resources (CPU, RSS and I/O of the processing workers, project
+filesystem throughput and free space) with a ring-buffered history and step markers
+"""
+import os
+import csv
+import json
+import time
+import shutil
+from pathlib import Path
+from collections import deque
+from threading import Thread, Event, Lock
+
+import psutil
+
+SPARKS = "▁▂▃▄▅▆▇█"
+
+CSV_KEYS = ['time', 'cpu_percent', 'ram_used', 'ram_total', 'disk_free', 'disk_total',
+            'disk_read_rate', 'disk_write_rate', 'nworkers', 'workers_cpu', 'workers_rss',
+            'workers_read_rate', 'workers_write_rate']
+
+
+def get_disk_device(path):
+    """ Return the name of the disk (as in 'psutil.disk_io_counters') hosting 'path' """
+    path = str(Path(path).resolve())
+    partitions = [part for part in psutil.disk_partitions(all=False)
+                  if path.startswith(part.mountpoint)]
+    if len(partitions) == 0:
+        return None
+    device = max(partitions, key=lambda part: len(part.mountpoint)).device
+    device = os.path.basename(os.path.realpath(device))  # '/dev/mapper/xx' -> 'dm-0'
+    return device if device in (psutil.disk_io_counters(perdisk=True) or {}) else None
+
+
+def sparkline(values, vmax=None):
+    """ Return the unicode sparkline of 'values' """
+    values = [val for val in values if val is not None]
+    if len(values) == 0:
+        return ""
+    vmax = vmax or max(values) or 1
+    return "".join(SPARKS[min(int(len(SPARKS) * val / vmax), len(SPARKS) - 1)]
+                   for val in values)
+
+
+class ResourceMonitor:
+    """
+    Thread sampling every 'interval' the system and workers (children processes) resources,
+    the last 'maxlen' samples being kept
+    """
+
+    def __init__(self, interval=1., maxlen=3600):
+        self.interval = interval
+        self.samples = deque(maxlen=maxlen)
+        self.markers = deque(maxlen=maxlen)
+        self.project_dir = Path(".")
+        self.device = None
+        self.processes = {}  # pid: psutil.Process (kept for the 'cpu_percent' calculation)
+        self.last_io = {}  # pid: (read, write)
+        self.last_disk_io = None
+        self.last_time = None
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def set_project_dir(self, project_dir):
+        self.project_dir = Path(project_dir)
+        try:
+            self.device = get_disk_device(project_dir)
+        except (OSError, RuntimeError):
+            self.device = None
+        self.last_disk_io = None
+
+    def mark(self, event, step):
+        """ Add a marker ('start', 'end', ...) related to 'step' in the time series """
+        with self.lock:
+            self.markers.append({'time': time.time(), 'event': event, 'step': step})
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:  # the monitoring never stops the application
+                print(f"[monitor] {e}")
+            self.stop_event.wait(self.interval)
+
+    def sample_workers(self, dt):
+        workers = []
+        children = {process.pid: process
+                    for process in psutil.Process().children(recursive=True)}
+        for pid, process in children.items():
+            process = self.processes.setdefault(pid, process)
+            try:
+                with process.oneshot():
+                    cpu = process.cpu_percent(None)  # since the last sample
+                    rss = process.memory_info().rss
+                    counters = process.io_counters()
+                io = (getattr(counters, 'read_chars', counters.read_bytes),
+                      getattr(counters, 'write_chars', counters.write_bytes))
+            except (psutil.Error, AttributeError):
+                continue
+            last_io = self.last_io.get(pid, io)
+            self.last_io[pid] = io
+            workers.append({'pid': pid, 'cpu_percent': cpu, 'rss': rss,
+                            'read_rate': (io[0] - last_io[0]) / dt if dt else 0.,
+                            'write_rate': (io[1] - last_io[1]) / dt if dt else 0.})
+        for pid in set(self.processes) - set(children):  # finished processes
+            self.processes.pop(pid)
+            self.last_io.pop(pid, None)
+        return workers
+
+    def sample(self):
+        now = time.time()
+        dt = now - self.last_time if self.last_time else None
+        self.last_time = now
+
+        mem = psutil.virtual_memory()
+        disk = shutil.disk_usage(self.project_dir)
+        if self.device is not None:
+            disk_io = psutil.disk_io_counters(perdisk=True).get(self.device)
+        else:
+            disk_io = psutil.disk_io_counters()
+        read_rate = write_rate = 0.
+        if disk_io is not None and self.last_disk_io is not None and dt:
+            read_rate = (disk_io.read_bytes - self.last_disk_io.read_bytes) / dt
+            write_rate = (disk_io.write_bytes - self.last_disk_io.write_bytes) / dt
+        self.last_disk_io = disk_io
+
+        workers = self.sample_workers(dt)
+        sample = {'time': now, 'cpu_percent': psutil.cpu_percent(None),
+                  'ram_used': mem.total - mem.available, 'ram_total': mem.total,
+                  'disk_free': disk.free, 'disk_total': disk.total,
+                  'disk_read_rate': read_rate, 'disk_write_rate': write_rate,
+                  'nworkers': len(workers),
+                  'workers_cpu': sum(worker['cpu_percent'] for worker in workers),
+                  'workers_rss': sum(worker['rss'] for worker in workers),
+                  'workers_read_rate': sum(worker['read_rate'] for worker in workers),
+                  'workers_write_rate': sum(worker['write_rate'] for worker in workers),
+                  'workers': workers}
+        with self.lock:
+            self.samples.append(sample)
+        return sample
+
+    def last(self):
+        with self.lock:
+            return self.samples[-1] if self.samples else None
+
+    def series(self, key, n=None):
+        with self.lock:
+            samples = list(self.samples)[-n:] if n else list(self.samples)
+        return [sample[key] for sample in samples]
+
+    def export(self, fname):
+        """ Save the history in a .csv (1 row per sample) or .json file with the markers """
+        fname = Path(fname)
+        with self.lock:
+            samples, markers = list(self.samples), list(self.markers)
+        if fname.suffix.lower() == '.json':
+            fname.write_text(json.dumps({'project_dir': str(self.project_dir),
+                                         'samples': samples, 'markers': markers}, indent=1),
+                             encoding='utf-8')
+            return
+        with open(fname, 'w', newline='', encoding='utf-8') as fid:
+            writer = csv.writer(fid)
+            writer.writerow(CSV_KEYS + ['markers'])
+            k = 0
+            for sample in samples:  # markers attached to the next sample
+                texts = []
+                while k < len(markers) and markers[k]['time'] <= sample['time']:
+                    texts.append(f"{markers[k]['event']}:{markers[k]['step']}")
+                    k += 1
+                writer.writerow([sample[key] for key in CSV_KEYS] + [";".join(texts)])
+
+
+MONITOR = ResourceMonitor()
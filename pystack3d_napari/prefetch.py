@@ -0,0 +1,107 @@
+"""
+Background prefetching of the slices neighbouring the displayed one
+"""
+import time
+import math
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """
+    Decode in a thread pool (tifffile releases the GIL) the next slices in the scrolling
+    direction, the number of slices ahead being adapted to the measured decoding latency
+    and to the scrolling speed
+    """
+
+    def __init__(self, max_workers=4, window_min=2, window_max=32):
+        self.max_workers = max_workers
+        self.window_min = window_min
+        self.window_max = window_max
+        self.viewer = None
+        self.executor = None
+        self.latency = None  # moving average of the decoding time (s)
+        self.interval = 1.  # moving average of the time between 2 steps (s)
+        self.last_time = None
+        self.last_step = None
+        self.direction = 1
+        self.pending = {}
+        self.lock = Lock()
+
+    @property
+    def window(self):
+        if self.latency is None:
+            return self.window_min
+        window = math.ceil(self.latency / max(self.interval, 1e-3)) + 1
+        return min(max(window, self.window_min), self.window_max)
+
+    def connect(self, viewer):
+        if viewer is None or self.viewer is viewer:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="prefetch")
+        self.viewer = viewer
+        viewer.dims.events.current_step.connect(self.on_step)
+
+    def cancel(self):
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+
+    def get_stacks(self):
+        stacks = []
+        for layer in self.viewer.layers:
+            stack = layer.metadata.get('tiff_stack') if hasattr(layer, 'metadata') else None
+            if stack is not None and layer.visible and not getattr(layer, 'multiscale', False):
+                ind = int(round(layer.world_to_data(self.viewer.dims.point)[0]))
+                stacks.append((stack, ind))
+        return stacks
+
+    def on_step(self, event=None):
+        if self.viewer.dims.ndisplay != 2:
+            return
+        step = self.viewer.dims.current_step[0]
+        last_step, self.last_step = self.last_step, step
+        if last_step is None or step == last_step:
+            return
+
+        now = time.perf_counter()
+        if self.last_time is not None:
+            interval = min(now - self.last_time, 1.)
+            self.interval = 0.7 * self.interval + 0.3 * interval
+        self.last_time = now
+
+        delta = step - last_step
+        if abs(delta) > self.window or (delta > 0) != (self.direction > 0):
+            self.cancel()  # jump or change of direction
+        self.direction = 1 if delta > 0 else -1
+
+        window = self.window
+        for stack, ind in self.get_stacks():
+            for k in range(1, window + 1):
+                self.submit(stack, ind + self.direction * k)
+
+    def submit(self, stack, ind):
+        if not 0 <= ind < len(stack) or stack.cache is None or stack.is_memmappable(ind):
+            return
+        key = stack.key(ind)
+        if key is None:  # slice not written yet (live layers)
+            return
+        with self.lock:
+            if key in stack.cache or key in self.pending:
+                return
+            self.pending[key] = self.executor.submit(self.read, stack, ind, key)
+
+    def read(self, stack, ind, key):
+        try:
+            t0 = time.perf_counter()
+            stack.read(ind)
+            latency = time.perf_counter() - t0
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+
+PREFETCHER = Prefetcher()
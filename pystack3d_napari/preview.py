@@ -0,0 +1,168 @@
+"""
+Single-slice evaluation of the processing steps, used for the live preview of the results
+while editing the parameters
+"""
+import json
+
+import numpy as np
+
+from pystack3d_napari.fusion import KERNELS
+from pystack3d_napari.utils import get_input_dirname
+from pystack3d_napari.index import get_slice_index
+from pystack3d_napari.reader import TiffStack
+
+SLAB_HALF_SIZE = 5  # slices considered on each side for the statistics along z
+
+
+class BkgRemoval:
+    """
+    Slice background removal, as done in 'pystack3d.bkg_removal'.
+    The 3D backgrounds (fitted on the whole stack) are approximated by 2D ones
+    """
+
+    def __init__(self, params, shape, **kwargs):
+        from pystack3d.bkg_removal import init_args, get_powers_2d, poly_basis_calculation
+
+        params = dict(params)
+        init_args(params, (1, *shape))  # 'powers' calculation
+        powers = get_powers_2d(params['powers'])
+        skip_factors = tuple(params.get('skip_factors') or (10, 10))[:2]
+        self.kwargs = {'powers': powers,
+                       'skip_factors': skip_factors,
+                       'threshold_min': params.get('threshold_min'),
+                       'threshold_max': params.get('threshold_max'),
+                       'weight_func': params.get('weight_func', 'HuberT'),
+                       'poly_basis_precalc': poly_basis_calculation(shape, powers),
+                       'poly_basis_precalc_skip': poly_basis_calculation(shape, powers,
+                                                                         skip_factors)}
+
+    def __call__(self, img, k):
+        from pystack3d.bkg_removal import bkg_eval
+
+        return bkg_eval(img, **self.kwargs)[0]
+
+
+class IntensityRescaling:
+    """
+    Slice intensity rescaling, as done in 'pystack3d.intensity_rescaling'.
+    The reference histograms (evaluated on the whole stack) are evaluated on a slab of slices
+    """
+
+    def __init__(self, params, shape, stack=None, **kwargs):
+        self.nbins = int(params.get('nbins', 256))
+        self.filter_size = int(params.get('filter_size', -1))
+        self.stack = stack
+
+    def __call__(self, img, k):
+        from scipy.ndimage import uniform_filter1d
+        from pystack3d.intensity_rescaling import eval as rescaling_eval
+
+        kmin = max(k - SLAB_HALF_SIZE, 0)
+        kmax = min(k + SLAB_HALF_SIZE + 1, len(self.stack))
+        slab = [self.stack.read(k_) for k_ in range(kmin, kmax)]
+        range_bins = [min(arr.min() for arr in slab), max(arr.max() for arr in slab)]
+        histos = np.asarray([np.histogram(arr.ravel(), bins=self.nbins, range=range_bins)[0]
+                             for arr in slab])
+        edges = np.histogram_bin_edges([], bins=self.nbins, range=range_bins)
+        x = (edges[1:] + edges[:-1]) / 2.
+        if self.filter_size == -1:
+            histo_ref = histos.mean(axis=0)
+        else:
+            histo_ref = uniform_filter1d(histos, self.filter_size, axis=0)[k - kmin]
+        cdf_target = np.cumsum(histo_ref)
+        cdf_target = cdf_target / np.max(cdf_target)
+        return rescaling_eval(img, cdf_target, x, self.nbins, range_bins)
+
+
+PREVIEW_KERNELS = {**KERNELS, 'bkg_removal': BkgRemoval, 'intensity_rescaling': IntensityRescaling}
+
+_LAST_KERNEL = {}  # kernel reused while scrolling with unchanged parameters
+
+
+def get_kernel(process_name, params, stack, project_dir=None):
+    key = json.dumps([process_name, params, stack.fnames[0], len(stack), str(project_dir)],
+                     sort_keys=True, default=str)
+    if key not in _LAST_KERNEL:
+        _LAST_KERNEL.clear()
+        _LAST_KERNEL[key] = PREVIEW_KERNELS[process_name](params, stack.slice_shape,
+                                                          project_dir=project_dir,
+                                                          stack=stack)
+    return _LAST_KERNEL[key]
+
+
+def get_input_stack(stack, process_name):
+    """ Return the TiffStack of the 'process_name' input images (1rst channel), None if empty """
+    history = stack.params['history']
+    dirname = get_input_dirname(stack.project_dir, history, process_name)
+    index = get_slice_index(dirname / stack.params['channels'][0])
+    ind_min, ind_max = (stack.params['ind_min'], stack.params['ind_max']) \
+        if len(history) == 0 else (0, None)
+    fnames = index.fnames(ind_min, ind_max)
+    if len(fnames) == 0:
+        return None
+    return TiffStack(fnames, infos=index.infos(ind_min, ind_max))
+
+
+def preview_slice(process_name, params, stack, ind, project_dir=None):
+    """
+    Return the result of 'process_name' (as it would be saved) on the slice 'ind' of 'stack'
+    (a TiffStack of the step input images)
+    """
+    from pystack3d.utils import img_reformatting
+
+    img = np.array(stack.read(ind))
+    kernel = get_kernel(process_name, params, stack, project_dir=project_dir)
+    return img_reformatting(kernel(img, ind), img.dtype)
+
+
+def get_spectrum(img):
+    """ Return the 'rfft2' of the slice (complex64) """
+    return np.fft.rfft2(img.astype(np.float32)).astype(np.complex64)
+
+
+def get_filters_spectrum(filters, shape):
+    """
+    Return the stripes power spectrum (in the 'rfft2' layout) modelled by the pyvsnr 'filters',
+    each filter spectrum being normalized and weighted by its 'noise_level'
+    """
+    from pyvsnr.vsnr2d import create_gabor
+
+    n0, n1 = shape
+    psd = np.zeros((n0, n1 // 2 + 1), dtype=np.float32)
+    for filt in filters:
+        if filt['name'] == 'Dirac':
+            spectrum = np.ones_like(psd)
+        elif filt['name'] == 'Gabor':
+            sigma = filt['sigma']
+            psi = create_gabor(n0, n1, 1, sigma[0], sigma[1], filt['theta'], 0, 0, np)
+            spectrum = np.abs(np.fft.rfft2(psi)) ** 2
+        else:
+            continue
+        psd += filt['noise_level'] * spectrum / max(spectrum.max(), 1e-12)
+    return psd
+
+
+def to_full_spectrum(half, n1):
+    """ Return the centered full spectrum of a real image from its 'rfft2' layout one """
+    n0, m = half.shape
+    full = np.empty((n0, n1), dtype=half.dtype)
+    full[:, :m] = half
+    full[:, m:] = half[(-np.arange(n0)) % n0][:, n1 - np.arange(m, n1)]  # hermitian symmetry
+    return np.fft.fftshift(full)
+
+
+def fourier_destriping(spectrum, filters, shape):
+    """
+    Fast approximation of the VSNR destriping from the slice 'spectrum' ('rfft2' layout).
+    The total variation prior of VSNR is replaced by a quadratic one on the gradients, leading
+    to a closed-form solution: the stripes are removed with the gain W / (1 + W),
+    W = (noise power spectrum modelled by the 'filters') x (gradient operator spectrum)
+    """
+    n0, n1 = shape
+    f0 = np.fft.fftfreq(n0)[:, None]
+    f1 = np.fft.rfftfreq(n1)[None, :]
+    grad = np.sin(np.pi * f0) ** 2 + np.sin(np.pi * f1) ** 2  # |fd1|^2 + |fd2|^2 (/4)
+    weight = get_filters_spectrum(filters, shape) * grad
+    gain = 1 / (1 + weight)
+    gain[0, 0] = 1  # mean value preserved
+    return np.fft.irfft2(spectrum * gain, s=shape)
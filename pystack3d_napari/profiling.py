@@ -0,0 +1,205 @@
+"""
+Opt-in profiling of a step run: cProfile and stack sampling of the eval thread and of each
+worker process, merged in 'process/<step>/profile/profile.prof' and 'profile.collapsed'
+"""
+import os
+import sys
+import time
+import shutil
+import pstats
+import cProfile
+from pathlib import Path
+from collections import Counter
+from threading import Thread, Event, get_ident
+from contextlib import contextmanager
+
+from pystack3d_napari.fusion import process_slice
+
+PROFILE_DIRNAME = "profile"
+SAMPLING_INTERVAL = 0.01  # (s)
+
+
+def get_step_dirname(fname):
+    """ Return the 'process/<step>' directory containing 'fname' """
+    fname = Path(fname).resolve()
+    for dirname in [fname, *fname.parents]:
+        if dirname.parent.name == 'process':
+            return dirname
+    return fname.parent
+
+
+def collapse(frame):
+    """ Return the collapsed stack ('module:func;module:func...', root first) of 'frame' """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler(Thread):
+    """ Sample periodically the stack of the thread 'ident' """
+
+    def __init__(self, ident, counts, interval=SAMPLING_INTERVAL):
+        super().__init__(daemon=True)
+        self.target_ident = ident
+        self.counts = counts
+        self.interval = interval
+        self.finished = Event()
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            frame = sys._current_frames().get(self.target_ident)
+            if frame is not None:
+                self.counts[collapse(frame)] += 1
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
+class Capture:
+    """ cProfile + stack sampling of the current thread, accumulated over the 'with' blocks """
+
+    def __init__(self, dirname, name):
+        self.dirname = Path(dirname)
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.counts = Counter()
+        self.sampler = None
+
+    def __enter__(self):
+        self.sampler = StackSampler(get_ident(), self.counts)
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.profile.disable()
+        self.sampler.stop()
+
+    def save(self):
+        os.makedirs(self.dirname, exist_ok=True)
+        self.profile.dump_stats(self.dirname / f"{self.name}.prof")
+        write_collapsed(self.dirname / f"{self.name}.collapsed", self.counts)
+
+
+def write_collapsed(fname, counts):
+    with open(fname, 'w', encoding='utf-8') as fid:
+        for stack, count in counts.most_common():
+            fid.write(f"{stack} {count}\n")
+
+
+def read_collapsed(fname):
+    counts = Counter()
+    with open(fname, 'r', encoding='utf-8') as fid:
+        for line in fid:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack:
+                counts[stack] += int(count)
+    return counts
+
+
+_WORKER_CAPTURES = {}  # worker captures (per profile directory), accumulated over the tasks
+_PROFILING_PID = None  # process running the profiled eval (with its own capture)
+
+
+def get_worker_capture(dirname):
+    if os.getpid() == _PROFILING_PID:
+        return None  # nproc=1: already profiled in the eval thread
+    if dirname not in _WORKER_CAPTURES:
+        _WORKER_CAPTURES[dirname] = Capture(dirname, f"worker_{os.getpid()}")
+    return _WORKER_CAPTURES[dirname]
+
+
+def profiled_step_wrapper(process_step, kwargs):
+    """ 'pystack3d' workers entry point, profiled """
+    from pystack3d.utils_multiprocessing import step_wrapper
+
+    dirname = get_step_dirname(kwargs['output_dirname']) / PROFILE_DIRNAME
+    capture = get_worker_capture(dirname)
+    if capture is None:
+        return step_wrapper(process_step, kwargs)
+    try:
+        with capture:
+            return step_wrapper(process_step, kwargs)
+    finally:
+        capture.save()
+
+
+def profiled_process_slice(args):
+    """ Fused steps workers entry point, profiled """
+    fnames_out = args[2]
+    dirname = get_step_dirname(list(fnames_out.values())[-1]) / PROFILE_DIRNAME
+    capture = get_worker_capture(dirname)
+    if capture is None:
+        return process_slice(args)
+    try:
+        with capture:
+            return process_slice(args)
+    finally:
+        capture.save()  # accumulated stats, overwritten at each task
+
+
+def merge(dirname):
+    """ Merge the '.prof' and '.collapsed' files of 'dirname' (except the merged ones) """
+    dirname = Path(dirname)
+    fnames = sorted(fname for fname in dirname.glob("*.prof") if fname.stem != 'profile')
+    if len(fnames) == 0:
+        return None
+    stats = pstats.Stats(str(fnames[0]))
+    for fname in fnames[1:]:
+        stats.add(str(fname))
+    stats.dump_stats(dirname / "profile.prof")
+
+    counts = Counter()
+    for fname in dirname.glob("*.collapsed"):
+        if fname.stem != 'profile':
+            counts.update(read_collapsed(fname))
+    write_collapsed(dirname / "profile.collapsed", counts)
+    return stats
+
+
+def summary(stats, n=15):
+    """ Return the top-'n' functions (by own time) of 'stats' as text """
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:n]
+    lines = [f"{'tottime':>8} {'cumtime':>8} {'ncalls':>8}  function"]
+    for (fname, line, func), (_, ncalls, tottime, cumtime, _) in rows:
+        lines.append(f"{tottime:8.3f} {cumtime:8.3f} {ncalls:8d}  "
+                     f"{func} ({Path(fname).name}:{line})")
+    return "\n".join(lines)
+
+
+@contextmanager
+def profiling(project_dir, process_names, results):
+    """
+    Profile the run of 'process_names' in the current thread and in the workers, the workers
+    entry points being patched during the run. 'results' (dict) receives the merged
+    'summary' and 'dirname' (the last step 'profile' folder)
+    """
+    global _PROFILING_PID
+    import pystack3d.stack3d
+    from pystack3d.utils_multiprocessing import step_wrapper
+    from pystack3d_napari import fusion
+
+    dirname = Path(project_dir) / 'process' / process_names[-1] / PROFILE_DIRNAME
+    shutil.rmtree(dirname, ignore_errors=True)  # previous run captures
+    pystack3d.stack3d.step_wrapper = profiled_step_wrapper
+    fusion.process_slice = profiled_process_slice
+    _PROFILING_PID = os.getpid()
+    capture = Capture(dirname, "eval")
+    t0 = time.perf_counter()
+    try:
+        with capture:
+            yield
+    finally:
+        pystack3d.stack3d.step_wrapper = step_wrapper
+        fusion.process_slice = process_slice
+        _PROFILING_PID = None
+        if (Path(project_dir) / 'process' / process_names[-1]).is_dir():
+            capture.save()
+            stats = merge(dirname)
+            results['dirname'] = dirname
+            results['summary'] = (f"profile ({time.perf_counter() - t0:.1f}s): {dirname}\n" +
+                                  summary(stats))
@@ -0,0 +1,117 @@
+"""
+Binned proxy volumes of tiff stacks for the 3D rendering, built in background
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+from functools import partial
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psutil
+
+PROXY_DIRNAME = ".proxy"
+PROXY_MB = int(os.environ.get("PYSTACK3D_PROXY_MB", 512))  # (GPU) memory of a proxy volume
+PROXY_MAX_SIZE = 2048  # max. 3D texture size along each axis
+
+_BUILDS = {}
+_BUILDS_LOCK = Lock()
+
+
+def get_max_voxels(proxy_mb=PROXY_MB):
+    """ Return the voxels budget (float32) from 'proxy_mb' and the available RAM """
+    nbytes = min(proxy_mb * 2 ** 20, psutil.virtual_memory().available // 4)
+    return max(nbytes // 4, 1)
+
+
+def get_binning(shape, max_voxels, max_size=PROXY_MAX_SIZE):
+    """ Return the binning factors along (z, y, x) for the binned volume to fit 'max_voxels' """
+    binning = [1, 1, 1]
+
+    def binned_shape():
+        return [int(np.ceil(n / b)) for n, b in zip(shape, binning)]
+
+    while np.prod(binned_shape(), dtype=float) > max_voxels or max(binned_shape()) > max_size:
+        axis = int(np.argmax(binned_shape()))  # the largest binned axis is binned first
+        binning[axis] += 1
+    return tuple(binning)
+
+
+def get_signature(tiff_stack):
+    content = json.dumps([tiff_stack.fnames, tiff_stack.infos], default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def get_fname(tiff_stack, binning):
+    dirname = Path(tiff_stack.fnames[0]).parent / PROXY_DIRNAME
+    name = f"{get_signature(tiff_stack)[:16]}_{'x'.join(map(str, binning))}.npy"
+    return dirname / name
+
+
+def bin_block(tiff_stack, k0, binning):
+    """ Return the binned (mean) slab of slices starting from 'k0' """
+    bz, by, bx = binning
+    imgs = [tiff_stack.read(k) for k in range(k0, min(k0 + bz, len(tiff_stack)))]
+    slab = np.mean(np.asarray(imgs, dtype=np.float32), axis=0)
+    ny, nx = slab.shape
+    pad = ((0, -ny % by), (0, -nx % bx))
+    slab = np.pad(slab, pad, mode='edge')
+    return slab.reshape(slab.shape[0] // by, by, slab.shape[1] // bx, bx).mean(axis=(1, 3))
+
+
+def reduce_slab(proxy, tiff_stack, kz, binning):
+    proxy[kz] = bin_block(tiff_stack, kz * binning[0], binning)
+
+
+def build_proxy(tiff_stack, binning, nthreads=None):
+    """ Build the proxy volume (float32) with a parallel reduction of the slabs of slices """
+    fname = get_fname(tiff_stack, binning)
+    os.makedirs(fname.parent, exist_ok=True)
+    nz, ny, nx = tiff_stack.shape
+    shape = tuple(int(np.ceil(n / b)) for n, b in zip((nz, ny, nx), binning))
+    fname_tmp = fname.with_suffix(".tmp.npy")
+    proxy = np.lib.format.open_memmap(fname_tmp, mode='w+', dtype=np.float32, shape=shape)
+    with ThreadPoolExecutor(nthreads or min(8, os.cpu_count())) as executor:
+        list(executor.map(partial(reduce_slab, proxy, tiff_stack, binning=binning),
+                          range(shape[0])))
+    proxy.flush()
+    proxy._mmap.close()  # (released before the renaming, required on Windows)
+    os.replace(fname_tmp, fname)
+
+
+def get_proxy(tiff_stack, max_voxels=None):
+    """
+    Return the proxy volume (memmap) and its binning if available, otherwise launch its
+    building in background and return (None, binning)
+    """
+    binning = get_binning(tiff_stack.shape, max_voxels or get_max_voxels())
+    fname = get_fname(tiff_stack, binning)
+    if fname.exists():
+        return np.load(fname, mmap_mode='r'), binning
+
+    key = str(fname)
+    with _BUILDS_LOCK:
+        if key in _BUILDS and _BUILDS[key].is_alive():
+            return None, binning
+
+        def build():
+            try:
+                build_proxy(tiff_stack, binning)
+            except Exception as e:
+                print(f"[proxy] Error with '{fname.parent.parent}': {e}")
+
+        _BUILDS[key] = Thread(target=build, daemon=True)
+        _BUILDS[key].start()
+    return None, binning
+
+
+def get_subbox(data, box):
+    """
+    Return the full resolution (lazy) sub-volume of 'data' related to 'box'
+    (zmin, zmax, ymin, ymax, xmin, xmax), clipped to the data shape
+    """
+    slices = tuple(slice(max(int(vmin), 0), min(int(vmax), n))
+                   for (vmin, vmax), n in zip(zip(box[::2], box[1::2]), data.shape))
+    return data[slices], tuple(s.start for s in slices)
@@ -0,0 +1,133 @@
+"""
+On-disk multiscale pyramids of tiff stacks, built in background: chunked and compressed
+(OME-Zarr) levels if 'zarr' is installed, whole-volume .npy memmaps otherwise
+"""
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from threading import Thread, Lock
+
+import numpy as np
+
+from pystack3d_napari.reader import TiffStack
+
+PYRAMID_DIRNAME = ".pyramid"
+PYRAMID_MIN_SIZE = 2048  # slices smaller than that are displayed in single-scale
+PYRAMID_TILE = 512  # levels are added until the slices fit in a tile
+LEVELS_NAME = "levels.zarr"
+
+_BUILDS = {}
+_BUILDS_LOCK = Lock()
+
+
+def get_signature(index):
+    """ Return a signature of the index content (names, shapes, mtimes) """
+    content = json.dumps([index.names, [index.entries[name] for name in index.names]])
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def get_levels_shapes(shape, tile=PYRAMID_TILE):
+    """ Return the 2x-binned slices shapes of the levels (without the full resolution one) """
+    shapes = []
+    while max(shape) > tile and min(shape) >= 2:
+        shape = (shape[0] // 2, shape[1] // 2)
+        shapes.append(shape)
+    return shapes
+
+
+def bin2(img):
+    """ Return the 2x2-binned (mean) image """
+    h, w = 2 * (img.shape[0] // 2), 2 * (img.shape[1] // 2)
+    img = img[:h, :w].astype(np.float32)
+    return 0.25 * (img[::2, ::2] + img[1::2, ::2] + img[::2, 1::2] + img[1::2, 1::2])
+
+
+def read_pyramid(index):
+    """ Return the levels (as dask arrays or memmaps) of an up-to-date pyramid or None """
+    from pystack3d_napari.store import has_zarr
+
+    dirname = index.dirname / PYRAMID_DIRNAME
+    try:
+        infos = json.loads((dirname / "pyramid.json").read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+    if infos['signature'] != get_signature(index):
+        return None
+    if infos.get('format') == 'zarr':
+        if not has_zarr():
+            return None
+        import zarr
+        import dask.array as da
+
+        group = zarr.open_group(str(dirname / LEVELS_NAME), mode='r')
+        return [da.from_zarr(group[str(k)]) for k in range(infos['nlevels'])]
+    return [np.load(dirname / f"level_{k}.npy", mmap_mode='r')
+            for k in range(1, infos['nlevels'] + 1)]
+
+
+def build_pyramid(index):
+    """ Build the pyramid related to a slice index in 'dirname/.pyramid' """
+    from pystack3d_napari.store import (has_zarr, write_levels, get_compressor,
+                                        DEFAULT_OUTPUT)
+
+    signature = get_signature(index)
+    shape, dtype = index.shape_dtype()
+    shapes = get_levels_shapes(shape)
+    stack = TiffStack(index.fnames(), shape=shape, dtype=dtype, infos=index.infos(), cache=None)
+
+    dirname = index.dirname / PYRAMID_DIRNAME
+    dirname_tmp = index.dirname / (PYRAMID_DIRNAME + ".tmp")
+    shutil.rmtree(dirname_tmp, ignore_errors=True)
+    os.makedirs(dirname_tmp)
+
+    if has_zarr():  # slices and tiles read on demand, no whole-volume mapping
+        write_levels(dirname_tmp / LEVELS_NAME, stack, len(shapes),
+                     [1, PYRAMID_TILE, PYRAMID_TILE],
+                     get_compressor(DEFAULT_OUTPUT['codec'], DEFAULT_OUTPUT['level']),
+                     {'signature': signature}, first_level=1)
+        file_format = 'zarr'
+    else:
+        levels = [np.lib.format.open_memmap(dirname_tmp / f"level_{k}.npy", mode='w+',
+                                            dtype=dtype, shape=(len(stack),) + shape_k)
+                  for k, shape_k in enumerate(shapes, start=1)]
+        for i in range(len(stack)):
+            img = stack.read(i)
+            for level in levels:
+                img = bin2(img)
+                level[i] = img.astype(dtype) if dtype.kind == 'f' else np.rint(img).astype(dtype)
+        for level in levels:
+            level.flush()
+        del levels
+        file_format = 'npy'
+
+    infos = {'signature': signature, 'nlevels': len(shapes), 'shapes': shapes,
+             'format': file_format}
+    (dirname_tmp / "pyramid.json").write_text(json.dumps(infos), encoding='utf-8')
+    shutil.rmtree(dirname, ignore_errors=True)
+    os.replace(dirname_tmp, dirname)
+
+
+def get_pyramid(index):
+    """ Return the pyramid levels if available, otherwise launch its building in background """
+    if len(index) == 0:
+        return None
+    levels = read_pyramid(index)
+    if levels is not None:
+        return levels
+
+    key = str(Path(index.dirname).resolve())
+    with _BUILDS_LOCK:
+        if key in _BUILDS and _BUILDS[key].is_alive():
+            return None
+
+        def build():
+            try:
+                build_pyramid(index)
+            except Exception as e:
+                print(f"[pyramid] Error with '{index.dirname}': {e}")
+
+        _BUILDS[key] = Thread(target=build, daemon=True)
+        _BUILDS[key].start()
+    return None
@@ -0,0 +1,167 @@
+"""
+Lazy readers dedicated to stacks of tiff slices
+"""
+import os
+
+import numpy as np
+from tifffile import TiffFile, imread
+
+from pystack3d_napari.cache import SLICE_CACHE
+
+CHUNK_BYTES = 64 * 2 ** 20  # default memory budget per dask chunk
+
+
+def get_tiff_info(fname):
+    """
+    Return the (shape, dtype, offset) of a tiff file from its header only, 'offset' being
+    the position of the data in the file if it can be memory-mapped, None otherwise
+    """
+    with TiffFile(fname) as tif:
+        page = tif.pages[0]
+        dtype = np.dtype(page.dtype)
+        offset = None
+        if page.is_memmappable and dtype.newbyteorder(tif.byteorder).isnative:
+            offset = page.dataoffsets[0]
+        return tuple(page.shape), dtype, offset
+
+
+def is_complete_tiff(fname, shape, dtype):
+    """ Return True if the tiff file has the expected shape and dtype and is not truncated """
+    try:
+        with TiffFile(fname) as tif:
+            page = tif.pages[0]
+            if tuple(page.shape) != tuple(shape) or np.dtype(page.dtype) != np.dtype(dtype):
+                return False
+            size = os.path.getsize(fname)
+            return all(offset + count <= size
+                       for offset, count in zip(page.dataoffsets, page.databytecounts))
+    except Exception:
+        return False
+
+
+def slice_key(fname, mtime=None):
+    """
+    Return the SLICE_CACHE key of a tiff file: (absolute file name, mtime in ns), the mtime
+    being read from the file if not given (by a SliceIndex)
+    """
+    if mtime is None:
+        mtime = os.stat(fname).st_mtime_ns
+    return os.path.abspath(fname), mtime
+
+
+def get_chunk_size(shape, dtype, chunk_size=None, chunk_bytes=CHUNK_BYTES):
+    """ Return the number of consecutive slices grouped in a same chunk """
+    if chunk_size is None:
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        chunk_size = chunk_bytes // max(nbytes, 1)
+    return max(int(chunk_size), 1)
+
+
+class TiffStack:
+    """ Array-like stack of tiff slices, read on demand """
+
+    def __init__(self, fnames, shape=None, dtype=None, infos=None, cache=SLICE_CACHE):
+        self.fnames = [str(fname) for fname in fnames]
+        self.infos = infos  # per-file metadata given by a SliceIndex
+        self.cache = cache
+        if shape is None or dtype is None:
+            shape, dtype, _ = get_tiff_info(self.fnames[0])
+        self.slice_shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return (len(self.fnames),) + self.slice_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return len(self.fnames)
+
+    def key(self, ind):
+        mtime = None if self.infos is None else self.infos[ind]['mtime']
+        return slice_key(self.fnames[ind], mtime)
+
+    def is_memmappable(self, ind):
+        return self.infos is not None and self.infos[ind].get('offset') is not None
+
+    def read(self, ind):
+        fname = self.fnames[ind]
+        if self.is_memmappable(ind):
+            # uncompressed data read as is, without decoding nor mapping left open on the file
+            # (a mapped file cannot be deleted on Windows)
+            infos = self.infos[ind]
+            shape = tuple(infos['shape'])
+            loader = lambda: np.fromfile(fname, dtype=np.dtype(infos['dtype']),
+                                         count=int(np.prod(shape)),
+                                         offset=infos['offset']).reshape(shape)
+        else:
+            loader = lambda: imread(fname)
+        if self.cache is None:
+            return loader()
+        return self.cache.get(self.key(ind), loader)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        zkey, rest = key[0], key[1:]
+        if zkey is Ellipsis:
+            zkey, rest = slice(None), key
+        if isinstance(zkey, (int, np.integer)):
+            return self.read(range(len(self))[zkey])[rest]
+        inds = range(len(self))[zkey]
+        if len(inds) == 1:
+            return self.read(inds[0])[np.newaxis][(slice(None),) + rest]
+        arr = np.empty((len(inds),) + self.slice_shape, dtype=self.dtype)
+        for k, ind in enumerate(inds):
+            arr[k] = self.read(ind)
+        return arr[(slice(None),) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def to_dask(self, chunk_size=None, chunk_bytes=CHUNK_BYTES):
+        """ Return a dask array grouping 'chunk_size' consecutive slices per chunk """
+        import dask.array as da
+        from dask.base import tokenize
+
+        nz = get_chunk_size(self.slice_shape, self.dtype, chunk_size, chunk_bytes)
+        chunks = (min(nz, len(self)),) + self.slice_shape
+        mtimes = None if self.infos is None else [infos['mtime'] for infos in self.infos]
+        name = "tiffstack-" + tokenize(self.fnames, mtimes, self.slice_shape, self.dtype.str, nz)
+        return da.from_array(self, chunks=chunks, name=name, asarray=False, fancy=False,
+                             meta=np.empty((0,) * self.ndim, dtype=self.dtype))
+
+
+class GrowingStack(TiffStack):
+    """
+    Stack of the tiff slices being written by a step (expected filenames, shape and dtype
+    known up front), the slices not written yet being read as placeholders
+    """
+
+    def __init__(self, fnames, shape, dtype, fill_value=0, cache=SLICE_CACHE):
+        super().__init__(fnames, shape=shape, dtype=dtype, cache=cache)
+        self.fill_value = fill_value
+        self.written = set()
+
+    def is_written(self, ind):
+        if ind not in self.written \
+                and is_complete_tiff(self.fnames[ind], self.slice_shape, self.dtype):
+            self.written.add(ind)
+        return ind in self.written
+
+    def key(self, ind):
+        """ Return the cache key of a written slice, None for the slices not written yet """
+        return slice_key(self.fnames[ind]) if self.is_written(ind) else None
+
+    def read(self, ind):
+        if not self.is_written(ind):
+            return np.full(self.slice_shape, self.fill_value, dtype=self.dtype)
+        return super().read(ind)
@@ -0,0 +1,143 @@
+"""
+Disk footprint of the step outputs: lossless compression of the tiff slices and retention
+policies releasing (deleting) the images of the steps no longer needed along the chain
+"""
+import io
+import os
+import gc
+import json
+import time
+import shutil
+from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from tifffile import TiffFile, TiffWriter, imwrite, COMPRESSION
+
+from pystack3d_napari.cache import SLICE_CACHE
+from pystack3d_napari.index import get_slice_index
+from pystack3d_napari.pyramid import PYRAMID_DIRNAME
+from pystack3d_napari.proxy import PROXY_DIRNAME
+from pystack3d_napari.fusion import is_saved, get_input_step, RELEASED_NAME
+
+# tiff compressions (tifffile names), 'zstd' requiring the 'imagecodecs' package
+COMPRESSIONS = {'none': None, 'deflate': 'zlib', 'zstd': 'zstd', 'lzma': 'lzma'}
+TIFF_TAGS = {'deflate': COMPRESSION.ADOBE_DEFLATE, 'zstd': COMPRESSION.ZSTD,
+             'lzma': COMPRESSION.LZMA}
+COMPRESSION_LEVELS = {'deflate': (0, 9), 'zstd': (1, 22), 'lzma': (0, 9)}  # (min, max)
+
+
+@lru_cache()
+def is_compression_available(compression):
+    """ Return True if tifffile can encode 'compression' in the current environment """
+    if COMPRESSIONS.get(compression) is None:
+        return compression == 'none'
+    try:
+        imwrite(io.BytesIO(), np.zeros((8, 8), dtype=np.uint8),
+                compression=COMPRESSIONS[compression])
+        return True
+    except Exception:  # codec not installed
+        return False
+
+
+def clamp_level(compression, level):
+    """ Return 'level' clamped to the range accepted by the 'compression' codec """
+    if level is None or compression not in COMPRESSION_LEVELS:
+        return level
+    level_min, level_max = COMPRESSION_LEVELS[compression]
+    return min(max(int(level), level_min), level_max)
+
+
+def compress_tiff(fname, compression, level=None):
+    """ Rewrite 'fname' with 'compression' (metadata preserved). Return the (old, new) sizes """
+    from pystack3d.utils import get_tags
+
+    nbytes = os.path.getsize(fname)
+    with TiffFile(fname) as fid:
+        if fid.pages[0].compression == TIFF_TAGS[compression]:
+            return nbytes, nbytes  # (written compressed by a step fed with compressed slices)
+        _, extra_tags = get_tags(fid)
+        arr = fid.asarray()
+    fname_tmp = str(fname) + ".tmp"  # (not listed as a slice by the index)
+    level = clamp_level(compression, level)
+    with TiffWriter(fname_tmp) as fid:
+        fid.write(arr, extratags=extra_tags, compression=COMPRESSIONS[compression],
+                  compressionargs=None if level is None else {'level': level})
+    os.replace(fname_tmp, fname)
+    return nbytes, os.path.getsize(fname)
+
+
+def compress_step(project_dir, process_name, channels, compression, level=None, nthreads=None):
+    """ Compress the tiff slices of 'process_name'. Return the (old, new) total sizes """
+    if COMPRESSIONS.get(compression) is None:
+        return 0, 0
+    if not is_compression_available(compression):
+        raise ImportError(f"'{compression}' compression requires the 'imagecodecs' package")
+    fnames = []
+    for channel in channels:
+        fnames += get_slice_index(Path(project_dir) / 'process' / process_name / channel).fnames()
+    with ThreadPoolExecutor(nthreads or min(8, os.cpu_count())) as executor:
+        sizes = list(executor.map(lambda fname: compress_tiff(fname, compression, level),
+                                  fnames))
+    return sum(size[0] for size in sizes), sum(size[1] for size in sizes)
+
+
+def get_steps_to_release(policy, project_dir, channels, history, pending=(), nkeep=1):
+    """
+    Return the steps of 'history' whose images can be released according to 'policy', the
+    inputs of the 'pending' steps (to be run next, in this order) being kept
+    """
+    if policy not in ('consumed', 'final', 'last'):
+        return []
+    image_steps = [name for name in history if name != 'registration_calculation'
+                   and is_saved(project_dir, channels, name)]
+    needed = set()
+    history_ = list(history)
+    for process_name in pending:
+        if process_name not in history_:
+            needed.add(get_input_step(history_, process_name))
+            history_.append(process_name)
+
+    if policy == 'consumed':
+        consumed = {get_input_step(history, name) for name in history}
+        candidates = [name for name in image_steps[:-1] if name in consumed]
+    elif policy == 'final':
+        candidates = image_steps[:-1]
+    else:
+        candidates = image_steps[:-max(int(nkeep), 1)]
+    return [name for name in candidates if name not in needed]
+
+
+def drop_references(dir_process):
+    """
+    Drop the cached slices of 'dir_process' and collect the unreachable arrays (of the removed
+    layers) still mapping its files, a mapped file not being deletable on Windows
+    """
+    SLICE_CACHE.invalidate(dir_process)
+    gc.collect()
+
+
+def release_step(project_dir, process_name, channels, policy=None):
+    """
+    Delete the images (and related pyramids and proxies) of 'process_name', the step being
+    kept in the history with its 'outputs', fingerprint and zarr stores.
+    Return the number of bytes freed
+    """
+    dir_process = Path(project_dir) / 'process' / process_name
+    drop_references(dir_process)
+    nbytes = 0
+    for channel in channels:
+        dirname = dir_process / channel
+        if not dirname.is_dir():
+            continue
+        with os.scandir(dirname) as it:
+            for entry in it:
+                if entry.name.endswith('.tif') and entry.is_file():
+                    nbytes += entry.stat().st_size
+                    os.remove(entry.path)
+        for name in [PYRAMID_DIRNAME, PROXY_DIRNAME]:
+            shutil.rmtree(dirname / name, ignore_errors=True)
+    infos = {'time': time.time(), 'policy': policy, 'nbytes': nbytes}
+    (dir_process / RELEASED_NAME).write_text(json.dumps(infos), encoding='utf-8')
+    return nbytes
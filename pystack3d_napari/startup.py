@@ -0,0 +1,106 @@
+"""
+Startup benchmark of the GUI: time-to-interactive of the 'pystack3d' launcher (from the
+interpreter start to the first event loop iteration with the dock widget shown) compared to
+napari alone, each launch being done in a fresh interpreter
+"""
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+from pathlib import Path
+
+PHASES = ['import', 'window', 'interactive']
+MARKER = "PYSTACK3D_STARTUP "
+
+# launch measured in a child interpreter ('mode': 'napari' or 'pystack3d')
+PROBE = """
+import sys, time, json
+import napari
+if sys.argv[1] == 'pystack3d':
+    from pystack3d_napari.main import create_viewer
+times = {'import': time.time()}
+viewer = napari.Viewer() if sys.argv[1] == 'napari' else create_viewer()
+times['window'] = time.time()
+
+def interactive():
+    times['interactive'] = time.time()
+    times['packages'] = sorted({name.split('.')[0] for name in sys.modules})
+    viewer.close()
+    from qtpy.QtWidgets import QApplication
+    QApplication.instance().quit()
+
+from qtpy.QtCore import QTimer
+QTimer.singleShot(0, interactive)
+napari.run()
+print("%s" + json.dumps(times), flush=True)
+""" % MARKER
+
+
+def measure(mode, timeout=300):
+    """ Return the phases durations (s) of a launch in 'mode' and the imported packages """
+    env = dict(os.environ)
+    if sys.platform.startswith('linux') and not (env.get('DISPLAY') or
+                                                 env.get('WAYLAND_DISPLAY')):
+        env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    t0 = time.time()
+    proc = subprocess.run([sys.executable, "-c", PROBE, mode], env=env, capture_output=True,
+                          text=True, timeout=timeout)
+    lines = [line for line in proc.stdout.splitlines() if line.startswith(MARKER)]
+    if proc.returncode != 0 or len(lines) == 0:
+        raise RuntimeError(f"'{mode}' launch failed:\n{proc.stderr[-2000:]}")
+    times = json.loads(lines[-1][len(MARKER):])
+    return {phase: times[phase] - t0 for phase in PHASES}, times['packages']
+
+
+def run_startup(nruns=3, stream=None):
+    """ Return the median phases durations of 'nruns' launches of napari and pystack3d """
+    stream = stream or sys.stdout
+    results = {}
+    packages = {}
+    for mode in ['napari', 'pystack3d']:
+        runs = []
+        for _ in range(nruns):
+            durations, packages[mode] = measure(mode)
+            runs.append(durations)
+        results[mode] = {phase: statistics.median(run[phase] for run in runs)
+                         for phase in PHASES}
+        results[mode]['runs'] = runs
+        print(format_result(mode, results[mode], results.get('napari')), file=stream,
+              flush=True)
+    results['overhead'] = results['pystack3d']['interactive'] - \
+        results['napari']['interactive']
+    results['packages'] = sorted(set(packages['pystack3d']) - set(packages['napari']))
+    return {'config': {'nruns': nruns, 'python': sys.version.split()[0],
+                       'platform': platform.platform()},
+            'time': time.time(), **results}
+
+
+def format_result(mode, result, result_ref=None):
+    line = f"{mode:12}" + "".join(f"{phase} {result[phase]:6.2f} s  " for phase in PHASES)
+    if result_ref is not None and mode != 'napari':
+        line += f"(+{result['interactive'] - result_ref['interactive']:.2f} s)"
+    return line.rstrip()
+
+
+def bench_startup(nruns=3, budget=None, fname_output=None, stream=None):
+    """
+    Command line entry point. Return the exit code (1 if the pystack3d time-to-interactive
+    exceeds 'budget', in seconds)
+    """
+    stream = stream or sys.stdout
+    results = run_startup(nruns=nruns, stream=stream)
+    print(f"packages imported at startup besides napari ones: "
+          f"{', '.join(results['packages']) or '-'}", file=stream)
+    if fname_output:
+        Path(fname_output).write_text(json.dumps(results, indent=2), encoding='utf-8')
+    tti = results['pystack3d']['interactive']
+    if budget is None:
+        return 0
+    if tti > budget:
+        print(f"OVER BUDGET: time-to-interactive {tti:.2f} s > {budget:.2f} s", file=stream)
+        return 1
+    print(f"time-to-interactive {tti:.2f} s within budget ({budget:.2f} s)", file=stream)
+    return 0
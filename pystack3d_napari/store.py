@@ -0,0 +1,230 @@
+"""
+Chunked and compressed (OME-)Zarr stores of the step results, exported from the tiff slices
+of a channel directory (which stay the step outputs read by the following steps) and read
+natively (without directory scan) by 'get_layers'
+"""
+import os
+import shutil
+from pathlib import Path
+from functools import lru_cache
+from importlib.util import find_spec
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pystack3d_napari.reader import TiffStack
+from pystack3d_napari.index import get_slice_index
+from pystack3d_napari.pyramid import get_signature, get_levels_shapes, bin2
+
+STORE_NAME = "stack.zarr"
+CODECS = ["blosc-zstd", "blosc-lz4", "zstd", "none"]
+DEFAULT_OUTPUT = {'format': 'tiff', 'chunks': [1, 1024, 1024], 'codec': 'blosc-zstd',
+                  'level': 5, 'compression': 'none', 'compression_level': 6}
+
+
+@lru_cache()
+def has_zarr():
+    """ Return True if 'zarr' is installed (imported at first use, not at startup) """
+    return find_spec('zarr') is not None
+
+
+def is_zarr_v3():
+    import zarr
+
+    return int(zarr.__version__.split('.')[0]) >= 3
+
+
+def get_compressor(codec, level):
+    import numcodecs
+
+    if codec == 'none':
+        return None
+    if codec == 'zstd':
+        return numcodecs.Zstd(level=level)
+    if codec.startswith('blosc-'):
+        return numcodecs.Blosc(cname=codec[6:], clevel=level,
+                               shuffle=numcodecs.Blosc.BITSHUFFLE)
+    raise ValueError(f"unknown codec '{codec}' (possible values: {CODECS})")
+
+
+def create_array(group, name, shape, chunks, dtype, compressor):
+    if is_zarr_v3():
+        return group.create_array(name, shape=shape, chunks=chunks, dtype=dtype,
+                                  compressors=compressor, fill_value=0)
+    return group.create_dataset(name, shape=shape, chunks=chunks, dtype=dtype,
+                                compressor=compressor, fill_value=0)
+
+
+def get_multiscales(nlevels, first_level=0):
+    """ Return the OME-Zarr (v0.4) 'multiscales' metadata of the 2x-binned (y, x) levels """
+    axes = [{'name': name, 'type': 'space'} for name in "zyx"]
+    datasets = [{'path': str(k),
+                 'coordinateTransformations': [{'type': 'scale',
+                                                'scale': [1, 2 ** (k + first_level),
+                                                          2 ** (k + first_level)]}]}
+                for k in range(nlevels)]
+    return [{'version': '0.4', 'axes': axes, 'datasets': datasets}]
+
+
+def write_levels(fname, tiff_stack, nlevels, chunks, compressor, attrs, first_level=0,
+                 nthreads=None):
+    """
+    Write the 'nlevels' 2x-binned levels of 'tiff_stack' from 'first_level' (0 for the full
+    resolution) in the OME-Zarr group 'fname', written aside and renamed once complete
+    """
+    import zarr
+
+    fname = Path(fname)
+    fname_tmp = fname.with_name(fname.name + ".tmp")
+    shutil.rmtree(fname_tmp, ignore_errors=True)
+    kwargs = {'zarr_format': 2} if is_zarr_v3() else {}  # OME-Zarr v0.4
+    group = zarr.open_group(str(fname_tmp), mode='w', **kwargs)
+    dtype = tiff_stack.dtype
+    shapes = [tiff_stack.slice_shape] + get_levels_shapes(tiff_stack.slice_shape)
+    shapes = shapes[first_level:first_level + nlevels]
+    levels = [create_array(group, str(k), (len(tiff_stack),) + shape_k,
+                           [chunks[0], min(chunks[1], shape_k[0]), min(chunks[2], shape_k[1])],
+                           dtype, compressor)
+              for k, shape_k in enumerate(shapes)]
+
+    def write_block(z0):
+        # the blocks are aligned on the z-chunks: no concurrent writes in a same chunk
+        imgs = [np.asarray(tiff_stack.read(k)) for k in range(z0, min(z0 + chunks[0],
+                                                                      len(tiff_stack)))]
+        for _ in range(first_level):
+            imgs = [bin2(img) for img in imgs]
+        for k, level in enumerate(levels):
+            if k > 0:
+                imgs = [bin2(img) for img in imgs]
+            block = np.asarray(imgs)
+            if first_level + k > 0 and dtype.kind != 'f':
+                block = np.rint(block)
+            level[z0:z0 + len(imgs)] = block.astype(dtype, copy=False)
+
+    with ThreadPoolExecutor(nthreads or min(8, os.cpu_count())) as executor:
+        list(executor.map(write_block, range(0, len(tiff_stack), chunks[0])))
+
+    group.attrs['multiscales'] = get_multiscales(len(levels), first_level=first_level)
+    group.attrs['pystack3d'] = attrs
+    shutil.rmtree(fname, ignore_errors=True)
+    os.replace(fname_tmp, fname)
+    return fname
+
+
+def write_store(dirname, chunks=None, codec='blosc-zstd', level=5, nthreads=None):
+    """
+    Write the tiff slices of 'dirname' (and their 2x-binned levels) in 'dirname/stack.zarr'.
+    Return the store path or None if 'dirname' has no tiff slices
+    """
+    if not has_zarr():
+        raise ImportError("The 'zarr' package is required to write zarr outputs")
+
+    index = get_slice_index(dirname)
+    if len(index) == 0:
+        return None
+    shape, dtype = index.shape_dtype()
+    tiff_stack = TiffStack(index.fnames(), shape=shape, dtype=dtype, infos=index.infos(),
+                           cache=None)
+    chunks = [min(int(c), n) for c, n in zip(chunks or DEFAULT_OUTPUT['chunks'],
+                                              tiff_stack.shape)]
+    attrs = {'signature': get_signature(index), 'names': index.names,
+             'codec': codec, 'level': level}
+    return write_levels(Path(dirname) / STORE_NAME, tiff_stack,
+                        1 + len(get_levels_shapes(shape)), chunks,
+                        get_compressor(codec, level), attrs, nthreads=nthreads)
+
+
+def write_step_stores(project_dir, process_name, channels, output):
+    """ Export the tiff slices of the channels of 'process_name' according to 'output' """
+    fnames = []
+    for channel in channels:
+        fname = write_store(Path(project_dir) / 'process' / process_name / channel,
+                            chunks=output.get('chunks'), codec=output.get('codec', 'blosc-zstd'),
+                            level=output.get('level', 5))
+        if fname is not None:
+            fnames.append(fname)
+    return fnames
+
+
+class ZarrStack:
+    """ Array-like stack of slices (and binned levels) stored in a zarr store """
+
+    def __init__(self, fname, ind_min=0, ind_max=None):
+        import zarr
+
+        self.fname = Path(fname)
+        self.group = zarr.open_group(str(fname), mode='r')
+        attrs = self.group.attrs.asdict()
+        paths = [dataset['path'] for dataset in attrs['multiscales'][0]['datasets']]
+        self.arrays = [self.group[path] for path in paths]
+        nz = self.arrays[0].shape[0]
+        self.zslice = slice(min(ind_min, nz), min(nz, nz if ind_max is None else ind_max + 1))
+        self.fnames = [str(self.fname)]  # ('proxy' folder located beside the store)
+        self.infos = [{'signature': attrs['pystack3d']['signature'],
+                       'range': [self.zslice.start, self.zslice.stop]}]
+        self.cache = None  # (decompressed chunks not shared with the tiff slices cache)
+        self.slice_shape = tuple(self.arrays[0].shape[1:])
+        self.dtype = np.dtype(self.arrays[0].dtype)
+
+    @property
+    def shape(self):
+        return (self.zslice.stop - self.zslice.start,) + self.slice_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def is_memmappable(self, ind):
+        return False
+
+    def read(self, ind):
+        return self.arrays[0][self.zslice.start + ind]
+
+    def to_dask(self, level=0):
+        """ Return the (zero-copy, chunked as the store) dask array of 'level' """
+        import dask.array as da
+
+        return da.from_zarr(self.arrays[level])[self.zslice]
+
+    def levels(self):
+        return [self.to_dask(level) for level in range(len(self.arrays))]
+
+
+def open_store(dirname, index=None, ind_min=0, ind_max=None):
+    """
+    Return the ZarrStack of 'dirname' if any, None otherwise. With the 'index' of the tiff
+    slices, the store is returned only if it is consistent with them (or if they have been
+    removed). Without 'index', the slices are not scanned, the stores of the steps being
+    removed with their tiff slices when the steps are re-run
+    """
+    fname = Path(dirname) / STORE_NAME
+    if not has_zarr() or not fname.is_dir():
+        return None
+    try:
+        stack = ZarrStack(fname, ind_min=ind_min, ind_max=ind_max)
+    except Exception:  # store being written or not written by 'write_store'
+        return None
+    if index is not None and len(index) > 0 \
+            and stack.infos[0]['signature'] != get_signature(index):
+        return None  # outdated (the step has been re-run)
+    return stack
+
+
+def convert(dirname, chunks=None, codec='blosc-zstd', level=5):
+    """ Write the zarr stores of all the directories of tiff slices found in 'dirname' """
+    fnames = []
+    for root, dirs, files in os.walk(dirname):
+        dirs[:] = sorted(name for name in dirs
+                         if not name.startswith('.') and not name.endswith('.zarr'))
+        if any(name.endswith('.tif') for name in files):
+            fname = write_store(root, chunks=chunks, codec=codec, level=level)
+            if fname is not None:
+                fnames.append(fname)
+    return fnames
@@ -4,10 +4,7 @@ import ast
 import time
 import queue
 import numpy as np
-from tifffile import imread
 import psutil
-import dask.array as da
-import dask
 
 
 def hsorted(list_):
@@ -47,20 +44,29 @@ def update_widgets_params(data, init_widget, process_container):
         if key == 'process_steps':
             process_container.reorder_widgets(value)
 
-    # update 'process'_widget parameters
+    # update 'process'_widget parameters (when built, see 'CollapsibleSection.build')
     for section in process_container.widgets():
-        section_name = section.process_name
-        widget = section.widget
-        if section_name in data:
-            section_data = data[section_name]
-            for key, value in section_data.items():
-                try:
-                    attr = getattr(widget, key)
-                    attr.value = value
-                    if key == "filters" and hasattr(widget, "_filters_widget"):
-                        widget._filters_widget.set_filters(value)
-                except Exception as e:
-                    print(f"[{section_name}] Error with '{key}': {e}")
+        if section.is_built:
+            update_section_params(section, data)
+        else:
+            section.pending_params = data
+
+
+def update_section_params(section, data):
+    section_name = section.process_name
+    widget = section.widget
+    if section_name in data:
+        section_data = data[section_name]
+        for key, value in section_data.items():
+            try:
+                attr = getattr(widget, key)
+                attr.value = value
+                if key == "filters" and hasattr(widget, "_filters_widget"):
+                    widget._filters_widget.set_filters(value)
+            except Exception as e:
+                print(f"[{section_name}] Error with '{key}': {e}")
+    if section.output_settings is not None:
+        section.output_settings.set(data.get('outputs', {}).get(section_name, {}))
 
 
 def get_params(widget, keep_null_string=True):
@@ -77,57 +83,180 @@ def get_params(widget, keep_null_string=True):
     return params
 
 
-def get_layers(dirname, channels, ind_min=0, ind_max=99999, is_init=False):
+def get_layers(dirname, channels, ind_min=0, ind_max=99999, is_init=False,
+               chunk_size=None, chunk_bytes=None, multiscale=False):
+    from pystack3d_napari.reader import TiffStack, CHUNK_BYTES
+    from pystack3d_napari.index import get_slice_index
+    from pystack3d_napari.pyramid import get_pyramid, PYRAMID_MIN_SIZE
+    from pystack3d_napari.store import open_store
+
+    chunk_bytes = chunk_bytes or CHUNK_BYTES
     layers = []
     for channel in channels:
-        channel_dir = dirname / channel
-        fnames = hsorted(channel_dir.glob("*.tif"))[ind_min:ind_max + 1]
         name_process = dirname.name.upper() + (len(channels) > 1) * f" ({channel})"
+        # exported store opened first, without scanning the tiff slices
+        zarr_stack = open_store(dirname / channel, ind_min=ind_min, ind_max=ind_max)
+        if zarr_stack is not None and len(zarr_stack) > 0:  # 1 metadata read, zero-copy
+            name = channel if is_init else name_process
+            kwargs = {"name": name, "metadata": {"tiff_stack": zarr_stack}}
+            stack = zarr_stack.to_dask()
+            if multiscale and len(zarr_stack.arrays) > 1:
+                stack = zarr_stack.levels()
+                kwargs["multiscale"] = True
+            layers.append(((stack, kwargs, "image")))
+            continue
+        index = get_slice_index(dirname / channel)
+        fnames = index.fnames(ind_min, ind_max)
         if len(fnames) > 0:
-            img0 = imread(fnames[0])
-            lazy_arrays = [da.from_delayed(dask.delayed(imread)(str(fname)),
-                                           shape=img0.shape, dtype=img0.dtype) for fname in fnames]
-            stack = da.stack(lazy_arrays, axis=0)
+            shape, dtype = index.shape_dtype(ind_min)
+            tiff_stack = TiffStack(fnames, shape=shape, dtype=dtype,
+                                   infos=index.infos(ind_min, ind_max))
+            stack = tiff_stack.to_dask(chunk_size=chunk_size, chunk_bytes=chunk_bytes)
             name = channel if is_init else name_process
-            layers.append(((stack, {"name": name}, "image")))
+            kwargs = {"name": name, "metadata": {"tiff_stack": tiff_stack}}
+            if multiscale and max(shape) >= PYRAMID_MIN_SIZE:
+                levels = get_pyramid(index)  # None while being built in background
+                if levels is not None:
+                    stack = [stack] + [level[ind_min:ind_max + 1] for level in levels]
+                    kwargs["multiscale"] = True
+            layers.append(((stack, kwargs, "image")))
 
     return layers
 
 
-def update_progress(nchannels, nproc, queue_incr, pbar_signal, stop_event=None):
-    count = 0
-    finished = 0
-    ntot = None  # set by the 1rst emit via queue_incr in stack.eval()
-    channel = 1
-    while True:
+def get_input_dirname(project_dir, history, process_name):
+    """ Return the directory of the images to be processed by 'process_name' """
+    if process_name in history:
+        history = history[:history.index(process_name)]
+    history = [name for name in history if name != 'registration_calculation']  # no images
+    return project_dir / 'process' / history[-1] if history else project_dir
+
+
+def get_slice_nbytes(dirname, channels):
+    from pystack3d_napari.index import get_slice_index
+
+    index = get_slice_index(dirname / channels[0])
+    if len(index) == 0:
+        return 0
+    shape, dtype = index.shape_dtype()
+    return int(np.prod(shape)) * dtype.itemsize
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+class ProgressStats:
+    """ Slices counts, throughputs and ETA, per channel and overall """
+
+    def __init__(self, nchannels, slice_nbytes=0):
+        self.nchannels = nchannels
+        self.slice_nbytes = slice_nbytes
+        self.t0 = time.perf_counter()
+        self.counts = [0] * nchannels
+        self.ntots = [None] * nchannels
+        self.t0s = [None] * nchannels
+        self.t1s = [None] * nchannels
+
+    def set_ntot(self, channel, ntot):
+        self.ntots[channel] = ntot
+        self.t0s[channel] = time.perf_counter()
+
+    def add(self, channel, count):
+        self.counts[channel] += count
+
+    def finish(self, channel):
+        self.t1s[channel] = time.perf_counter()
+
+    def percent(self):
+        ntot = next((ntot for ntot in self.ntots if ntot), None)
+        if ntot is None:
+            return 0
+        ntot_all = sum(ntot if ntot_ is None else ntot_ for ntot_ in self.ntots)
+        return int(100 * sum(self.counts) / ntot_all)
+
+    def as_dict(self):
+        now = time.perf_counter()
+        elapsed = now - self.t0
+        count = sum(self.counts)
+        rate = count / elapsed if elapsed > 0 else 0.
+        channels = []
+        for count_, ntot, t0, t1 in zip(self.counts, self.ntots, self.t0s, self.t1s):
+            duration = None if t0 is None else (t1 or now) - t0
+            rate_ = count_ / duration if duration else 0.
+            channels.append({'count': count_, 'ntot': ntot, 'slices/s': rate_})
+        ntot = next((ntot for ntot in self.ntots if ntot), None)
+        eta = None
+        if ntot and rate > 0:
+            remaining = sum(ntot if ntot_ is None else ntot_ for ntot_ in self.ntots) - count
+            eta = max(remaining, 0) / rate
+        return {'percent': self.percent(), 'count': count, 'elapsed': elapsed, 'eta': eta,
+                'slices/s': rate, 'MB/s': rate * self.slice_nbytes / 2 ** 20,
+                'channels': channels}
+
+
+def update_progress(nchannels, nproc, queue_incr, pbar_signal, stop_event=None,
+                    stats_signal=None, slice_nbytes=0, interval=0.25):
+    """ Collect the slices increments sent by the workers and emit rate-limited updates """
+    stats = ProgressStats(nchannels, slice_nbytes)
+    finished = [0] * nchannels
+    ntots = [None] * nchannels  # set by the 1rst emit via queue_incr in stack.eval()
+    nchannels_done = 0
+    last_emit = 0.
+    done = False
+    while not done:
         if stop_event is not None and stop_event.is_set():
             break
+        vals = []
         try:
-            val = queue_incr.get_nowait()
+            vals.append(queue_incr.get(timeout=0.1))
+            while True:  # coalesce the pending increments
+                vals.append(queue_incr.get_nowait())
+        except queue.Empty:
+            pass
+        for val in vals:
+            # (channel index, value) from 'eval_fused', possibly for concurrent channels,
+            # values of the channels processed one after another from 'stack.eval()'
+            channel, val = val if isinstance(val, tuple) else (nchannels_done, val)
             if val == "finished":
-                finished += 1
+                finished[channel] += 1
+            elif ntots[channel] is not None:
+                stats.add(channel, val)
             else:
-                if ntot:
-                    count += val
-                    pbar_signal.emit(int(100 * count / (nchannels * ntot)))
-                else:
-                    ntot = val
-            if finished == nproc:
-                channel += 1
-                if channel <= nchannels:
-                    finished = 0
-                    ntot = None  # continue with the next channel
-                else:
+                ntots[channel] = val
+                stats.set_ntot(channel, val)
+            if finished[channel] == nproc:
+                stats.finish(channel)
+                nchannels_done += 1
+                if nchannels_done == nchannels:
+                    done = True
                     break
-        except queue.Empty:
-            time.sleep(0.01)
+
+        now = time.perf_counter()
+        if done or now - last_emit > interval:
+            last_emit = now
+            pbar_signal.emit(stats.percent())
+            if stats_signal is not None:
+                stats_signal.emit(stats.as_dict())
 
 
-def get_disk_info():
-    usage = shutil.disk_usage(".")
+def get_disk_info(dirname="."):
+    """ Return the (total, used, free) bytes of the filesystem hosting 'dirname' """
+    usage = shutil.disk_usage(dirname)
     return usage.total, usage.used, usage.free
 
 
 def get_ram_info():
     mem = psutil.virtual_memory()
     return mem.total, mem.used, mem.available
+
+
+def get_cache_info():
+    from pystack3d_napari.cache import SLICE_CACHE
+
+    stats = SLICE_CACHE.stats()
+    return stats['max_bytes'], stats['nbytes'], stats['max_bytes'] - stats['nbytes']
@@ -3,22 +3,27 @@ import warnings
 from pathlib import Path
 import shutil
 import ast
+import time
+from functools import lru_cache
+from contextlib import nullcontext
 from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from tomlkit import dumps, parse
 import napari
 from napari.utils.transforms import Affine
 
 from qtpy.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QCheckBox,
                             QFrame, QProgressBar, QTableWidget, QTableWidgetItem, QFileDialog,
-                            QMessageBox, QDialog)
+                            QMessageBox, QDialog, QLineEdit, QComboBox, QSpinBox)
 from qtpy.QtCore import Qt, QMimeData, QSize, Signal, QTimer, QObject, QEvent
 from qtpy.QtGui import QDrag, QIcon
 
-from pystack3d.utils import reformat_params, dumps_params
-
 from pystack3d_napari.utils import get_layers, convert_params, update_progress, get_params
-from pystack3d_napari.utils import get_disk_info, get_ram_info, update_widgets_params
+from pystack3d_napari.utils import get_input_dirname, get_slice_nbytes, format_duration
+from pystack3d_napari.utils import get_disk_info, get_ram_info, get_cache_info
+from pystack3d_napari.utils import update_widgets_params, update_section_params
+from pystack3d_napari.cache import SLICE_CACHE
+from pystack3d_napari.prefetch import PREFETCHER
 from pystack3d_napari import KWARGS_RENDERING, FILTER_DEFAULT
 
 DIR_ICONS = Path(__file__).parent / 'resources' / 'icons'
@@ -30,29 +35,39 @@ warnings.filterwarnings("ignore", message=msg)
 warnings.filterwarnings("ignore", category=UserWarning)
 
 
+@lru_cache()
 def get_napari_icon(icon_name):
     path = Path(os.path.dirname(napari.__file__)) / 'resources' / 'icons' / f'{icon_name}.svg'
     icon = QIcon(str(path))
     return QIcon(icon.pixmap(QSize(24, 24), QIcon.Disabled))
 
 
-def add_layers(dirname, channels, ind_min=0, ind_max=99999, is_init=False):
-    layers = get_layers(dirname, channels, ind_min=ind_min, ind_max=ind_max, is_init=is_init)
+@lru_cache()
+def get_icon(icon_name):
+    return QIcon(str(DIR_ICONS / f"{icon_name}.svg"))
+
+
+def add_layers(dirname, channels, ind_min=0, ind_max=99999, is_init=False, multiscale=False):
+    layers = get_layers(dirname, channels, ind_min=ind_min, ind_max=ind_max, is_init=is_init,
+                        multiscale=multiscale)
     viewer = napari.current_viewer()
+    PREFETCHER.connect(viewer)
     for data, kwargs, layer_type in layers:
         getattr(viewer, f"add_{layer_type}")(data, **kwargs, **KWARGS_RENDERING)
 
 
 def remove_layers(dirname, channels, is_init=False):
+    """ Remove the layers of 'dirname' and the proxies derived from them """
     viewer = napari.current_viewer()
-    layers_names = [layer.name for layer in viewer.layers]
+    PREFETCHER.cancel()
     for channel in channels:
         if is_init:
             layer_name = channel
         else:
             layer_name = Path(dirname).name.upper() + (len(channels) > 1) * f" ({channel})"
-        if layer_name in layers_names:
-            viewer.layers.remove(layer_name)
+        for layer in list(viewer.layers):
+            if layer.name == layer_name or layer.metadata.get('source') == layer_name:
+                viewer.layers.remove(layer)
 
 
 def size(layers):
@@ -62,6 +77,8 @@ def size(layers):
             data = layer.data
         elif isinstance(layer, list) and isinstance(layer[0], tuple):
             data = layer[0][0]
+        elif isinstance(layer, tuple):  # (data, kwargs, layer_type) as returned by get_layers
+            data = layer[0]
         else:
             continue
 
@@ -79,11 +96,7 @@ def change_ndisplay(state):
     enabled = (state == Qt.Checked)
     viewer = napari.current_viewer()
     viewer.window._qt_viewer.viewerButtons.ndisplayButton.setEnabled(enabled)
-    if enabled:
-        msg = "Displaying large datasets in 3D may crash your system.\n" \
-              "Think to check your available RAM !"
-        QMessageBox.warning(viewer.window._qt_window, "3D View Enabled", msg)
-    else:
+    if not enabled:
         viewer.dims.ndisplay = 2
 
 
@@ -123,19 +136,37 @@ class CompactLayouts:
 class CollapsibleSection(QFrame):
     toggled = Signal(object)
     pbar_signal = Signal(int)
+    stats_signal = Signal(dict)
+    nproc_signal = Signal(str)
+    warning_signal = Signal(str)
+    live_signal = Signal()
 
-    def __init__(self, parent, process_name: str, widget):
+    def __init__(self, parent, process_name: str, widget_factory, panels=()):
         super().__init__()
         self.parent = parent
         self.process_name = process_name
-        self.widget = widget
+        self.widget_factory = widget_factory
+        self.panels = panels  # classes of the widgets added under the process widget
+        self.pending_params = None  # loaded parameters to apply once the content is built
+        self._widget = None
         self.is_open = False
+        self.fused_sections = []
+        self.nproc_info = ""  # explanation of the automatic nproc choice
+        self.profile_panel = None
+        self.output_settings = None
+        self.live_layers = []  # result layers growing during the run
+        self._live_count = 0
+        self._governor = None
         self._threads = []
 
         self.setAcceptDrops(True)
         self.setObjectName(process_name)
 
         self.pbar_signal.connect(self.update_progress_bar)
+        self.stats_signal.connect(self.update_stats)
+        self.nproc_signal.connect(self.update_nproc_info)
+        self.warning_signal.connect(show_warning)
+        self.live_signal.connect(self.close_live_layers)
 
         self.setFrameStyle(QFrame.NoFrame)
         self.setLineWidth(2)
@@ -158,17 +189,25 @@ class CollapsibleSection(QFrame):
         self.checkbox.stateChanged.connect(self.toggle_content_enabled)
 
         self.run_button = QPushButton()
-        self.run_button.setIcon(QIcon(str(DIR_ICONS / "play.svg")))
+        self.run_button.setIcon(get_icon("play"))
         self.run_button.setToolTip("Run")
         self.run_button.clicked.connect(self.run)
 
+        self.resume_button = QPushButton()
+        self.resume_button.setIcon(get_napari_icon("step_right"))
+        self.resume_button.setToolTip("Resume an interrupted run (only the missing slices are "
+                                      "processed for slice-local steps with unchanged "
+                                      "parameters)")
+        self.resume_button.clicked.connect(lambda: self.run(resume=True))
+
         self.stop_button = QPushButton()
-        self.stop_button.setIcon(QIcon(str(DIR_ICONS / "stop.svg")))
+        self.stop_button.setIcon(get_icon("stop"))
         self.stop_button.setToolTip("Stop")
         self.stop_button.clicked.connect(self.stop)
 
         self.progress_bar = QProgressBar()
         self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("%p%")
 
         self._run_lock = Lock()
         self._stop_event = Event()
@@ -195,6 +234,7 @@ class CollapsibleSection(QFrame):
         header_layout2 = QHBoxLayout()
         header_layout2.addWidget(self.checkbox)
         header_layout2.addWidget(self.run_button)
+        header_layout2.addWidget(self.resume_button)
         header_layout2.addWidget(self.stop_button)
         header_layout2.addWidget(self.progress_bar)
         header_layout2.addWidget(show_button)
@@ -205,8 +245,38 @@ class CollapsibleSection(QFrame):
         self.main_layout.addWidget(self.content)
         self.main_layout.addLayout(header_layout2)
 
+    @property
+    def widget(self):
+        """ Process widget (magicgui), the section content being built at first access """
+        if self._widget is None:
+            self.build()
+        return self._widget
+
+    @property
+    def is_built(self):
+        return self._widget is not None
+
+    def build(self):
+        """
+        Build the section content (process widget and panels), deferred to the first expansion
+        or parameters access to keep the plugin startup short
+        """
+        if self._widget is not None:
+            return
+        self._widget = self.widget_factory()
+        self._widget._parent = self.parent
+        self.add_widget(self._widget.native)
+        for panel in self.panels:
+            self.add_widget(panel(self))
+        if self.pending_params is not None:
+            update_section_params(self, self.pending_params)
+            self.pending_params = None
+        self.parent.process_container.set_cropping_area()
+
     def toggle(self):
         self.is_open = not self.is_open
+        if self.is_open:
+            self.build()
         self.content.setVisible(self.is_open)
         self.toggle_button.setText("▼" if self.is_open else "►")
         if self.is_open:
@@ -219,11 +289,20 @@ class CollapsibleSection(QFrame):
         enabled = (state == Qt.Checked)
         self.content.setEnabled(enabled)
         self.run_button.setEnabled(enabled)
+        self.resume_button.setEnabled(enabled)
 
     def add_widget(self, widget):
         self.content_layout.addWidget(widget)
 
-    def run(self, callback=None):
+    def run(self, callback=None, resume=False):
+        from pystack3d_napari.autotune import auto_nproc
+        from pystack3d_napari.governor import MemoryGovernor, check_admission
+        from pystack3d_napari.monitor import MONITOR
+        from pystack3d_napari.profiling import profiling
+        from pystack3d_napari.fusion import eval_fused, get_restart_step, is_pool_run
+        from pystack3d_napari.fingerprint import (get_fingerprints, write_fingerprint,
+                                                  write_run_marker, remove_run_marker)
+
         self.stop()
 
         if self.parent.stack is None:
@@ -237,27 +316,139 @@ class CollapsibleSection(QFrame):
         progress_done = Event()
         eval_done = Event()
 
+        sections = [self] + self.fused_sections
+        self.fused_sections = []
+        resume_steps = self.parent.get_resumable_steps(self) if resume else None
+        if resume_steps is not None:  # interrupted run, possibly fused with other steps
+            sections = [self.parent.process_container.get_widget(process_name)[0]
+                        for process_name in resume_steps]
+        stack = self.parent.stack
+        restart = get_restart_step(stack.project_dir, stack.params['channels'],
+                                   stack.params['history'], sections[0].process_name)
+        if restart != sections[0].process_name and resume_steps is None:
+            self._run_lock.release()
+            self.parent._stop_all = True  # RUN ALL interrupted too
+            show_warning(f"The input images of {sections[0].process_name.upper()} were not "
+                         f"saved (fused steps) or were released (retention policy): "
+                         f"re-run from {restart.upper()}")
+            self.parent.finish_signal.emit()
+            return
+        for section in sections:
+            section.build()  # (output settings of the sections never expanded)
+        channels = stack.channels(sections[0].process_name)
+        # slices of all the channels in a single pool of workers (slice-local steps only)
+        pool_run = is_pool_run([section.process_name for section in sections], len(channels),
+                               resume=resume_steps is not None,
+                               concurrent_channels=self.parent.concurrent_channels)
+        input_dirname = get_input_dirname(stack.project_dir, stack.params['history'],
+                                          sections[0].process_name)
+        slice_nbytes = get_slice_nbytes(input_dirname, channels)
+        self.progress_bar.setFormat("%p%")
+        self.nproc_info = ""
+        run_name = "+".join(section.process_name for section in sections)
+        MONITOR.mark('start', run_name)
+        if self.parent.live_layers:
+            self.open_live_layers(sections, channels)
+        profile = self.profile_panel is not None and self.profile_panel.checkbox.isChecked()
+        outputs = {section.process_name: (section.output_settings, section.output_settings.get())
+                   for section in sections if section.output_settings is not None}
+        if profile:
+            self.profile_panel.label.setText("profiling...")
+
+        # the nproc is set by the eval thread (after calibration in 'auto' mode)
+        run_params = {'nproc': self.parent.nproc, 'chunksize': None}
+        nproc_ready = Event()
+        if not self.parent.auto_nproc:
+            nproc_ready.set()
+
         def wrapped_update_progress():
             try:
-                update_progress(nchannels=len(self.parent.stack.channels(self.process_name)),
-                                nproc=self.parent.nproc,
+                while not nproc_ready.wait(timeout=0.1):
+                    if self._stop_event.is_set():
+                        return
+                update_progress(nchannels=len(channels),
+                                nproc=run_params['nproc'],
                                 queue_incr=self.parent.stack.queue_incr,
                                 pbar_signal=self.pbar_signal,
-                                stop_event=self._stop_event)
+                                stop_event=self._stop_event,
+                                stats_signal=self.stats_signal,
+                                slice_nbytes=slice_nbytes)
             finally:
                 if not self._stop_event.is_set():
-                    self.pbar_signal.emit(100)
+                    for section in sections:
+                        section.pbar_signal.emit(100)
                 progress_done.set()
 
         def wrapped_eval():
             try:
-                params = convert_params(self.widget.asdict())
-                self.parent.stack.params[self.process_name] = params
-                self.parent.stack.params['nproc'] = self.parent.nproc
-                self.parent.stack.eval(process_steps=self.process_name,
-                                       show_pbar=False,
-                                       pbar_init=True)
+                process_names = [section.process_name for section in sections]
+                params_list = [convert_params(section.widget.asdict()) for section in sections]
+                for process_name, params in zip(process_names, params_list):
+                    self.parent.stack.params[process_name] = params
+                if not nproc_ready.is_set():
+                    self.nproc_signal.emit("calibrating...")
+                    nproc, chunksize, info = auto_nproc(self.parent.stack, process_names[0],
+                                                        params_list[0])
+                    run_params.update({'nproc': nproc, 'chunksize': chunksize})
+                    self.nproc_signal.emit(info)
+                    nproc_ready.set()
+                self.parent.stack.params['nproc'] = run_params['nproc']
+                if self.parent.governor:
+                    reason = check_admission(self.parent.stack, process_names[0],
+                                             params_list[0], run_params['nproc'])
+                    if reason is not None:
+                        self.parent._stop_all = True  # RUN ALL interrupted too
+                        self._stop_event.set()
+                        self.warning_signal.emit(f"{self.process_name.upper()} not started: "
+                                                 f"{reason}")
+                        return
+                    self._governor = MemoryGovernor(stop_event=self._stop_event,
+                                                    throttle=pool_run)
+                    self._governor.start()
+                try:
+                    history = list(self.parent.stack.params['history'])
+                    fingerprints = get_fingerprints(self.parent.stack, process_names, params_list)
+                    write_run_marker(self.parent.stack.project_dir, process_names, fingerprints)
+                    profile_results = {}
+                    with (profiling(self.parent.stack.project_dir, process_names,
+                                    profile_results) if profile else nullcontext()):
+                        if pool_run:
+                            eval_fused(self.parent.stack,
+                                       process_steps=process_names,
+                                       pbar_init=True,
+                                       stop_event=self._stop_event,
+                                       resume=resume_steps is not None,
+                                       chunksize=run_params['chunksize'],
+                                       concurrent_channels=self.parent.concurrent_channels)
+                        else:
+                            self.parent.stack.eval(process_steps=self.process_name,
+                                                   show_pbar=False,
+                                                   pbar_init=True)
+                    if profile:
+                        self.profile_panel.profile_signal.emit(
+                            profile_results.get('summary', "No profile (step not run)"))
+                    # stamp the new outputs (the steps already in the history are not re-run)
+                    for process_name, fingerprint in zip(process_names, fingerprints):
+                        if fingerprint is not None and process_name not in history \
+                                and process_name in self.parent.stack.params['history']:
+                            write_fingerprint(self.parent.stack.project_dir, process_name,
+                                              fingerprint)
+                    if all(process_name in self.parent.stack.params['history']
+                           for process_name in process_names):
+                        remove_run_marker(self.parent.stack.project_dir, process_names)
+                    for process_name, (settings, output) in outputs.items():
+                        if (output['format'] == 'zarr' or output['compression'] != 'none') \
+                                and process_name in self.parent.stack.params['history']:
+                            settings.apply(self.parent.stack, process_name, output)
+                finally:
+                    if self._governor is not None:
+                        self._governor.stop()
+                        for process_name in process_names:
+                            self._governor.write_log(self.parent.stack.project_dir / 'process' /
+                                                     process_name)
+                        self._governor = None
             finally:
+                nproc_ready.set()
                 eval_done.set()
 
         def monitor():
@@ -270,6 +461,8 @@ class CollapsibleSection(QFrame):
                     progress_done.wait(timeout=0.1)
                     eval_done.wait(timeout=0.1)
             finally:
+                MONITOR.mark('end', run_name)
+                self.live_signal.emit()
                 self._run_lock.release()
                 self.parent.finish_signal.emit()
 
@@ -288,15 +481,128 @@ class CollapsibleSection(QFrame):
             if thread.is_alive():
                 thread.join()
 
+    def set_fused(self, sections):
+        """ Evaluate the following 'sections' in memory with the current one at the next run """
+        self.fused_sections = sections
+        process_names = [section.process_name for section in [self] + sections]
+        for section in [self] + sections:
+            section.mark_fused(process_names if sections else None)
+
+    def mark_fused(self, process_names=None):
+        text, tooltip = self.process_name.upper(), ""
+        if process_names:
+            text += "  [fused]"
+            tooltip = "Evaluated in memory in a single pass: " + " > ".join(process_names)
+        self.title_label.setText(text)
+        self.title_label.setToolTip(tooltip)
+
+    def set_uptodate(self):
+        self.progress_bar.setValue(100)
+        self.progress_bar.setFormat("up to date")
+        self.progress_bar.setToolTip("Parameters, inputs and upstream steps unchanged "
+                                     "since the last run")
+
+    def update_nproc_info(self, info):
+        self.nproc_info = info
+        self.progress_bar.setFormat(info.split("\n")[0])
+        self.progress_bar.setToolTip(info)
+
     def update_progress_bar(self, percent):
         self.progress_bar.setValue(percent)
 
+    def open_live_layers(self, sections, channels):
+        """
+        Add the layers of the slices to be written by the run (last of the 'sections'),
+        refreshed at each slice completion
+        """
+        from tifffile import imread
+        from pystack3d_napari.reader import GrowingStack, get_tiff_info
+        from pystack3d_napari.fusion import get_out_shape
+
+        stack = self.parent.stack
+        process_names = [section.process_name for section in sections]
+        params = {section.process_name: convert_params(section.widget.asdict())
+                  for section in sections}
+        input_dirname = get_input_dirname(stack.project_dir, stack.params['history'],
+                                          process_names[0])
+        viewer = napari.current_viewer()
+        self.close_live_layers(show=False)
+        for process_name in process_names:  # outputs about to be overwritten
+            remove_layers(process_name, channels)
+        for channel in channels:
+            fnames = stack.fnames(input_dirname / channel)
+            if len(fnames) == 0:
+                continue
+            shape, dtype, _ = get_tiff_info(fnames[0])
+            try:
+                out_shape = get_out_shape(process_names, params, shape, stack.project_dir)
+            except Exception:  # missing 'tmats.npy', ...
+                out_shape = None
+            if out_shape is None:
+                continue
+            dirname = stack.process_dirname(process_names[-1], channel)
+            data = GrowingStack([dirname / fname.name for fname in fnames], out_shape, dtype)
+            img = imread(fnames[0])  # (placeholders excluded from the contrast limits)
+            kwargs = {'contrast_limits': (img.min(), img.max())} if img.min() < img.max() else {}
+            name = process_names[-1].upper() + (len(channels) > 1) * f" ({channel})" + " (live)"
+            self.live_layers.append(viewer.add_image(data, name=name, metadata={'live': True},
+                                                     **kwargs, **KWARGS_RENDERING))
+        self._live_count = 0
+        self._live_section = sections[-1]
+
+    def refresh_live_layers(self, stats):
+        if self.live_layers and stats['count'] != self._live_count:
+            self._live_count = stats['count']
+            for layer in self.live_layers:
+                layer.refresh()  # (only the displayed slice is read again)
+
+    def close_live_layers(self, show=True):
+        """ Replace the live layers by the regular result layers of a completed run """
+        if not self.live_layers:
+            return
+        viewer = napari.current_viewer()
+        for layer in self.live_layers:
+            if layer in viewer.layers:
+                viewer.layers.remove(layer)
+        self.live_layers = []
+        section = self._live_section
+        if show and self.parent.stack is not None \
+                and section.process_name in self.parent.stack.params['history']:
+            section.show_results()
+
+    def update_stats(self, stats):
+        self.refresh_live_layers(stats)
+        self.progress_bar.setFormat(f"%p%  {stats['slices/s']:.1f} sl/s  "
+                                    f"ETA {format_duration(stats['eta'])}")
+        tooltip = f"{self.nproc_info}\n" if self.nproc_info else ""
+        tooltip += (f"{stats['count']} slices in {format_duration(stats['elapsed'])}\n"
+                    f"{stats['slices/s']:.1f} slices/s - {stats['MB/s']:.1f} MB/s\n"
+                    f"ETA: {format_duration(stats['eta'])}")
+        governor = self._governor
+        if governor is not None and governor.suspended:
+            self.progress_bar.setFormat(self.progress_bar.format() + "  (throttled)")
+            tooltip += (f"\nmemory governor: {len(governor.suspended)} worker(s) suspended "
+                        f"(RAM > {governor.pause_percent:.0f}%)")
+        channels = self.parent.stack.channels(self.process_name) if self.parent.stack else []
+        for channel, stats_ in zip(channels, stats['channels']):
+            tooltip += (f"\n  [{channel}] {stats_['count']}/{stats_['ntot'] or '?'} - "
+                        f"{stats_['slices/s']:.1f} slices/s")
+        self.progress_bar.setToolTip(tooltip)
+        if self.parent.current_section is self:
+            self.parent.update_run_all_status(self, stats)
+
     def show_results(self):
         if self.parent.stack:
             add_layers(dirname=self.parent.stack.project_dir / 'process' / self.process_name,
-                       channels=self.parent.stack.params['channels'])
+                       channels=self.parent.stack.params['channels'],
+                       multiscale=self.parent.multiscale)
 
     def delete(self, reply=None):
+        from pystack3d.utils import dumps_params
+        from pystack3d_napari.fusion import get_restart_step
+        from pystack3d_napari.fingerprint import remove_run_marker
+        from pystack3d_napari.retention import drop_references
+
         if self.parent.stack:
             if reply is None:
                 msg = ("You are about to delete all the layers and processed data for the current "
@@ -306,13 +612,20 @@ class CollapsibleSection(QFrame):
             if reply == QMessageBox.Yes:
                 sections = self.parent.get_sections()
                 process_names = self.parent.get_process_names()
-                ind = process_names.index(self.process_name)
+                # fused steps without saved images are deleted with the steps they fed
+                restart = get_restart_step(self.parent.stack.project_dir,
+                                           self.parent.stack.params['channels'],
+                                           self.parent.stack.params['history'], self.process_name)
+                ind = min(process_names.index(self.process_name), process_names.index(restart))
                 for section in sections[ind:]:
                     remove_layers(section.process_name, self.parent.stack.params['channels'])
                     section.progress_bar.setValue(0)
+                    section.mark_fused(None)
                     dir_process = self.parent.project_dir / 'process' / section.process_name
+                    drop_references(dir_process)  # (layers removed first)
                     if dir_process.is_dir():
                         shutil.rmtree(dir_process)
+                    remove_run_marker(self.parent.project_dir, [section.process_name])
                     if section.process_name in self.parent.stack.params['history']:
                         self.parent.stack.params['history'].remove(section.process_name)
                 self.parent.stack.fname_toml.write_text(dumps_params(self.parent.stack.params),
@@ -413,11 +726,14 @@ class DragDropContainer(QWidget):
         event.accept()
 
     def set_cropping_area(self):
-        _cropping_area = None
+        # (the not built sections get their cropping area when built)
+        cropping_section = None
         for section in self.widgets():
-            section.widget.cropping_area = _cropping_area
+            if section.is_built:
+                section.widget.cropping_area = \
+                    None if cropping_section is None else cropping_section.widget.area
             if 'cropping' in section.process_name:
-                _cropping_area = section.widget.area
+                cropping_section = section
 
 
 class FilterTableWidget(QWidget):
@@ -433,14 +749,18 @@ class FilterTableWidget(QWidget):
         self.button = QPushButton("VALIDATE FILTERS")
         self.button.clicked.connect(self.handle_submit)
 
+        self.fourier = FourierPreview(self)
+
         layout = QVBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
         layout.setSpacing(5)
         layout.addWidget(self.table)
         layout.addWidget(self.button)
+        layout.addWidget(self.fourier)
         self.setLayout(layout)
 
         self.set_filters([FILTER_DEFAULT])
+        self.table.cellChanged.connect(self.fourier.schedule)
 
     def sizeHint(self):
         return QSize(0, 0)  # force automatic readjustment
@@ -472,9 +792,8 @@ class FilterTableWidget(QWidget):
         self.table.resizeColumnsToContents()
         self.table.resizeRowsToContents()
 
-    def handle_submit(self):
-        self.center_all_cells()
-        self.filters.clear()
+    def get_filters(self):
+        filters = []
         for row in range(self.table.rowCount()):
             try:
                 name = self.table.item(row, 0).text()
@@ -482,11 +801,156 @@ class FilterTableWidget(QWidget):
                 sigma = self.table.item(row, 2).text()
                 sigma = ast.literal_eval(sigma) if sigma else []
                 theta = float(self.table.item(row, 3).text()) if self.table.item(row, 3) else 0.
-                self.filters.append({"name": name, "noise_level": noise, "sigma": sigma,
-                                     "theta": theta})
-                self.widget.filters.value = str(self.filters)
+                filters.append({"name": name, "noise_level": noise, "sigma": sigma,
+                                "theta": theta})
             except:
                 pass
+        return filters
+
+    def handle_submit(self):
+        self.center_all_cells()
+        self.filters[:] = self.get_filters()
+        if len(self.filters) > 0:
+            self.widget.filters.value = str(self.filters)
+        self.fourier.refresh_spectrum()
+
+
+class FourierPreview(QWidget):
+    """
+    Fourier-domain view of the destriping filters: the log spectrum of the displayed slice
+    (calculated once per slice) overlaid with the filters spectra, and a fast approximation
+    of the destriped slice, both updated at each filters edition in a background thread
+    """
+    layer_names = ["fourier spectrum", "fourier filters", "fourier destriping (approx.)"]
+    display_size = 1024  # max. size of the displayed spectra
+    result_signal = Signal(object, str)
+
+    def __init__(self, table_widget, delay=150):
+        super().__init__()
+        self.table_widget = table_widget
+        self.key = None  # cached slice key
+        self.img = None
+        self.spectrum = None
+        self.log_spectrum = None
+        self.generation = 0  # incremented at each request to drop the superseded results
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="fourier")
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.refresh_spectrum)
+
+        self.checkbox = QCheckBox("Fourier preview")
+        self.checkbox.setToolTip("Show the displayed slice spectrum with the filters overlaid "
+                                 "and an approximate destriping\n(quadratic approximation of "
+                                 "VSNR, not the final result)")
+        self.checkbox.toggled.connect(self.on_toggled)
+        self.label = QLabel("")
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.checkbox)
+        layout.addWidget(self.label)
+        self.setLayout(layout)
+
+        self.result_signal.connect(self.show_result)
+
+    def on_toggled(self, checked):
+        viewer = napari.current_viewer()
+        if checked:
+            viewer.dims.events.current_step.connect(self.schedule)
+            self.refresh_spectrum()
+        else:
+            viewer.dims.events.current_step.disconnect(self.schedule)
+            self.timer.stop()
+            self.generation += 1
+            self.label.setText("")
+            self.executor.submit(self.clear_cache)
+            for layer_name in self.layer_names:
+                if layer_name in viewer.layers:
+                    del viewer.layers[layer_name]
+
+    def schedule(self, *args):
+        if self.checkbox.isChecked():
+            self.generation += 1
+            self.timer.start()  # restarted by each new change
+
+    def clear_cache(self):
+        self.key = self.img = self.spectrum = self.log_spectrum = None
+
+    def load_slice(self, tiff_stack, ind):
+        """ Read the 'ind' slice of the destriping input and its spectrum if not cached """
+        from pystack3d_napari.preview import get_spectrum, to_full_spectrum
+
+        infos = tiff_stack.infos[ind]
+        key = (tiff_stack.fnames[ind], infos['size'], infos['mtime'])
+        if key != self.key:
+            self.img = np.asarray(tiff_stack.read(ind))
+            self.spectrum = get_spectrum(self.img)
+            self.log_spectrum = to_full_spectrum(np.log1p(np.abs(self.spectrum)),
+                                                 self.img.shape[1])
+            self.key = key
+
+    def refresh_spectrum(self):
+        from pystack3d_napari.preview import get_input_stack
+
+        self.timer.stop()
+        if not self.checkbox.isChecked():
+            return
+        parent = getattr(self.table_widget.widget, '_parent', None)
+        stack = parent.stack if parent is not None else None
+        if stack is None:
+            self.label.setText("error: INIT first")
+            return
+        tiff_stack = get_input_stack(stack, 'destriping')
+        if tiff_stack is None:
+            self.label.setText("error: No input image")
+            return
+        ind = min(napari.current_viewer().dims.current_step[0], len(tiff_stack) - 1)
+        filters = self.table_widget.get_filters()
+        self.generation += 1
+        self.label.setText("computing...")
+        self.executor.submit(self.compute, self.generation, tiff_stack, ind, filters)
+
+    def compute(self, generation, tiff_stack, ind, filters):
+        from pystack3d_napari.preview import (get_filters_spectrum, to_full_spectrum,
+                                              fourier_destriping)
+
+        if generation != self.generation:
+            return  # superseded before being started
+        t0 = time.perf_counter()
+        try:
+            self.load_slice(tiff_stack, ind)
+            shape = self.img.shape
+            filters_spectrum = to_full_spectrum(get_filters_spectrum(filters, shape), shape[1])
+            result = fourier_destriping(self.spectrum, filters, shape)
+            data = (self.log_spectrum, filters_spectrum, result.astype(np.float32))
+            msg = f"{1e3 * (time.perf_counter() - t0):.0f} ms"
+        except Exception as e:
+            data, msg = None, f"error: {e}"
+        if generation == self.generation:
+            self.result_signal.emit(data, msg)
+
+    def show_result(self, data, msg):
+        self.label.setText(msg)
+        if data is None or not self.checkbox.isChecked():
+            return
+        log_spectrum, filters_spectrum, result = data
+        h, w = result.shape
+        step = max(1, int(np.ceil(max(h, w) / self.display_size)))
+        kwargs = {'scale': (step, step), 'translate': (0, 1.05 * w)}  # beside the slice
+        data = [(log_spectrum[::step, ::step], {'colormap': 'gray', **kwargs}),
+                (filters_spectrum[::step, ::step], {'colormap': 'red', 'blending': 'additive',
+                                                    'opacity': 0.5, **kwargs}),
+                (result, {'colormap': 'gray', 'translate': (0, 2.1 * w)})]
+        viewer = napari.current_viewer()
+        for layer_name, (arr, kwargs) in zip(self.layer_names, data):
+            if layer_name in viewer.layers:
+                layer = viewer.layers[layer_name]
+                layer.data = arr
+                layer.reset_contrast_limits()
+            else:
+                viewer.add_image(arr, name=layer_name, **kwargs)
 
 
 class CroppingPreview(QWidget):
@@ -584,13 +1048,424 @@ class CroppingPreview(QWidget):
         viewer.window._qt_viewer.canvas.native.installEventFilter(self.watcher)
 
 
+class LivePreview(QWidget):
+    """
+    Evaluation of the step on the displayed slice each time a parameter changes (debounced),
+    in a background thread, the result being shown in a single reused layer
+    """
+    instances = []
+    layer_name = "live preview"
+    result_signal = Signal(object, str)
+
+    def __init__(self, section, delay=300):
+        super().__init__()
+        self.section = section
+        self.generation = 0  # incremented at each request to drop the superseded results
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="preview")
+        LivePreview.instances.append(self)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.submit)
+
+        self.checkbox = QCheckBox("Live preview")
+        self.checkbox.setToolTip("Evaluate the step on the displayed slice when a parameter "
+                                 "changes\n(statistics along z evaluated on a slab of slices)")
+        self.checkbox.toggled.connect(self.on_toggled)
+        self.label = QLabel("")
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.checkbox)
+        layout.addWidget(self.label)
+        self.setLayout(layout)
+
+        self.section.widget.changed.connect(self.schedule)
+        self.result_signal.connect(self.show_result)
+
+    def on_toggled(self, checked):
+        viewer = napari.current_viewer()
+        if checked:
+            for instance in LivePreview.instances:
+                if instance is not self:
+                    instance.checkbox.setChecked(False)
+            viewer.dims.events.current_step.connect(self.schedule)
+            self.schedule()
+        else:
+            viewer.dims.events.current_step.disconnect(self.schedule)
+            self.generation += 1
+            self.label.setText("")
+            if self.layer_name in viewer.layers:
+                del viewer.layers[self.layer_name]
+
+    def schedule(self, *args):
+        if self.checkbox.isChecked():
+            self.generation += 1
+            self.timer.start()  # restarted by each new change
+
+    def submit(self):
+        from pystack3d_napari.preview import get_input_stack
+
+        stack = self.section.parent.stack
+        if stack is None:
+            self.label.setText("INIT first")
+            return
+        process_name = self.section.process_name
+        tiff_stack = get_input_stack(stack, process_name)
+        if tiff_stack is None:
+            self.label.setText("No input image")
+            return
+        ind = min(napari.current_viewer().dims.current_step[0], len(tiff_stack) - 1)
+        params = convert_params(self.section.widget.asdict())
+        self.label.setText("computing...")
+        self.executor.submit(self.compute, self.generation, process_name, params, tiff_stack,
+                             ind, stack.project_dir)
+
+    def compute(self, generation, process_name, params, tiff_stack, ind, project_dir):
+        from pystack3d_napari.preview import preview_slice
+
+        if generation != self.generation:
+            return  # superseded before being started
+        t0 = time.perf_counter()
+        try:
+            result = preview_slice(process_name, params, tiff_stack, ind,
+                                   project_dir=project_dir)
+            msg = f"slice {ind}: {1e3 * (time.perf_counter() - t0):.0f} ms"
+        except Exception as e:
+            result, msg = None, f"error: {e}"
+        if generation == self.generation:
+            self.result_signal.emit(result, msg)
+
+    def show_result(self, result, msg):
+        self.label.setText(msg)
+        if result is None or not self.checkbox.isChecked():
+            return
+        viewer = napari.current_viewer()
+        if self.layer_name in viewer.layers:
+            layer = viewer.layers[self.layer_name]
+            layer.data = result
+            layer.reset_contrast_limits()
+        else:
+            viewer.add_image(result, name=self.layer_name, colormap="gray")
+
+
+class OutputSettings(QWidget):
+    """
+    Post-processing of the step results once the step is completed: lossless compression of
+    the tiff slices and export to a chunked and compressed zarr store (copy of the tiff
+    slices, read directly by 'get_layers')
+    """
+    status_signal = Signal(str)
+
+    def __init__(self, section):
+        from pystack3d_napari.store import has_zarr, CODECS, DEFAULT_OUTPUT
+        from pystack3d_napari.retention import COMPRESSIONS, is_compression_available
+
+        super().__init__()
+        section.output_settings = self
+
+        self.format = QComboBox()  # ('tiff' or 'zarr' output format, as saved in the TOML)
+        self.format.addItems(["none", "zarr"])
+        self.format.setToolTip("export of the tiff slices to a zarr store once the step is "
+                               "completed\n(second copy of the results, the tiff slices "
+                               "being still read by the following steps)")
+        if not has_zarr():
+            self.format.model().item(1).setEnabled(False)
+            self.format.setToolTip("'zarr' package not installed")
+        self.chunks = QLineEdit(str(tuple(DEFAULT_OUTPUT['chunks'])))
+        self.chunks.setToolTip("zarr chunk shape (z, y, x)")
+        self.codec = QComboBox()
+        self.codec.addItems(CODECS)
+        self.codec.setToolTip("zarr compression codec")
+        self.level = QSpinBox()
+        self.level.setRange(0, 22)
+        self.level.setValue(DEFAULT_OUTPUT['level'])
+        self.level.setToolTip("compression level")
+        self.compression = QComboBox()
+        self.compression.addItems(list(COMPRESSIONS))
+        for k, compression in enumerate(COMPRESSIONS):
+            if not is_compression_available(compression):
+                self.compression.model().item(k).setEnabled(False)
+        self.compression.setToolTip("lossless compression of the tiff slices ('zstd' requires "
+                                    "the 'imagecodecs' package).\nThe following steps keep "
+                                    "the compression of their input slices")
+        self.compression_level = QSpinBox()
+        self.compression_level.setValue(DEFAULT_OUTPUT['compression_level'])
+        self.compression_level.setToolTip("tiff compression level (range of the codec)")
+        self.label = QLabel("")
+        self.format.currentTextChanged.connect(self.update_enabled)
+        self.compression.currentTextChanged.connect(self.update_enabled)
+        self.update_enabled()
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        for label, widgets in [("Compression", [self.compression, self.compression_level]),
+                               ("Export", [self.format, self.chunks, self.codec, self.level])]:
+            hlayout = QHBoxLayout()
+            hlayout.addWidget(QLabel(label))
+            for widget in widgets:
+                hlayout.addWidget(widget)
+            layout.addLayout(hlayout)
+        layout.addWidget(self.label)
+        self.setLayout(layout)
+
+        self.status_signal.connect(self.label.setText)
+
+    def update_enabled(self, *args):
+        from pystack3d_napari.retention import COMPRESSION_LEVELS
+
+        is_zarr = self.format.currentText() == 'zarr'
+        for widget in [self.chunks, self.codec, self.level]:
+            widget.setEnabled(is_zarr)
+        self.compression_level.setEnabled(self.compression.currentText() != 'none')
+        if self.compression.currentText() in COMPRESSION_LEVELS:
+            self.compression_level.setRange(*COMPRESSION_LEVELS[self.compression.currentText()])
+
+    def get(self):
+        from pystack3d_napari.store import DEFAULT_OUTPUT
+
+        try:
+            chunks = [int(val) for val in ast.literal_eval(self.chunks.text())]
+        except (ValueError, SyntaxError, TypeError):
+            chunks = DEFAULT_OUTPUT['chunks']
+        return {'format': ['tiff', 'zarr'][self.format.currentIndex()], 'chunks': chunks,
+                'codec': self.codec.currentText(), 'level': self.level.value(),
+                'compression': self.compression.currentText(),
+                'compression_level': self.compression_level.value()}
+
+    def set(self, output):
+        from pystack3d_napari.store import DEFAULT_OUTPUT
+
+        output = {**DEFAULT_OUTPUT, **output}
+        self.format.setCurrentIndex(int(output['format'] == 'zarr'))
+        self.chunks.setText(str(tuple(output['chunks'])))
+        self.codec.setCurrentText(output['codec'])
+        self.level.setValue(output['level'])
+        self.compression.setCurrentText(output['compression'])
+        self.compression_level.setValue(output['compression_level'])
+
+    def apply(self, stack, process_name, output):
+        """ Compress the step results and export the zarr stores (called from the eval thread) """
+        from pystack3d_napari.store import write_step_stores
+        from pystack3d_napari.retention import compress_step
+
+        channels = stack.channels(process_name)
+        msgs = []
+        t0 = time.perf_counter()
+        try:
+            if output['compression'] != 'none':
+                self.status_signal.emit("compressing...")
+                nbytes, nbytes_new = compress_step(stack.project_dir, process_name, channels,
+                                                   output['compression'],
+                                                   output['compression_level'])
+                if nbytes:
+                    msgs.append(f"{output['compression']}: {nbytes / 2 ** 20:.0f} MB -> "
+                                f"{nbytes_new / 2 ** 20:.0f} MB")
+            if output['format'] == 'zarr':
+                self.status_signal.emit("exporting to zarr...")
+                fnames = write_step_stores(stack.project_dir, process_name, channels, output)
+                msgs.append(f"{len(fnames)} zarr store(s)")
+        except Exception as e:
+            self.status_signal.emit(f"output error: {e}")
+            return
+        self.status_signal.emit(", ".join(msgs) +
+                                f" in {format_duration(time.perf_counter() - t0)}")
+
+
+class ProfilePanel(QWidget):
+    """
+    Opt-in profiling of the next run of the step (eval thread and workers), the merged
+    'profile.prof' and 'profile.collapsed' being saved in 'process/<step>/profile'
+    """
+    profile_signal = Signal(str)
+
+    def __init__(self, section, nrows=8):
+        super().__init__()
+        self.nrows = nrows
+        section.profile_panel = self
+
+        self.checkbox = QCheckBox("Profile this step")
+        self.checkbox.setToolTip("Profile the next run (cProfile + stack sampling of the "
+                                 "eval thread and of the workers).\nThe merged profile "
+                                 "(snakeviz, speedscope...) is saved in "
+                                 "'process/<step>/profile'")
+        self.checkbox.toggled.connect(lambda checked: self.label.setVisible(checked))
+        self.label = QLabel("")
+        self.label.setStyleSheet("font-family: monospace;")
+        self.label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self.label.setVisible(False)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.checkbox)
+        layout.addWidget(self.label)
+        self.setLayout(layout)
+
+        self.profile_signal.connect(self.show_summary)
+
+    def show_summary(self, text):
+        lines = text.split("\n")
+        self.label.setText("\n".join(lines[:self.nrows + 2]))  # (path + header)
+        self.label.setToolTip(text)
+
+
+class Volume3DWidget(QWidget):
+    """
+    3D rendering of binned proxy volumes (built in background and cached in '.proxy' folders)
+    instead of the full resolution stacks, the latter being loaded only in a user-defined box
+    """
+    proxy_suffix = " [proxy]"
+    box_suffix = " [box]"
+
+    def __init__(self):
+        super().__init__()
+        self.hidden_layers = []  # names of the full resolution layers hidden by their proxy
+
+        self.timer = QTimer(self)  # polling of the proxies built in background
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.show_proxies)
+
+        self.label = QLabel("")
+        self.label.setToolTip("3D rendering of binned proxy volumes\n(budget set by the "
+                              "PYSTACK3D_PROXY_MB environment variable)")
+        self.box_edit = QLineEdit()
+        self.box_edit.setPlaceholderText("(zmin, zmax, ymin, ymax, xmin, xmax)")
+        self.box_edit.setToolTip("Full resolution sub-volume (in voxels) to load in 3D")
+        self.box_edit.textChanged.connect(self.update_box_size)
+        self.box_button = QPushButton("LOAD BOX")
+        self.box_button.clicked.connect(self.load_box)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        hlayout = QHBoxLayout()
+        hlayout.addWidget(self.box_edit)
+        hlayout.addWidget(self.box_button)
+        layout.addLayout(hlayout)
+        layout.addWidget(self.label)
+        self.setLayout(layout)
+        self.setEnabled(False)
+
+    def set_enabled(self, state):
+        enabled = (state == Qt.Checked)
+        viewer = napari.current_viewer()
+        self.setEnabled(enabled)
+        if enabled:
+            viewer.dims.events.ndisplay.connect(self.on_ndisplay)
+        else:
+            viewer.dims.events.ndisplay.disconnect(self.on_ndisplay)
+            self.hide_proxies()
+
+    def on_ndisplay(self, event=None):
+        if napari.current_viewer().dims.ndisplay == 3:
+            self.show_proxies()
+        else:
+            self.hide_proxies()
+
+    @staticmethod
+    def get_stack_layers():
+        """ Return the full resolution layers related to tiff stacks """
+        return [layer for layer in napari.current_viewer().layers
+                if 'tiff_stack' in layer.metadata and 'proxy' not in layer.metadata
+                and layer.ndim == 3]
+
+    def show_proxies(self):
+        from pystack3d_napari.proxy import get_proxy
+
+        viewer = napari.current_viewer()
+        if viewer.dims.ndisplay != 3:
+            return
+        pending = []
+        for layer in self.get_stack_layers():
+            name = layer.name + self.proxy_suffix
+            if not layer.visible or name in viewer.layers:
+                continue
+            proxy, binning = get_proxy(layer.metadata['tiff_stack'])
+            if proxy is None:
+                pending.append(layer.name)
+                continue
+            scale = np.asarray(layer.scale)
+            translate = np.asarray(layer.translate) + 0.5 * (np.asarray(binning) - 1) * scale
+            viewer.add_image(proxy, name=name, scale=scale * binning, translate=translate,
+                             contrast_limits=layer.contrast_limits,
+                             metadata={'proxy': binning, 'source': layer.name},
+                             **KWARGS_RENDERING)
+            layer.visible = False
+            self.hidden_layers.append(layer.name)
+        if pending:
+            self.label.setText(f"building proxy: {', '.join(pending)}...")
+            self.timer.start()
+        else:
+            self.label.setText("")
+
+    def hide_proxies(self):
+        self.timer.stop()
+        viewer = napari.current_viewer()
+        for layer in list(viewer.layers):
+            if 'proxy' in layer.metadata:
+                viewer.layers.remove(layer)
+        for name in self.hidden_layers:  # (names: no reference kept on the removed layers)
+            if name in viewer.layers:
+                viewer.layers[name].visible = True
+        self.hidden_layers = []
+        self.label.setText("")
+
+    def get_box_layers(self):
+        """ Return the (lazy) full resolution box layers as (data, kwargs, layer_type) """
+        from pystack3d_napari.proxy import get_subbox
+
+        box = ast.literal_eval(self.box_edit.text())
+        layers = []
+        for layer in self.get_stack_layers():
+            data, origin = get_subbox(layer.metadata['tiff_stack'].to_dask(), box)
+            scale = np.asarray(layer.scale)
+            kwargs = {'name': layer.name + self.box_suffix, 'scale': scale,
+                      'translate': np.asarray(layer.translate) + np.asarray(origin) * scale,
+                      'contrast_limits': layer.contrast_limits}
+            layers.append((data, kwargs, 'image'))
+        return layers
+
+    def update_box_size(self):
+        try:
+            layers = self.get_box_layers()
+        except (ValueError, SyntaxError, TypeError):
+            self.label.setText("")
+            return
+        self.label.setText(f"box: {size(layers) / 2 ** 20:.0f} MB to load "
+                           f"({len(layers)} layer(s))")
+
+    def load_box(self):
+        try:
+            layers = self.get_box_layers()
+        except (ValueError, SyntaxError, TypeError):
+            show_warning("'box' syntax is not correct: (zmin, zmax, ymin, ymax, xmin, xmax)")
+            return
+        nbytes = size(layers)
+        available = get_ram_info()[2]
+        msg = (f"About to load {nbytes / 2 ** 20:.0f} MB at full resolution "
+               f"({available / 2 ** 30:.1f} GB RAM available).\n\nDo you confirm ?")
+        reply = QMessageBox.question(None, "Confirm", msg, QMessageBox.Yes | QMessageBox.No)
+        if reply != QMessageBox.Yes:
+            return
+        viewer = napari.current_viewer()
+        for data, kwargs, layer_type in layers:
+            if kwargs['name'] in viewer.layers:
+                viewer.layers.remove(kwargs['name'])
+            getattr(viewer, f"add_{layer_type}")(np.asarray(data), **kwargs, **KWARGS_RENDERING)
+
+
 class DiskRAMUsageWidget(QWidget):
     def __init__(self):
+        from pystack3d_napari.monitor import MONITOR
+
         super().__init__()
-        self.usages = ['Disk', 'RAM']
+        self.usages = ['Disk', 'RAM', 'Cache']
         self.pbars = []
         self.labels = []
 
+        MONITOR.start()  # sampling in background, the widget only reads the last samples
+
         self.init_ui()
         self.update_usage()
 
@@ -614,16 +1489,74 @@ class DiskRAMUsageWidget(QWidget):
             self.pbars.append(pbar)
             self.labels.append(label)
 
+        hlayout = QHBoxLayout()
+        self.sparklines = QLabel()
+        self.sparklines.setStyleSheet("font-family: monospace;")
+        export_button = QPushButton("EXPORT")
+        export_button.setToolTip("Save the resources history (with the steps start/end "
+                                 "markers) in a .csv or .json file")
+        export_button.clicked.connect(self.export)
+        hlayout.addWidget(self.sparklines)
+        hlayout.addWidget(export_button)
+        layout.addLayout(hlayout)
+
         self.setLayout(layout)
 
     def update_usage(self):
+        from pystack3d_napari.monitor import MONITOR
+
+        sample = MONITOR.last()
         for usage, pbar, label in zip(self.usages, self.pbars, self.labels):
-            total, used, _ = eval(f"get_{usage.lower()}_info()")  # get_ram_info or get_disk_info
-            percent = int(100 * used / total)
+            if usage == 'Disk' and sample is not None:  # project filesystem
+                total, used = sample['disk_total'], sample['disk_total'] - sample['disk_free']
+            elif usage == 'RAM' and sample is not None:
+                total, used = sample['ram_total'], sample['ram_used']
+            elif usage == 'Disk':  # project filesystem (monitor not sampled yet)
+                total, used, _ = get_disk_info(MONITOR.project_dir)
+            else:
+                total, used, _ = eval(f"get_{usage.lower()}_info()")  # get_cache_info, ...
+            percent = int(100 * used / total) if total else 0
             pbar.setValue(percent)
             self.update_color(percent, pbar)
             label.setText(f" {usage} used / total : "
                           f"{used / 1_073_741_824:.2f} / {total / 1_073_741_824:.2f} (GB)")
+        stats = SLICE_CACHE.stats()
+        self.labels[2].setToolTip(f"Slices cache: {stats['nslices']} slices\n"
+                                  f"hits: {stats['hits']}  misses: {stats['misses']}  "
+                                  f"evictions: {stats['evictions']}\n"
+                                  f"(budget set by the PYSTACK3D_CACHE_MB environment variable)")
+        self.update_sparklines(sample)
+
+    def update_sparklines(self, sample, n=30):
+        from pystack3d_napari.monitor import MONITOR, sparkline
+
+        if sample is None:
+            return
+        io = [read + write for read, write in zip(MONITOR.series('disk_read_rate', n),
+                                                  MONITOR.series('disk_write_rate', n))]
+        self.sparklines.setText(
+            f"CPU {sparkline(MONITOR.series('workers_cpu', n), vmax=100 * os.cpu_count())}"
+            f" {sample['workers_cpu']:.0f}%\n"
+            f"RSS {sparkline(MONITOR.series('workers_rss', n), vmax=sample['ram_total'])}"
+            f" {sample['workers_rss'] / 2 ** 30:.2f} GB\n"
+            f"I/O {sparkline(io)} {io[-1] / 2 ** 20:.0f} MB/s")
+        self.sparklines.setToolTip(
+            f"{sample['nworkers']} worker(s): {sample['workers_cpu']:.0f}% CPU, "
+            f"{sample['workers_rss'] / 2 ** 20:.0f} MB RSS, "
+            f"R/W {sample['workers_read_rate'] / 2 ** 20:.1f}/"
+            f"{sample['workers_write_rate'] / 2 ** 20:.1f} MB/s\n"
+            f"project disk: R/W {sample['disk_read_rate'] / 2 ** 20:.1f}/"
+            f"{sample['disk_write_rate'] / 2 ** 20:.1f} MB/s, "
+            f"{sample['disk_free'] / 2 ** 30:.1f} GB free\n"
+            f"system CPU: {sample['cpu_percent']:.0f}%")
+
+    def export(self):
+        from pystack3d_napari.monitor import MONITOR
+
+        fname, _ = QFileDialog.getSaveFileName(self, "Export resources history", "",
+                                               "CSV files (*.csv);;JSON files (*.json)")
+        if fname:
+            MONITOR.export(fname)
 
     def update_color(self, percent, pbar):
         if percent < 70:
@@ -701,6 +1634,8 @@ class LoadParamsWidget(DragDropPushButton):
             self.load_params(fname_toml)
 
     def load_params(self, fname_toml):
+        from tomlkit import parse
+
         with open(fname_toml, 'r') as fid:
             params = dict(parse(fid.read()))
             update_widgets_params(params, self.parent.init_widget, self.parent.process_container)
@@ -718,6 +1653,10 @@ class SaveParamsWidget(DragDropPushButton):
             self.save_params(fname_toml)
 
     def save_params(self, fname_toml):
+        from tomlkit import dumps
+        from pystack3d.utils import reformat_params
+        from pystack3d_napari.store import DEFAULT_OUTPUT
+
         params = get_params(self.parent.init_widget, keep_null_string=False)
 
         process_steps = []
@@ -725,6 +1664,10 @@ class SaveParamsWidget(DragDropPushButton):
             if section.checkbox.isChecked():
                 process_steps.append(section.process_name)
                 params[section.process_name] = get_params(section.widget, keep_null_string=False)
+                if section.output_settings is not None \
+                        and section.output_settings.get() != DEFAULT_OUTPUT:
+                    params.setdefault('outputs', {})[section.process_name] = \
+                        section.output_settings.get()
         params['process_steps'] = process_steps
         params['history'] = self.parent.stack.params['history'] if self.parent.stack else []
 
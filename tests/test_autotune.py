@@ -0,0 +1,68 @@
+import tracemalloc
+
+import numpy as np
+from tifffile import imwrite
+
+from pystack3d_napari import autotune
+from pystack3d_napari.autotune import recommend, WORKER_OVERHEAD
+from pystack3d_napari.reader import TiffStack
+
+
+def test_limited_by_cores():
+    nproc, chunksize, explanation = recommend(1000, 0.01, 0, ram_available=2 ** 40, cpu_count=4)
+    assert nproc == 4
+    assert chunksize == 8
+    assert "limited by cores" in explanation
+
+
+def test_limited_by_ram():
+    nproc, _, explanation = recommend(1000, 1., 2 ** 30 - WORKER_OVERHEAD,
+                                      ram_available=3 * 2 ** 30, cpu_count=64)
+    assert 1 <= nproc <= 3
+    assert "limited by RAM" in explanation
+
+
+def test_limited_by_work():
+    nproc, chunksize, explanation = recommend(1000, 1e-4, 0, ram_available=2 ** 40, cpu_count=64)
+    assert nproc == 1
+    assert "limited by work" in explanation
+
+
+def test_slices_per_channel():
+    # the partition of each channel slices requires nproc <= nslices (per channel)
+    nproc, chunksize, explanation = recommend(3, 10., 0, ram_available=2 ** 40, cpu_count=64,
+                                              nslices_tot=3 * 50)
+    assert nproc == 3
+    assert "limited by slices" in explanation
+
+
+def test_work_and_chunksize_over_channels():
+    nproc, chunksize, _ = recommend(20, 0.01, 0, ram_available=2 ** 40, cpu_count=64)
+    assert (nproc, chunksize) == (1, 5)
+    nproc, chunksize, _ = recommend(20, 0.01, 0, ram_available=2 ** 40, cpu_count=64,
+                                    nslices_tot=20 * 10)
+    assert (nproc, chunksize) == (2, 8)
+
+
+def test_time_not_measured():
+    nproc, chunksize, explanation = recommend(10, None, 0, ram_available=2 ** 40, cpu_count=4)
+    assert nproc == 4
+    assert chunksize == 1
+    assert "not measured" in explanation
+
+
+def test_calibration_reused(tmp_path, monkeypatch):
+    for k in range(4):
+        imwrite(tmp_path / f"slice_{k}.tif", np.zeros((32, 32), dtype=np.uint16))
+    tiff_stack = TiffStack(sorted(tmp_path.glob("*.tif")), cache=None)
+    params = {'area': [0, 16, 0, 16]}
+    time_per_slice, peak = autotune.calibrate('cropping', params, tiff_stack, nslices=3)
+    assert time_per_slice is not None and peak >= 32 * 32 * 8
+    assert not tracemalloc.is_tracing()  # (evaluated in a separate process)
+
+    def spawn(*args, **kwargs):
+        raise AssertionError("calibration not reused")
+
+    monkeypatch.setattr(autotune, 'ProcessPoolExecutor', spawn)
+    assert autotune.calibrate('cropping', params, tiff_stack, nslices=1) == (time_per_slice,
+                                                                             peak)
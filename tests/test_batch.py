@@ -0,0 +1,52 @@
+import io
+import json
+
+import pytest
+from tomlkit import dumps
+
+pytest.importorskip("pystack3d")
+pytest.importorskip("pyvsnr")
+
+from pystack3d_napari import FILTER_DEFAULT
+from pystack3d_napari.batch import run
+from pystack3d_napari.benchmark import make_synthetic_stack
+
+STEPS = ['cropping', 'registration_calculation', 'registration_transformation', 'destriping']
+
+
+def write_params(tmp_path, channels, maxit):
+    params = {'project_dir': str(tmp_path / 'proj'), 'channels': channels, 'ind_min': 0,
+              'ind_max': 99999, 'nproc': 1, 'process_steps': STEPS, 'history': [],
+              'cropping': {'area': [2, 44, 2, 44]},
+              'registration_calculation': {'area': [0, 9999, 0, 9999], 'nb_blocks': [1, 1],
+                                           'transformation': 'TRANSLATION'},
+              'registration_transformation': {'subpixel': True, 'mode': 'edge',
+                                              'cropping': False},
+              'destriping': {'maxit': maxit, 'cvg_threshold': 1e-2,
+                             'filters': [FILTER_DEFAULT]}}
+    fname = tmp_path / 'params.toml'
+    fname.write_text(dumps(params), encoding='utf-8')
+    return fname
+
+
+def get_events(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_rerun_after_release(tmp_path):
+    channels = make_synthetic_stack(tmp_path / 'proj', shape=(6, 48, 48))
+    (tmp_path / 'proj' / 'params.toml').write_text(dumps({'history': [], 'channels': channels}))
+    fname = write_params(tmp_path, channels, maxit=10)
+    stream = io.StringIO()
+    assert run(fname, fuse=True, retention='consumed', json_mode=True, stream=stream) == 0
+    assert [event['step'] for event in get_events(stream)
+            if event['event'] == 'released'] == ['cropping']
+
+    # the released 'cropping' images are needed again to re-run the fused steps
+    fname = write_params(tmp_path, channels, maxit=12)
+    stream = io.StringIO()
+    assert run(fname, fuse=True, retention='consumed', json_mode=True, stream=stream) == 0
+    statuses = {event['step']: event['status'] for event in get_events(stream)
+                if event['event'] == 'step_end'}
+    assert statuses == {'cropping': 'completed', 'registration_calculation': 'completed',
+                        'registration_transformation+destriping': 'completed'}
@@ -0,0 +1,20 @@
+import pytest
+
+pytest.importorskip("pystack3d")
+
+from pystack3d_napari import PROCESS_NAMES
+from pystack3d_napari.benchmark import get_bench_params
+
+
+def test_bench_params_from_packaged_toml():
+    params = get_bench_params()
+    assert list(params) == PROCESS_NAMES
+    assert params['intensity_rescaling'] == {'nbins': 256, 'filter_size': -1}
+    assert params['destriping']['filters'][0]['name'] == "Gabor"
+
+
+def test_bench_params_overwritten():
+    params = get_bench_params({'intensity_rescaling': {'nbins': 64},
+                               'cropping': {'area': [0, 10, 0, 10]}})
+    assert params['intensity_rescaling'] == {'nbins': 64, 'filter_size': -1}
+    assert params['cropping'] == {'area': [0, 10, 0, 10]}
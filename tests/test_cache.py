@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from tifffile import imwrite
+
+from pystack3d_napari.cache import SliceCache
+from pystack3d_napari.prefetch import Prefetcher
+from pystack3d_napari.index import get_slice_index
+from pystack3d_napari.reader import TiffStack, GrowingStack
+
+
+def make_loader(calls, nbytes=100):
+    def loader():
+        calls.append(1)
+        return np.zeros(nbytes, dtype=np.uint8)
+
+    return loader
+
+
+def test_hits_and_misses():
+    cache = SliceCache(max_bytes=1000)
+    calls = []
+    arr = cache.get(("/a/slice_0.tif", 1), make_loader(calls))
+    assert cache.get(("/a/slice_0.tif", 1), make_loader(calls)) is arr
+    assert len(calls) == 1
+    assert not arr.flags.writeable
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['nslices'], stats['nbytes']) == (1, 1, 1, 100)
+
+
+def test_new_mtime_is_a_miss():
+    cache = SliceCache(max_bytes=1000)
+    calls = []
+    cache.get(("/a/slice_0.tif", 1), make_loader(calls))
+    cache.get(("/a/slice_0.tif", 2), make_loader(calls))
+    assert len(calls) == 2
+
+
+def test_lru_eviction():
+    cache = SliceCache(max_bytes=300)
+    for k in range(3):
+        cache.get((f"/a/slice_{k}.tif", 0), make_loader([]))
+    cache.get(("/a/slice_0.tif", 0), make_loader([]))  # slice_0 most recently used
+    cache.get(("/a/slice_3.tif", 0), make_loader([]))
+    assert ("/a/slice_1.tif", 0) not in cache
+    assert ("/a/slice_0.tif", 0) in cache and ("/a/slice_3.tif", 0) in cache
+    assert cache.nbytes == 300 and cache.evictions == 1
+
+
+def test_too_large_not_cached():
+    cache = SliceCache(max_bytes=50)
+    arr = cache.get(("/a/slice_0.tif", 0), make_loader([]))
+    assert arr.nbytes == 100
+    assert cache.stats()['nslices'] == 0 and cache.nbytes == 0
+
+
+def test_set_max_bytes():
+    cache = SliceCache(max_bytes=1000)
+    for k in range(5):
+        cache.get((f"/a/slice_{k}.tif", 0), make_loader([]))
+    cache.set_max_bytes(200)
+    assert cache.nbytes == 200
+    assert ("/a/slice_4.tif", 0) in cache and ("/a/slice_0.tif", 0) not in cache
+
+
+def test_invalidate(tmp_path):
+    cache = SliceCache(max_bytes=1000)
+    keys = [(str(tmp_path / "process" / "cropping" / "s_0.tif"), 0),
+            (str(tmp_path / "process" / "cropping_final" / "s_0.tif"), 0),
+            (str(tmp_path / "s_0.tif"), 0)]
+    for key in keys:
+        cache.put(key, np.zeros(10, dtype=np.uint8))
+    cache.invalidate(tmp_path / "process" / "cropping")  # (not 'cropping_final')
+    assert keys[0] not in cache and keys[1] in cache and keys[2] in cache
+    cache.invalidate()
+    assert cache.stats()['nslices'] == 0 and cache.nbytes == 0
+
+
+def test_prefetched_growing_slice_is_a_hit(tmp_path):
+    fnames = [tmp_path / f"s_{k}.tif" for k in range(3)]
+    imwrite(fnames[0], np.ones((8, 8), dtype=np.uint16))
+    cache = SliceCache(max_bytes=10000)
+    stack = GrowingStack(fnames, shape=(8, 8), dtype=np.uint16, cache=cache)
+
+    prefetcher = Prefetcher()
+    prefetcher.executor = ThreadPoolExecutor(1)
+    prefetcher.submit(stack, 1)  # not written yet: not prefetched
+    prefetcher.submit(stack, 0)
+    prefetcher.executor.shutdown(wait=True)
+    assert stack.key(1) is None and stack.key(0) in cache
+    assert cache.stats()['misses'] == 1
+
+    prefetcher.submit(stack, 0)  # already cached: not submitted again
+    assert np.array_equal(stack.read(0), np.ones((8, 8)))
+    assert cache.stats()['hits'] == 1
+
+
+def test_uncompressed_slice_cached_as_copy(tmp_path):
+    imwrite(tmp_path / "s_0.tif", np.arange(64, dtype=np.uint16).reshape(8, 8))
+    index = get_slice_index(tmp_path)
+    cache = SliceCache(max_bytes=10000)
+    stack = TiffStack(index.fnames(), infos=index.infos(), cache=cache)
+    assert stack.is_memmappable(0)
+    arr = stack.read(0)
+    assert not isinstance(arr, np.memmap) and stack.key(0) in cache
+    assert np.array_equal(arr, np.arange(64).reshape(8, 8))
@@ -0,0 +1,109 @@
+import os
+import json
+from types import SimpleNamespace
+
+import numpy as np
+from tifffile import imwrite
+
+from pystack3d_napari.fingerprint import (get_fingerprint, get_fingerprints, write_fingerprint,
+                                          is_uptodate, write_run_marker, get_resumable_steps)
+from pystack3d_napari.fusion import FUSED_NAME
+from pystack3d_napari.retention import release_step
+
+
+def make_stack(project_dir, history=(), channels=('.',), nslices=3):
+    for channel in channels:
+        (project_dir / channel).mkdir(parents=True, exist_ok=True)
+        for k in range(nslices):
+            fname = project_dir / channel / f"slice_{k}.tif"
+            if not fname.exists():
+                imwrite(fname, np.zeros((4, 4), dtype=np.uint8))
+    for name in history:
+        (project_dir / 'process' / name).mkdir(parents=True, exist_ok=True)
+    params = {'history': list(history), 'channels': list(channels), 'ind_min': 0,
+              'ind_max': 99999}
+    return SimpleNamespace(project_dir=project_dir, params=params)
+
+
+def test_deterministic(tmp_path):
+    stack = make_stack(tmp_path)
+    params = {'area': [0, 2, 0, 2]}
+    assert get_fingerprint(stack, 'cropping', params) == get_fingerprint(stack, 'cropping', params)
+
+
+def test_parameters_and_stack_settings(tmp_path):
+    stack = make_stack(tmp_path)
+    ref = get_fingerprint(stack, 'cropping', {'area': [0, 2, 0, 2]})
+    assert get_fingerprint(stack, 'cropping', {'area': [0, 3, 0, 2]}) != ref
+    assert get_fingerprint(stack, 'destriping', {'area': [0, 2, 0, 2]}) != ref
+    stack.params['ind_max'] = 1
+    assert get_fingerprint(stack, 'cropping', {'area': [0, 2, 0, 2]}) != ref
+
+
+def test_raw_inputs(tmp_path):
+    stack = make_stack(tmp_path)
+    ref = get_fingerprint(stack, 'cropping', {})
+    imwrite(tmp_path / "slice_3.tif", np.zeros((4, 4), dtype=np.uint8))
+    assert get_fingerprint(stack, 'cropping', {}) != ref
+
+    # slice rewritten in place
+    ref = get_fingerprint(stack, 'cropping', {})
+    stat = os.stat(tmp_path / "slice_1.tif")
+    imwrite(tmp_path / "slice_1.tif", np.ones((4, 4), dtype=np.uint8))
+    os.utime(tmp_path / "slice_1.tif", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert get_fingerprint(stack, 'cropping', {}) != ref
+
+
+def test_upstream(tmp_path):
+    stack = make_stack(tmp_path, history=['cropping', 'destriping'])
+    assert get_fingerprint(stack, 'destriping', {}) is None  # upstream without fingerprint
+
+    write_fingerprint(tmp_path, 'cropping', 'abc')
+    ref = get_fingerprint(stack, 'destriping', {})
+    assert ref == get_fingerprint(stack, 'destriping', {}, upstream='abc')
+    write_fingerprint(tmp_path, 'cropping', 'def')
+    assert get_fingerprint(stack, 'destriping', {}) != ref
+
+
+def test_chained_fingerprints(tmp_path):
+    stack = make_stack(tmp_path)
+    fingerprints = get_fingerprints(stack, ['cropping', 'destriping'], [{}, {}])
+    assert fingerprints[1] == get_fingerprint(stack, 'destriping', {}, upstream=fingerprints[0])
+
+
+def test_is_uptodate(tmp_path):
+    stack = make_stack(tmp_path, history=['cropping'])
+    params = {'area': [0, 2, 0, 2]}
+    assert not is_uptodate(stack, 'cropping', params)
+    write_fingerprint(tmp_path, 'cropping', get_fingerprint(stack, 'cropping', params))
+    assert is_uptodate(stack, 'cropping', params)
+    assert not is_uptodate(stack, 'cropping', {'area': [0, 3, 0, 2]})
+    assert not is_uptodate(stack, 'destriping', params)  # not in history
+
+
+def test_released_input(tmp_path):
+    history = ['cropping', 'registration_calculation', 'registration_transformation',
+               'destriping']
+    stack = make_stack(tmp_path, history=history)
+    fingerprints = get_fingerprints(stack, history, [{}] * 4)
+    for name, fingerprint in zip(history, fingerprints):
+        write_fingerprint(tmp_path, name, fingerprint)
+    assert is_uptodate(stack, 'registration_transformation', {})
+
+    release_step(tmp_path, 'cropping', ['.'], policy='consumed')
+    assert is_uptodate(stack, 'registration_transformation', {})  # (its images are saved)
+    dirname = tmp_path / 'process' / 'registration_transformation' / '.' / 'outputs'
+    dirname.mkdir(parents=True)
+    (dirname / FUSED_NAME).write_text(json.dumps({'saved': False}), encoding='utf-8')
+    assert not is_uptodate(stack, 'registration_transformation', {})
+    assert is_uptodate(stack, 'cropping', {})
+
+
+def test_not_resumable_after_release(tmp_path):
+    stack = make_stack(tmp_path, history=['cropping'])
+    write_fingerprint(tmp_path, 'cropping', get_fingerprint(stack, 'cropping', {}))
+    (tmp_path / 'process' / 'destriping').mkdir(parents=True)
+    write_run_marker(tmp_path, ['destriping'], get_fingerprints(stack, ['destriping'], [{}]))
+    assert get_resumable_steps(stack, 'destriping', {}) == ['destriping']
+    release_step(tmp_path, 'cropping', ['.'], policy='consumed')
+    assert get_resumable_steps(stack, 'destriping', {}) is None
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from pystack3d_napari.fusion import get_out_shape, interleave, is_pool_run
+
+
+def test_cropping_chain(tmp_path):
+    params = {'cropping': {'area': [10, 90, 5, 45]}, 'destriping': {},
+              'cropping_final': {'area': [0, 50, 10, 30]}}
+    shape = (60, 100)  # (ny, nx)
+    assert get_out_shape(['cropping'], params, shape, tmp_path) == (40, 80)
+    assert get_out_shape(['cropping', 'destriping', 'cropping_final'], params, shape,
+                         tmp_path) == (20, 50)
+
+
+def test_area_exceeding_the_slice(tmp_path):
+    params = {'cropping': {'area': [10, 200, 0, 60]}}
+    assert get_out_shape(['cropping'], params, (60, 100), tmp_path) == (60, 90)
+
+
+def test_no_area(tmp_path):
+    assert get_out_shape(['cropping', 'destriping'], {'cropping': {}, 'destriping': {}},
+                         (60, 100), tmp_path) == (60, 100)
+
+
+def test_registration_transformation(tmp_path):
+    pytest.importorskip("pystack3d")
+    dirname = tmp_path / 'process' / 'registration_calculation'
+    dirname.mkdir(parents=True)
+    np.save(dirname / 'tmats.npy', np.repeat(np.eye(3)[None], 5, axis=0))
+    params = {'registration_transformation': {}}
+    assert get_out_shape(['registration_transformation'], params, (60, 100),
+                         tmp_path) == (60, 100)
+
+
+@pytest.mark.parametrize('process_step', ['registration_calculation', 'resampling'])
+def test_shape_not_known(tmp_path, process_step):
+    params = {'cropping': {'area': [10, 90, 5, 45]}}
+    assert get_out_shape(['cropping', process_step], params, (60, 100), tmp_path) is None
+
+
+def test_interleave():
+    tasks_list = [[(0, 'a'), (0, 'b'), (0, 'c')], [(1, 'a')], [], [(3, 'a'), (3, 'b')]]
+    assert interleave(tasks_list) == [(0, 'a'), (1, 'a'), (3, 'a'), (0, 'b'), (3, 'b'),
+                                      (0, 'c')]
+    assert interleave([]) == []
+
+
+def test_is_pool_run():
+    assert is_pool_run(['cropping', 'destriping'], 1)  # fused
+    assert is_pool_run(['destriping'], 1, resume=True)
+    assert is_pool_run(['destriping'], 2, concurrent_channels=True)
+    assert not is_pool_run(['destriping'], 2)
+    assert not is_pool_run(['destriping'], 1, concurrent_channels=True)
+    assert not is_pool_run(['bkg_removal'], 2, concurrent_channels=True)  # (not slice-local)
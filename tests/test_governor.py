@@ -0,0 +1,132 @@
+from types import SimpleNamespace
+
+import psutil
+import pytest
+
+from pystack3d_napari import governor
+from pystack3d_napari.governor import MemoryGovernor
+
+
+class FakeProcess:
+    """ Worker process consuming CPU when running and not blocked """
+
+    def __init__(self, pid, rss):
+        self.pid = pid
+        self.rss = rss
+        self.cpu_time = 0.
+        self.is_suspended = False
+        self.blocked = False  # (waiting at a barrier or for the other workers)
+
+    def suspend(self):
+        self.is_suspended = True
+
+    def resume(self):
+        self.is_suspended = False
+
+    def is_running(self):
+        return True
+
+    def cpu_times(self):
+        return SimpleNamespace(user=self.cpu_time, system=0.)
+
+    def work(self):
+        if not self.is_suspended and not self.blocked:
+            self.cpu_time += 0.5
+
+
+@pytest.fixture
+def ram(monkeypatch):
+    state = {'percent': 50.}
+    monkeypatch.setattr(psutil, 'virtual_memory',
+                        lambda: SimpleNamespace(percent=state['percent'], available=2 ** 30))
+    return state
+
+
+def make_governor(monkeypatch, processes, **kwargs):
+    monkeypatch.setattr(MemoryGovernor, 'workers',
+                        staticmethod(lambda: [(process, process.rss) for process in processes]))
+    return MemoryGovernor(pause_percent=90, resume_percent=80, **kwargs)
+
+
+def run_steps(gov, processes, nsteps):
+    for _ in range(nsteps):
+        for process in processes:
+            process.work()
+        gov.step()
+
+
+def test_suspend_largest_and_resume(monkeypatch, ram):
+    processes = [FakeProcess(1, 100), FakeProcess(2, 300), FakeProcess(3, 200)]
+    gov = make_governor(monkeypatch, processes)
+    run_steps(gov, processes, 1)
+    ram['percent'] = 95.
+    run_steps(gov, processes, 1)
+    assert gov.suspended == [processes[1]] and processes[1].is_suspended
+
+    ram['percent'] = 70.
+    run_steps(gov, processes, 1)
+    assert gov.suspended == [] and not processes[1].is_suspended
+    assert [event['event'] for event in gov.events] == ['pressure', 'suspend', 'resume']
+
+
+def test_no_suspension_without_throttle(monkeypatch, ram):
+    processes = [FakeProcess(1, 100), FakeProcess(2, 300)]
+    gov = make_governor(monkeypatch, processes, throttle=False)
+    ram['percent'] = 95.
+    run_steps(gov, processes, 5)
+    assert gov.suspended == [] and gov.nthrottled == 0
+    assert [event['event'] for event in gov.events] == ['pressure']
+
+
+def test_forced_resume_when_others_idle(monkeypatch, ram):
+    # the other workers wait for the suspended one while the RAM stays high
+    processes = [FakeProcess(1, 100), FakeProcess(2, 300)]
+    gov = make_governor(monkeypatch, processes)
+    ram['percent'] = 95.
+    run_steps(gov, processes, 1)
+    assert processes[1].is_suspended
+    processes[0].blocked = True
+    run_steps(gov, processes, 2)
+    assert not processes[1].is_suspended
+    assert [event.get('forced') for event in gov.events if event['event'] == 'resume'] == ['idle']
+
+    # the resumed worker is no longer suspended, the other one can be
+    processes[0].blocked = False
+    run_steps(gov, processes, 3)
+    assert not processes[1].is_suspended
+
+
+def test_forced_resume_after_max_suspension(monkeypatch, ram):
+    clock = {'now': 0.}
+    monkeypatch.setattr(governor.time, 'monotonic', lambda: clock['now'])
+    processes = [FakeProcess(1, 100), FakeProcess(2, 300), FakeProcess(3, 200)]
+    gov = make_governor(monkeypatch, processes, max_suspension=10.)
+    ram['percent'] = 95.
+    run_steps(gov, processes, 1)
+    assert processes[1].is_suspended
+    clock['now'] = 5.
+    run_steps(gov, processes, 1)
+    assert processes[1].is_suspended
+    clock['now'] = 11.
+    run_steps(gov, processes, 1)
+    assert not processes[1].is_suspended
+    assert gov.events[-1]['forced'] == 'max_suspension'
+
+
+@pytest.mark.parametrize('blocked', [False, True])
+def test_resume_always_happens(monkeypatch, ram, blocked):
+    # RAM never going down: each suspended worker is resumed within a bounded time
+    clock = {'now': 0.}
+    monkeypatch.setattr(governor.time, 'monotonic', lambda: clock['now'])
+    processes = [FakeProcess(pid, 100 * pid) for pid in range(1, 5)]
+    for process in processes:
+        process.blocked = blocked
+    gov = make_governor(monkeypatch, processes, max_suspension=3.)
+    ram['percent'] = 99.
+    for _ in range(50):
+        clock['now'] += 1.
+        run_steps(gov, processes, 1)
+        for process in gov.suspended:
+            assert clock['now'] - gov.suspension_times[process.pid] <= 4.
+    gov.stop()
+    assert not any(process.is_suspended for process in processes)
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+from tifffile import imwrite
+
+from pystack3d_napari.index import SliceIndex, INDEX_NAME, hsorted
+
+
+def write_slices(dirname, inds, shape=(8, 12), dtype=np.uint16, value=0):
+    dirname.mkdir(parents=True, exist_ok=True)
+    for ind in inds:
+        imwrite(dirname / f"slice_{ind}.tif", np.full(shape, value, dtype=dtype))
+
+
+def test_hsorted():
+    assert hsorted(["s_10.tif", "s_2.tif", "s_1.tif"]) == ["s_1.tif", "s_2.tif", "s_10.tif"]
+
+
+def test_listing_and_infos(tmp_path):
+    write_slices(tmp_path, [1, 2, 10])
+    (tmp_path / "notes.txt").write_text("not a slice")
+    index = SliceIndex(tmp_path)
+    assert index.update()
+    assert len(index) == 3
+    assert [fname.name for fname in index.fnames()] == ["slice_1.tif", "slice_2.tif",
+                                                         "slice_10.tif"]
+    assert [fname.name for fname in index.fnames(1, 1)] == ["slice_2.tif"]
+    assert index.shape_dtype() == ((8, 12), np.dtype(np.uint16))
+    assert not index.update()
+
+
+def test_persistence(tmp_path):
+    write_slices(tmp_path, range(3))
+    SliceIndex(tmp_path).update()
+    assert (tmp_path / INDEX_NAME).exists()
+    index = SliceIndex(tmp_path)
+    assert len(index) == 3
+    assert not index.update()  # (index file creation not seen as a change)
+
+
+def test_no_sidecar_without_slices(tmp_path):
+    (tmp_path / "notes.txt").write_text("not a slice")
+    index = SliceIndex(tmp_path)
+    assert not index.update()
+    assert len(index) == 0
+    assert not (tmp_path / INDEX_NAME).exists()
+
+
+def test_files_added_and_removed(tmp_path):
+    write_slices(tmp_path, range(3))
+    index = SliceIndex(tmp_path)
+    index.update()
+    write_slices(tmp_path, [3])
+    assert index.update() and len(index) == 4
+    os.remove(tmp_path / "slice_0.tif")
+    assert index.update() and len(index) == 3
+
+
+def test_slice_rewritten_in_place(tmp_path):
+    write_slices(tmp_path, range(3))
+    index = SliceIndex(tmp_path)
+    index.update()
+    dir_mtime = os.stat(tmp_path).st_mtime_ns
+    # any slice (not only the first one) rewritten with another shape, same directory mtime
+    stat = os.stat(tmp_path / "slice_2.tif")
+    write_slices(tmp_path, [2], shape=(4, 6))
+    os.utime(tmp_path / "slice_2.tif", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    os.utime(tmp_path, ns=(dir_mtime, dir_mtime))
+    assert index.update()
+    assert index.shape_dtype(2) == ((4, 6), np.dtype(np.uint16))
+    assert index.shape_dtype(0) == ((8, 12), np.dtype(np.uint16))
+
+
+def test_missing_directory(tmp_path):
+    write_slices(tmp_path / "ch", range(2))
+    index = SliceIndex(tmp_path / "ch")
+    index.update()
+    for fname in (tmp_path / "ch").iterdir():
+        fname.unlink()
+    (tmp_path / "ch").rmdir()
+    assert index.update() and len(index) == 0
@@ -0,0 +1,100 @@
+import io
+import sys
+
+import pytest
+
+from pystack3d_napari.jobs import Job, JobQueue, LOG_NAME
+
+
+def write_toml(dirname, steps=None, name="params.toml"):
+    dirname.mkdir(parents=True, exist_ok=True)
+    lines = [f"project_dir = '{dirname.as_posix()}'"]
+    if steps is not None:
+        lines.append(f"process_steps = {steps}")
+    fname = dirname / name
+    fname.write_text("\n".join(lines) + "\n", encoding='utf-8')
+    return fname
+
+
+@pytest.fixture
+def fake_start(monkeypatch):
+    """ Start the steps without subprocess """
+
+    def start_step(self, nproc):
+        self.step = self.steps.pop(0)
+        self.nproc = nproc
+        self.status = 'running'
+        self.process = object()
+
+    monkeypatch.setattr(Job, 'start_step', start_step)
+
+
+def test_job_without_steps_is_completed(tmp_path):
+    for steps in [None, []]:
+        job = Job(write_toml(tmp_path / f"proj_{steps}", steps))
+        assert job.status == 'completed' and job.is_done
+
+
+@pytest.mark.parametrize('case', ['missing', 'none', 'several', 'invalid'])
+def test_job_construction_errors(tmp_path, case):
+    fname = tmp_path / "proj"
+    if case == 'missing':
+        fname = tmp_path / "missing.toml"
+    elif case == 'none':
+        fname.mkdir()
+    elif case == 'several':
+        write_toml(fname, ['cropping'], name="a.toml")
+        write_toml(fname, ['cropping'], name="b.toml")
+    else:
+        fname.mkdir()
+        (fname / "params.toml").write_text("process_steps = [", encoding='utf-8')
+    job = JobQueue().add(fname)
+    assert job.status == 'failed' and job.error
+
+
+def test_run_terminates(tmp_path):
+    queue = JobQueue(poll_interval=0.)
+    queue.add(write_toml(tmp_path / "empty", []))
+    queue.add(tmp_path / "missing.toml")
+    stream = io.StringIO()
+    assert queue.run(stream=stream) == 1
+    assert "failed" in stream.getvalue() and "completed" in stream.getvalue()
+
+
+def test_schedule_priorities(tmp_path, fake_start):
+    queue = JobQueue(cpus=8)
+    job1 = queue.add(write_toml(tmp_path / "proj1", ['cropping', 'destriping']), priority=1,
+                     nproc_max=8)
+    job3 = queue.add(write_toml(tmp_path / "proj3", ['cropping', 'destriping']), priority=3,
+                     nproc_max=8)
+    queue.schedule()
+    assert (job1.nproc, job3.nproc) == (2, 6)
+    assert queue.free_cpus() == 0
+
+
+def test_schedule_budget_and_nproc_max(tmp_path, fake_start):
+    queue = JobQueue(cpus=4)
+    jobs = [queue.add(write_toml(tmp_path / f"proj{i}", ['cropping']), nproc_max=1)
+            for i in range(6)]
+    queue.schedule()
+    assert [job.nproc for job in jobs] == [1, 1, 1, 1, 0, 0]
+    assert [job.status for job in jobs[4:]] == ['pending', 'pending']
+
+
+def test_schedule_fair_sharing(tmp_path, fake_start):
+    queue = JobQueue(cpus=1)
+    job_a = queue.add(write_toml(tmp_path / "a", ['cropping', 'destriping']))
+    job_b = queue.add(write_toml(tmp_path / "b", ['cropping', 'destriping']))
+    job_a.cpu_time = 100.
+    queue.schedule()
+    assert job_b.is_running and not job_a.is_running
+
+
+def test_failed_step_reports_stderr(tmp_path, monkeypatch):
+    script = "import sys; print('step details', file=sys.stderr); sys.exit(3)"
+    monkeypatch.setattr(Job, 'get_command', lambda self, nproc: [sys.executable, "-c", script])
+    queue = JobQueue(poll_interval=0.)
+    job = queue.add(write_toml(tmp_path / "proj", ['cropping']))
+    assert queue.run(stream=io.StringIO()) == 1
+    assert job.error.startswith("exit code 3") and "step details" in job.error
+    assert "step details" in (tmp_path / "proj" / "process" / LOG_NAME).read_text()
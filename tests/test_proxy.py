@@ -0,0 +1,27 @@
+import numpy as np
+from tifffile import imwrite
+
+from pystack3d_napari.proxy import build_proxy, get_binning, get_fname
+from pystack3d_napari.reader import TiffStack
+
+
+def test_get_binning():
+    assert get_binning((10, 100, 100), max_voxels=10 ** 6) == (1, 1, 1)
+    binning = get_binning((100, 1000, 1000), max_voxels=10 ** 6)
+    nvoxels = np.prod([np.ceil(n / b) for n, b in zip((100, 1000, 1000), binning)])
+    assert nvoxels <= 10 ** 6
+    assert max(get_binning((10, 5000, 100), max_voxels=10 ** 9, max_size=2048)) == 3
+
+
+def test_build_proxy(tmp_path):
+    imgs = np.random.default_rng(0).integers(0, 1000, (5, 6, 8)).astype(np.uint16)
+    for k, img in enumerate(imgs):
+        imwrite(tmp_path / f"slice_{k}.tif", img)
+    tiff_stack = TiffStack(sorted(tmp_path.glob("*.tif")), cache=None)
+    binning = (2, 2, 2)
+    build_proxy(tiff_stack, binning, nthreads=2)
+    proxy = np.load(get_fname(tiff_stack, binning))
+    assert proxy.shape == (3, 3, 4)
+    assert np.allclose(proxy[0, 0, 0], imgs[:2, :2, :2].mean())
+    assert np.allclose(proxy[2, 1, 3], imgs[4, 2:4, 6:8].mean())
+    assert not get_fname(tiff_stack, binning).with_suffix(".tmp.npy").exists()
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from tifffile import imwrite
+
+from pystack3d_napari import store
+from pystack3d_napari.index import get_slice_index
+from pystack3d_napari.pyramid import build_pyramid, read_pyramid, bin2, PYRAMID_DIRNAME
+
+
+def write_slices(dirname, nslices=3, shape=(600, 520)):
+    dirname.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    imgs = rng.integers(0, 1000, size=(nslices,) + shape).astype(np.uint16)
+    for k, img in enumerate(imgs):
+        imwrite(dirname / f"s_{k}.tif", img)
+    return imgs
+
+
+def check_levels(levels, imgs):
+    assert len(levels) == 1
+    expected = np.rint([bin2(img) for img in imgs]).astype(imgs.dtype)
+    assert levels[0].shape == (3, 300, 260) and levels[0].dtype == imgs.dtype
+    assert np.array_equal(np.asarray(levels[0][1:]), expected[1:])
+
+
+def test_zarr_levels(tmp_path):
+    pytest.importorskip("zarr")
+    imgs = write_slices(tmp_path)
+    index = get_slice_index(tmp_path)
+    build_pyramid(index)
+    assert (tmp_path / PYRAMID_DIRNAME / "levels.zarr").is_dir()
+    levels = read_pyramid(index)
+    assert not isinstance(levels[0], np.ndarray)  # (lazy, chunked)
+    check_levels(levels, imgs)
+
+
+def test_npy_levels_without_zarr(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'has_zarr', lambda: False)
+    imgs = write_slices(tmp_path)
+    index = get_slice_index(tmp_path)
+    build_pyramid(index)
+    levels = read_pyramid(index)
+    assert isinstance(levels[0], np.memmap)
+    check_levels(levels, imgs)
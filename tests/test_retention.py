@@ -0,0 +1,75 @@
+import json
+
+import numpy as np
+from tifffile import TiffFile, imwrite
+
+from pystack3d_napari.fusion import get_restart_step, FUSED_NAME
+from pystack3d_napari.retention import (get_steps_to_release, release_step, clamp_level,
+                                        compress_tiff, TIFF_TAGS)
+
+HISTORY = ['cropping', 'registration_calculation', 'registration_transformation', 'destriping']
+
+
+def test_policies(tmp_path):
+    assert get_steps_to_release('all', tmp_path, ['.'], HISTORY) == []
+    assert get_steps_to_release('consumed', tmp_path, ['.'], HISTORY) == \
+        ['cropping', 'registration_transformation']
+    assert get_steps_to_release('final', tmp_path, ['.'], HISTORY) == \
+        ['cropping', 'registration_transformation']
+    assert get_steps_to_release('last', tmp_path, ['.'], HISTORY, nkeep=2) == ['cropping']
+
+
+def test_pending_inputs_kept(tmp_path):
+    assert get_steps_to_release('consumed', tmp_path, ['.'], ['cropping'],
+                                pending=['destriping', 'cropping_final']) == []
+    assert get_steps_to_release('last', tmp_path, ['.'], ['cropping', 'destriping'],
+                                pending=['cropping_final']) == ['cropping']
+
+
+def test_unsaved_steps_ignored(tmp_path):
+    dirname = tmp_path / 'process' / 'registration_transformation' / '.' / 'outputs'
+    dirname.mkdir(parents=True)
+    (dirname / FUSED_NAME).write_text(json.dumps({'saved': False}), encoding='utf-8')
+    assert get_steps_to_release('final', tmp_path, ['.'], HISTORY) == ['cropping']
+
+
+def test_release_step(tmp_path):
+    dirname = tmp_path / 'process' / 'cropping' / 'channel_0'
+    (dirname / 'outputs').mkdir(parents=True)
+    for k in range(3):
+        imwrite(dirname / f"slice_{k}.tif", np.zeros((8, 8), dtype=np.uint16))
+    nbytes = sum(fname.stat().st_size for fname in dirname.glob("*.tif"))
+    assert release_step(tmp_path, 'cropping', ['channel_0'], policy='final') == nbytes
+    assert list(dirname.glob("*.tif")) == [] and (dirname / 'outputs').is_dir()
+    assert get_steps_to_release('final', tmp_path, ['channel_0'], HISTORY) == \
+        ['registration_transformation']
+
+
+def test_restart_from_released_input(tmp_path):
+    # 'cropping' released, 'registration_transformation' fused with 'destriping' (not saved)
+    history = HISTORY + ['cropping_final']
+    (tmp_path / 'process' / 'cropping').mkdir(parents=True)
+    release_step(tmp_path, 'cropping', ['.'], policy='consumed')
+    dirname = tmp_path / 'process' / 'registration_transformation' / '.' / 'outputs'
+    dirname.mkdir(parents=True)
+    (dirname / FUSED_NAME).write_text(json.dumps({'saved': False}), encoding='utf-8')
+    assert get_restart_step(tmp_path, ['.'], history, 'cropping_final') == 'cropping_final'
+    assert get_restart_step(tmp_path, ['.'], history, 'destriping') == 'cropping'
+    assert get_restart_step(tmp_path, ['.'], history, 'registration_calculation') == 'cropping'
+    assert get_restart_step(tmp_path, ['.'], history, 'cropping') == 'cropping'
+
+
+def test_clamp_level():
+    assert clamp_level('deflate', 22) == 9
+    assert clamp_level('zstd', 22) == 22 and clamp_level('zstd', 0) == 1
+    assert clamp_level('none', 22) == 22 and clamp_level('lzma', None) is None
+
+
+def test_compress_tiff_out_of_range_level(tmp_path):
+    fname = tmp_path / "s_0.tif"
+    arr = np.arange(256, dtype=np.uint16).reshape(16, 16)
+    imwrite(fname, arr)
+    compress_tiff(fname, 'deflate', level=22)  # (zlib accepts 0-9 only)
+    with TiffFile(fname) as fid:
+        assert fid.pages[0].compression == TIFF_TAGS['deflate']
+        assert np.array_equal(fid.asarray(), arr)
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from tifffile import imwrite
+
+pytest.importorskip("zarr")
+
+from pystack3d_napari import utils
+from pystack3d_napari import index as slice_index
+from pystack3d_napari.index import get_slice_index
+from pystack3d_napari.store import write_store, open_store, ZarrStack
+
+
+def write_slices(dirname, nslices=4, shape=(16, 20)):
+    dirname.mkdir(parents=True, exist_ok=True)
+    imgs = np.arange(nslices * shape[0] * shape[1], dtype=np.uint16).reshape(nslices, *shape)
+    for k, img in enumerate(imgs):
+        imwrite(dirname / f"slice_{k}.tif", img)
+    return imgs
+
+
+def test_export(tmp_path):
+    imgs = write_slices(tmp_path / 'ch')
+    fname = write_store(tmp_path / 'ch', chunks=[2, 8, 8])
+    stack = ZarrStack(fname, ind_min=1, ind_max=2)
+    assert stack.shape == (2, 16, 20)
+    assert np.array_equal(np.asarray(stack.to_dask()), imgs[1:3])
+    assert np.array_equal(stack.read(0), imgs[1])
+
+
+def test_outdated_store(tmp_path):
+    write_slices(tmp_path / 'ch')
+    write_store(tmp_path / 'ch')
+    index = get_slice_index(tmp_path / 'ch')
+    assert open_store(tmp_path / 'ch', index) is not None
+    imwrite(tmp_path / 'ch' / "slice_4.tif", np.zeros((16, 20), dtype=np.uint16))
+    index.update()
+    assert open_store(tmp_path / 'ch', index) is None
+
+
+def test_get_layers_without_scan(tmp_path, monkeypatch):
+    imgs = write_slices(tmp_path / 'cropping' / 'ch')
+    write_store(tmp_path / 'cropping' / 'ch')
+
+    def scan(*args, **kwargs):
+        raise AssertionError("tiff slices scanned")
+
+    monkeypatch.setattr(slice_index, 'get_slice_index', scan)
+    layers = utils.get_layers(tmp_path / 'cropping', ['ch'], ind_min=0, ind_max=2)
+    assert len(layers) == 1
+    data, kwargs, _ = layers[0]
+    assert isinstance(kwargs['metadata']['tiff_stack'], ZarrStack)
+    assert np.array_equal(np.asarray(data), imgs[:3])